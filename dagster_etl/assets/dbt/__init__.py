@@ -1,17 +1,20 @@
 from typing import Any, Mapping
 
-from dagster import AssetExecutionContext, AssetKey, file_relative_path
+from dagster import AssetExecutionContext, AssetKey, Output, file_relative_path
 from dagster_dbt import (
     DagsterDbtTranslator,
     DbtCliResource,
     dbt_assets,
 )
 
+from ...utils.metrics import LOAD_METADATA
+from .manifest import cached_manifest_path
+
 DBT_PROJECT_DIR = file_relative_path(__file__, "../../../dbt_project")
 
 dbt_resource = DbtCliResource(project_dir=DBT_PROJECT_DIR)
-dbt_parse_invocation = dbt_resource.cli(["parse"]).wait()
-dbt_manifest_path = dbt_parse_invocation.target_path.joinpath("manifest.json")
+# Reuses the last manifest.json unless the project changed, so loading the code location doesn't parse every time
+dbt_manifest_path = cached_manifest_path(dbt_resource, DBT_PROJECT_DIR)
 
 
 class CustomDagsterDbtTranslator(DagsterDbtTranslator):
@@ -31,5 +34,8 @@ class CustomDagsterDbtTranslator(DagsterDbtTranslator):
     dagster_dbt_translator=CustomDagsterDbtTranslator(),
 )
 def dbt_project_assets(context: AssetExecutionContext, dbt: DbtCliResource):
-    yield from dbt.cli(["build"], context=context).stream()
+    for event in dbt.cli(["build"], context=context).stream():
+        if isinstance(event, Output):
+            context.add_output_metadata(dict(LOAD_METADATA), output_name=event.output_name)
+        yield event
 
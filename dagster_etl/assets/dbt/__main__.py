@@ -0,0 +1,5 @@
+# `python -m dagster_etl.assets.dbt` parses the project if it changed, run by the deploy workflows so
+# the image ships with target/manifest.json and code locations start without running `dbt parse`
+from . import dbt_manifest_path
+
+print(dbt_manifest_path)
@@ -0,0 +1,68 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from importlib.metadata import version
+from pathlib import Path
+
+from dagster import get_dagster_logger
+
+from ...utils.metrics import LOAD_METADATA
+
+# Everything under these decides what `dbt parse` produces, installed packages included
+DBT_SOURCE_DIRS = ("models", "macros", "seeds", "snapshots", "tests", "analyses", "dbt_packages")
+DBT_SOURCE_FILES = ("dbt_project.yml", "profiles.yml", "packages.yml", "dependencies.yml", "selectors.yml")
+
+
+def project_hash(project_dir: str) -> str:
+    """Hash of the dbt project's sources and the dbt version that parses them."""
+    root = Path(project_dir)
+    paths = [root / name for name in DBT_SOURCE_FILES if (root / name).is_file()]
+    for directory in DBT_SOURCE_DIRS:
+        paths.extend(path for path in (root / directory).rglob("*") if path.is_file())
+
+    digest = hashlib.sha256(version("dbt-core").encode("utf-8"))
+    for path in sorted(paths):
+        digest.update(b"\0" + path.relative_to(root).as_posix().encode("utf-8") + b"\0")
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _write_atomically(path: Path, data: bytes) -> None:
+    descriptor, temp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    with os.fdopen(descriptor, "wb") as file:
+        file.write(data)
+    os.replace(temp_path, path)
+
+
+def cached_manifest_path(dbt_resource, project_dir: str) -> Path:
+    """Path to a manifest.json for the project, only running `dbt parse` when its sources changed.
+
+    The hash of the sources the manifest was parsed from is kept next to it in target/. The
+    deploy workflows run `python -m dagster_etl.assets.dbt` so the image ships with both. Set
+    DAGSTER_DBT_PARSE_PROJECT_ON_LOAD to always parse.
+    """
+    started = time.perf_counter()
+    target = Path(project_dir) / "target"
+    manifest_path = target / "manifest.json"
+    hash_path = target / "manifest.sha256"
+    current_hash = project_hash(project_dir)
+
+    if (
+        not os.getenv("DAGSTER_DBT_PARSE_PROJECT_ON_LOAD")
+        and manifest_path.is_file()
+        and hash_path.is_file()
+        and hash_path.read_text() == current_hash
+    ):
+        LOAD_METADATA.update(dbt_manifest_parsed=0, dbt_manifest_seconds=round(time.perf_counter() - started, 3))
+        return manifest_path
+
+    invocation = dbt_resource.cli(["parse"]).wait()
+    target.mkdir(exist_ok=True)
+    _write_atomically(manifest_path, invocation.target_path.joinpath("manifest.json").read_bytes())
+    _write_atomically(hash_path, current_hash.encode("utf-8"))
+    shutil.rmtree(invocation.target_path, ignore_errors=True)
+    LOAD_METADATA.update(dbt_manifest_parsed=1, dbt_manifest_seconds=round(time.perf_counter() - started, 3))
+    get_dagster_logger().info(f"Parsed dbt project in {LOAD_METADATA['dbt_manifest_seconds']:.1f}s")
+    return manifest_path
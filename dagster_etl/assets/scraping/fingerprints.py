@@ -0,0 +1,69 @@
+import hashlib
+import json
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+import pyarrow as pa
+from dagster_duckdb import DuckDBResource
+
+# Fields of an Algolia hit that change when the prices or availability of a sailing change
+FINGERPRINT_FIELDS = ("orderingPrice", "orderingWebFare", "prices", "available", "promoCodes", "fareCodes")
+
+FINGERPRINT_TABLE = "public.sailing_fingerprints"
+
+
+def hit_fingerprint(hit: dict) -> str:
+    fields = {field: hit.get(field) for field in FINGERPRINT_FIELDS}
+    canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _ensure_table(conn) -> None:
+    conn.execute("create schema if not exists public")
+    conn.execute(
+        f"""
+        create table if not exists {FINGERPRINT_TABLE} (
+            sail_code varchar,
+            currency varchar,
+            fingerprint varchar,
+            scraped_at timestamp,
+            primary key (sail_code, currency)
+        )
+        """
+    )
+
+
+def load_fingerprints(duckdb: DuckDBResource, currency: str) -> Dict[str, Tuple[str, datetime]]:
+    """sail_code -> (fingerprint, scraped_at) from the last time each sailing was scraped."""
+    with duckdb.get_connection() as conn:
+        _ensure_table(conn)
+        rows = conn.execute(
+            f"select sail_code, fingerprint, scraped_at from {FINGERPRINT_TABLE} where currency = ?", [currency]
+        ).fetchall()
+    return {sail_code: (fingerprint, scraped_at) for sail_code, fingerprint, scraped_at in rows}
+
+
+def save_fingerprints(duckdb: DuckDBResource, currency: str, fingerprints: Iterable[Tuple[str, str]], scraped_at: datetime) -> None:
+    sail_codes, values = [], []
+    for sail_code, fingerprint in fingerprints:
+        sail_codes.append(sail_code)
+        values.append(fingerprint)
+    scraped = pa.table({
+        "sail_code": pa.array(sail_codes, type=pa.string()),
+        "currency": pa.array([currency] * len(sail_codes), type=pa.string()),
+        "fingerprint": pa.array(values, type=pa.string()),
+        "scraped_at": pa.array([scraped_at] * len(sail_codes), type=pa.timestamp("us")),
+    })
+    with duckdb.get_connection() as conn:
+        _ensure_table(conn)
+        conn.register("scraped", scraped)
+        conn.execute(f"insert or replace into {FINGERPRINT_TABLE} select * from scraped")
+        conn.unregister("scraped")
+
+
+def needs_scrape(previous: Optional[Tuple[str, datetime]], fingerprint: Optional[str], stale_before: datetime) -> bool:
+    """True for new sailings, sailings whose hit changed, and sailings last scraped before `stale_before`."""
+    if previous is None or fingerprint is None:
+        return True
+    previous_fingerprint, scraped_at = previous
+    return previous_fingerprint != fingerprint or scraped_at < stale_before
@@ -0,0 +1,54 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+import pandas as pd
+
+from .scheduler import ScrapeUnit
+
+
+@dataclass(frozen=True)
+class SailingPlan:
+    sail_code: str
+    cabin_categories: Tuple[str, ...]
+    fare_codes: Tuple[str, ...]
+
+
+def build_availability_index(cabin_categories: pd.DataFrame, sail_codes: Iterable[dict]) -> Dict[str, SailingPlan]:
+    """Groups everything scrape_availability needs per sail code in one pass over each input.
+
+    Sail codes are matched to the cabin categories of their ship (the first 2 characters of the
+    sail_code), fare codes are de-duplicated across all rows of a sail code in first-seen order.
+    Sail codes whose ship has no known cabin categories are left out.
+    """
+    categories_by_ship = {
+        ship_code: tuple(group['cabin_category'].unique().tolist())
+        for ship_code, group in cabin_categories.groupby('ship_code', sort=False)
+    }
+
+    fare_codes_by_sail_code: Dict[str, dict] = {}
+    for row in sail_codes:
+        if row['sail_code'][:2] not in categories_by_ship:
+            continue
+        fare_codes = fare_codes_by_sail_code.setdefault(row['sail_code'], {})
+        fare_codes.update(dict.fromkeys(row['fare_codes'] or []))
+
+    return {
+        sail_code: SailingPlan(sail_code, categories_by_ship[sail_code[:2]], tuple(fare_codes))
+        for sail_code, fare_codes in fare_codes_by_sail_code.items()
+    }
+
+
+def plan_availability_units(index: Dict[str, SailingPlan], currency: str = "US") -> List[ScrapeUnit]:
+    return [
+        ScrapeUnit(action="available-suites", sail_code=plan.sail_code, fare_code=fare_code, currency=currency, cabin_categories=plan.cabin_categories)
+        for plan in index.values()
+        for fare_code in plan.fare_codes
+    ]
+
+
+def plan_size(units: List[ScrapeUnit]) -> Dict[str, int]:
+    return {
+        "plan_sail_codes": len({unit.sail_code for unit in units}),
+        "plan_units": len(units),
+        "plan_requests": sum(len(unit.requests()) for unit in units),
+    }
@@ -0,0 +1,209 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import AbstractSet, Iterable, List, Optional, Set, Tuple, Union
+
+from dagster import OpExecutionContext
+
+from ...resources import SilverSeaWebSocketClient, StorageAccountIoManager
+from ...resources.socket_responses import BAD_REQUEST, EMPTY_SUITES, PRICES_ERROR, response_outcome
+
+# (adults, kids) occupancies requested for prices-v2, a cabin holds at most 4 guests
+OCCUPANCY_COMBINATIONS = [
+    (1, 0), (1, 1), (1, 2), (1, 3),
+    (2, 0), (2, 1), (2, 2),
+    (3, 0), (3, 1),
+    (4, 0),
+]
+
+
+@dataclass(frozen=True)
+class ScrapeUnit:
+    """All socket requests whose replies are stored together in one blob."""
+    action: str
+    sail_code: str
+    fare_code: str
+    currency: str = "US"
+    cabin_categories: Tuple[Optional[str], ...] = (None,)
+
+    @property
+    def blob_name(self) -> str:
+        return f"socket/sail_code={self.sail_code}/action={self.action}/currency={self.currency}/fare_code={self.fare_code}/data"
+
+    def requests(self) -> List[Tuple[int, int, Optional[str]]]:
+        """(adults, kids, cabin_category) for every request of this unit."""
+        if self.action == 'available-suites':
+            return [(1, 0, cabin_category) for cabin_category in self.cabin_categories]
+        return [(adults, kids, None) for adults, kids in OCCUPANCY_COMBINATIONS]
+
+
+@dataclass
+class _UnitState:
+    unit: ScrapeUnit
+    remaining: int
+    pieces: List[bytes] = field(default_factory=list)
+    failed: bool = False
+
+
+def process_received_message(context, action, received_message: Union[str, bytes], fare_code, sail_code, cabin_category=None) -> bytes:
+    """The reply as bytes for the landing blob, or b"" when it carries nothing worth storing.
+
+    Replies are classified from the raw frame and never decoded here.
+    """
+    outcome = response_outcome(received_message)
+    if isinstance(received_message, str):
+        received_message = received_message.encode("utf-8")
+    if outcome == PRICES_ERROR:
+        context.log.warning(f"No such fare_code={fare_code} for sail_code={sail_code} for action={action}, skipping...")
+    elif outcome == BAD_REQUEST:
+        context.log.error(f"Bad request for {received_message.decode('utf-8', 'replace')}")
+        raise Exception("Bad request received")
+    elif action == 'available-suites' and outcome == EMPTY_SUITES:
+        context.log.warning(f"No availability for fare_code={fare_code} for sail_code={sail_code} for cabin_category={cabin_category}, skipping...")
+    else:
+        return received_message
+    return b""
+
+
+class ScrapeScheduler:
+    """Runs the requests of many ScrapeUnits through one bounded queue.
+
+    At most `concurrency` requests are outstanding across all units, and units are pulled from
+    the iterable only when there is room, so a slow sail code never holds back the others.
+    Each unit is uploaded as soon as its last reply arrives, units without any data as an empty
+    blob. Units whose blob name is in `completed` have already landed and are skipped, so a
+    retried run only does what is left.
+
+    A request that still fails after the client's replays (timeouts, dropped sockets) fails only
+    its unit: nothing is uploaded for it, so a resumed run scrapes it again. A unit whose upload
+    fails counts as failed too. The run itself fails once more than `max_failed_units` units have
+    failed, and `failed_sail_codes` holds the sail codes with at least one failed unit.
+    """
+
+    def __init__(
+        self,
+        context: OpExecutionContext,
+        socket: SilverSeaWebSocketClient,
+        storage_account_io_manager: StorageAccountIoManager,
+        concurrency: int = 200,
+        upload_workers: int = 4,
+        completed: Optional[AbstractSet[str]] = None,
+        max_failed_units: int = 100,
+    ):
+        self.context = context
+        self.socket = socket
+        self.storage_account_io_manager = storage_account_io_manager
+        self.concurrency = concurrency
+        self.upload_workers = upload_workers
+        self.completed = completed or set()
+        self.max_failed_units = max_failed_units
+        self.units_done = 0
+        self.units_skipped = 0
+        self.units_failed = 0
+        self.failed_sail_codes: Set[str] = set()
+        self.requests_done = 0
+        self._error: Optional[BaseException] = None
+        self._lock = threading.Lock()
+
+    def run(self, units: Iterable[ScrapeUnit]) -> None:
+        slots = threading.BoundedSemaphore(self.concurrency)
+        replies: queue.Queue = queue.Queue()
+
+        with ThreadPoolExecutor(max_workers=self.upload_workers) as uploads:
+            collector = threading.Thread(target=self._collect, args=(replies, uploads), name="scrape-collector")
+            collector.start()
+            try:
+                self._submit_all(units, slots, replies)
+            finally:
+                # Once every slot is back, every submitted request has been answered
+                for _ in range(self.concurrency):
+                    slots.acquire()
+                replies.put(None)
+                collector.join()
+
+        if self._error is not None:
+            raise self._error
+        self.context.log.info(
+            f"Scraped {self.units_done} units with {self.requests_done} requests, skipped {self.units_skipped} units that had already landed"
+            f" and {self.units_failed} units failed"
+        )
+
+    def _submit_all(self, units, slots, replies) -> None:
+        for unit in units:
+            if unit.blob_name in self.completed:
+                self.units_skipped += 1
+                continue
+            requests = unit.requests()
+            if not requests:
+                continue
+            state = _UnitState(unit=unit, remaining=len(requests))
+            for adults, kids, cabin_category in requests:
+                slots.acquire()
+                if self._error is not None:
+                    slots.release()
+                    return
+                try:
+                    future = self.socket.submit(self.context, unit.action, unit.fare_code, unit.sail_code, adults, kids, unit.currency, cabin_category)
+                except BaseException:
+                    slots.release()
+                    raise
+                future.add_done_callback(
+                    lambda future, state=state, cabin_category=cabin_category: (replies.put((state, future, cabin_category)), slots.release())
+                )
+
+    def _collect(self, replies: queue.Queue, uploads: ThreadPoolExecutor) -> None:
+        while True:
+            item = replies.get()
+            if item is None:
+                return
+            state, future, cabin_category = item
+            if self._error is not None:
+                continue
+            unit = state.unit
+            state.remaining -= 1
+            exception = future.exception()
+            if exception is not None:
+                self.context.log.warning(f"Request for sail_code={unit.sail_code} fare_code={unit.fare_code} action={unit.action} failed: {exception!r}")
+                state.failed = True
+            else:
+                try:
+                    data_piece = process_received_message(self.context, unit.action, future.result(), unit.fare_code, unit.sail_code, cabin_category)
+                except BaseException as e:
+                    self._error = e
+                    continue
+                if data_piece:
+                    state.pieces.append(data_piece)
+                self.requests_done += 1
+            if state.remaining == 0:
+                if state.failed:
+                    self.context.log.warning(f"Not storing {unit.blob_name}, some of its requests failed")
+                    self._unit_failed(unit)
+                else:
+                    uploads.submit(self._store, state)
+
+    def _unit_failed(self, unit: ScrapeUnit) -> None:
+        # Called from the collector and the upload workers
+        with self._lock:
+            self.units_failed += 1
+            self.failed_sail_codes.add(unit.sail_code)
+            if self.units_failed > self.max_failed_units:
+                self._error = Exception(f"{self.units_failed} units failed, more than max_failed_units={self.max_failed_units}")
+
+    def _store(self, state: _UnitState) -> None:
+        unit = state.unit
+        try:
+            if state.pieces:
+                data = b"\n".join(state.pieces) + b"\n"
+                self.context.log.info(f"Blob name will be {unit.blob_name}")
+            else:
+                # An empty blob still marks the unit as done, so a resumed run doesn't ask again
+                self.context.log.warning(f"No data was recorded for fare_code={unit.fare_code} for sail_code={unit.sail_code} for action={unit.action}")
+                data = b""
+            if not self.storage_account_io_manager.upload_blob(self.context, competitor="silversea", json_data=data, blob_name=unit.blob_name):
+                self._unit_failed(unit)
+                return
+            with self._lock:
+                self.units_done += 1
+        except BaseException as e:
+            self._error = e
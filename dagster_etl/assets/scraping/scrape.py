@@ -1,12 +1,45 @@
 import json
-import time
-from dagster import (AssetExecutionContext, StaticPartitionMapping, asset, OpExecutionContext,AssetMaterialization, StaticPartitionsDefinition, AssetDep)
+from dagster import (AssetExecutionContext, Config, asset, DynamicPartitionsDefinition, MetadataValue, MultiPartitionsDefinition)
 from dagster_duckdb import DuckDBResource
-import duckdb
 import pandas as pd
-from ...resources import SilverSeaWebSocketClient, StorageAccountIoManager
-from typing import List, Optional
+import pyarrow as pa
+from ...resources import LazyDuckDBTable, StorageAccountIoManager
+from ...resources.algolia_api import AlgoliaError
+from ...utils import fastjson
+from ..staging.silversea import currency_partition
+from typing import List, Optional, Set
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from .planning import build_availability_index, plan_availability_units, plan_size
+from .fingerprints import hit_fingerprint, load_fingerprints, needs_scrape, save_fingerprints
+from .scheduler import ScrapeScheduler, ScrapeUnit
+
+
+# Ship codes are registered by store_sail_codes_file as new ships show up in Algolia
+ship_code_partition = DynamicPartitionsDefinition(name="ship_codes")
+# The socket scraping runs once per currency and ship, so partitions can run in parallel on separate run workers
+currency_ship_partition = MultiPartitionsDefinition({"currency": currency_partition, "ship_code": ship_code_partition})
+
+def scrape_partition(context) -> tuple:
+    """(currency, ship_code) of the partition being scraped."""
+    keys = context.partition_key.keys_by_dimension
+    return keys["currency"], keys["ship_code"]
+
+class ScrapeConfig(Config):
+    # Maximum number of socket requests in flight across all sail codes
+    concurrency: int = 200
+    # Skip units that already landed today, so a retried run only scrapes what is left
+    resume: bool = True
+    # Units whose requests still fail after the websocket's replays are left for the next run,
+    # the run only fails once more than this many have failed
+    max_failed_units: int = 100
+
+class CombinationConfig(ScrapeConfig):
+    # Only scrape sailings whose Algolia hit changed since they were last scraped. The others get
+    # no blobs in that day's socket landing, so the day's staged prices only cover changed sailings
+    incremental: bool = False
+    # Unchanged sailings are still scraped again once their last scrape is this old
+    refresh_after_days: int = 28
 
 def get_all_full_cabin_categories(duckdb: DuckDBResource):
     query = """
@@ -19,197 +52,185 @@ def get_all_full_cabin_categories(duckdb: DuckDBResource):
 
     return df
 
-def process_received_message(context, action, received_message, fare_code, sail_code, cabin_category=None):
-    message = json.loads(received_message)
-    if '"PricesErrorResponseV2"' in received_message:
-        context.log.warn(f"No such fare_code={fare_code} for sail_code={sail_code} for action={action}, skipping...")
-    elif '"BadRequestResponse"' in received_message:
-        context.log.error(f"Bad request for {received_message}")
-        raise Exception("Bad request received")
-    elif action == 'available-suites' and 'suites' in message and not message['suites']:
-        context.log.warn(f"No availability for fare_code={fare_code} for sail_code={sail_code} for cabin_category={cabin_category}, skipping...")
-    else:
-        return received_message
-    return ""
-
-def execute_requests(context, socket, action, sail_code, fare_code, currency, cabin_categories, combinations):
-    futures = []
-    data = ""
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        if action == 'available-suites':
-            for cabin_category in cabin_categories:
-                futures.append(executor.submit(socket.send_and_receive, context, action, fare_code, sail_code, 1, 0, currency, cabin_category))
-        else:
-            for adults, kids in combinations.keys():
-                if adults + kids <= 4:
-                    futures.append(executor.submit(socket.send_and_receive, context, action, fare_code, sail_code, adults, kids, currency, None))
-        
-        for future in as_completed(futures):
-            received_message = future.result()
-            data_piece = process_received_message(context, action, received_message, fare_code, sail_code)
-            if data_piece:
-                data += data_piece + "\n"
-    
-    return data
-
-def get_and_store(
-    context: OpExecutionContext,
-    socket: SilverSeaWebSocketClient,
-    action: str,
-    sail_code: str,
-    storage_account_io_manager: StorageAccountIoManager,
-    fare_code: str = "Essential",
-    currency: str = "US",
-    cabin_categories: Optional[List[str]] = None,
-) -> None:
-    if action not in ["prices-v2", "available-suites"]:
-        context.log.error("Incorrect action set")
-        return
-
-    if action == 'available-suites' and cabin_categories is None:
-        cabin_categories = [None]
-
-    combinations = {
-        (1, 0): "1 adult, 0 kids",
-        (1, 1): "1 adult, 1 kid",
-        (1, 2): "1 adult, 2 kids",
-        (1, 3): "1 adult, 3 kids",
-        (2, 0): "2 adults, 0 kids",
-        (2, 1): "2 adults, 1 kid",
-        (2, 2): "2 adults, 2 kids",
-        (3, 0): "3 adults, 0 kids",
-        (3, 1): "3 adults, 1 kid",
-        (4, 0): "4 adults, 0 kids",
+def landed_units(context, storage_account_io_manager: StorageAccountIoManager, action: str, currency: str) -> Set[str]:
+    """Blob names of the units of `action` that already landed today, used as the run's checkpoint."""
+    landed = storage_account_io_manager.landed_blob_names(context, "silversea", "socket", filters={"action": action, "currency": currency})
+    context.log.info(f"Found {len(landed)} {action} units that already landed today")
+    return landed
+
+class AlgoliaConfig(Config):
+    hits_per_page: int = 100
+    # How many page queries are packed into one /1/indexes/*/queries call
+    pages_per_request: int = 10
+    max_parallel_requests: int = 4
+    # Assume for now they won't have more hits. This prevents the job from running forever.
+    max_hits: int = 3020
+
+def algolia_page_query(page: int, hits_per_page: int) -> dict:
+    return {
+        "indexName": "prod_cruises_all_languages",
+        "params": f"analytics=false&distinct=true&filters=(countries%3A%22US%22)&hitsPerPage={hits_per_page}&maxValuesPerFacet=100&page={page}&query=&tagFilters=",
     }
 
-    data = execute_requests(context, socket, action, sail_code, fare_code, currency, cabin_categories, combinations)
-
-    if data:
-        blob_name = f"socket/sail_code={sail_code}/action={action}/currency={currency}/fare_code={fare_code}/data"
-        context.log.info(f"Blob name will be {blob_name}")
-        storage_account_io_manager.upload_blob(context, competitor="silversea", json_data=data, blob_name=blob_name)
-    else:
-        context.log.warn(f"No data was recorded for fare_code={fare_code} for sail_code={sail_code} for action={action}")
+def fetch_algolia_pages(context, algolia_api, pages: List[int], hits_per_page: int) -> Optional[List[dict]]:
+    """Fetches several pages with one multi-query request, returning one result per page."""
+    payload = json.dumps({"requests": [algolia_page_query(page, hits_per_page) for page in pages]})
+    algolia_api.log_metrics(context.log)
+    try:
+        return algolia_api.query(payload)["results"]
+    except AlgoliaError as e:
+        context.log.error(f"Error fetching pages {pages}: {e}")
+        return None
 
 @asset(
     required_resource_keys={"storage_account_io_manager", "algolia_api"},
     description="Fetches sail codes prices for all cabins"
 )
-def store_sail_codes_file(context: AssetExecutionContext) -> pd.DataFrame:
+def store_sail_codes_file(context: AssetExecutionContext, config: AlgoliaConfig) -> pa.Table:
     storage_account_io_manager = context.resources.storage_account_io_manager
     algolia_api = context.resources.algolia_api
-    page = 0
-    sail_codes_data = []
-
-    while True:  # Continue until all pages are processed
-        time.sleep(1)
-        payload = json.dumps(
-            {
-                "requests": [
-                    {
-                        "indexName": "prod_cruises_all_languages",
-                        "params": f"analytics=false&distinct=true&filters=(countries%3A%22US%22)&hitsPerPage=10&maxValuesPerFacet=100&page={page}&query=&tagFilters=",
-                    }
-                ]
-            }
-        )
-
-        response = algolia_api.request("POST", "/1/indexes/*/queries", payload)
-        if response.status != 200:
-            context.log.error(f"Error: {response.status} - {response.reason}")
-            break
-
-        result = json.loads(response.read().decode("utf-8"))
-        page_target = result["results"][0]["nbPages"]
-        sail_code = ''
-        for hit in result["results"][0]["hits"]:
-            sail_code = hit["cruiseCode"]
-            fare_codes = hit.get("fareCodes", [])
-            sail_codes_data.append({
-                "sail_code": sail_code,
-                "fare_codes": fare_codes
-            })
-
-        result_str = json.dumps(result)
-        storage_account_io_manager.upload_blob(
-            context,
-            competitor="silversea",
-            json_data=result_str,
-            blob_name=f"algolia/{page}",
-        )
-        # Assume for now they won't have more pages. This prevents the job from running forever.
-        if page > 300 or page >= page_target - 1:
-            context.log.warn(f"Stopped at page {page} and target was {page_target}")
-            break  # Stop the loop when all pages are processed
-
-        page += 1
-
-    # Convert sail_codes_data to a DataFrame
-    df = pd.DataFrame(sail_codes_data)
-    context.log.info(df)
-    return df
+    results_by_page = {}
+
+    with ThreadPoolExecutor(max_workers=4) as uploads:
+        def store_page(page, result):
+            results_by_page[page] = result
+            uploads.submit(
+                storage_account_io_manager.upload_blob,
+                context,
+                competitor="silversea",
+                json_data=fastjson.dumps({"results": [result]}),
+                blob_name=f"algolia/{page}",
+            )
+
+        # The first page tells us how many pages there are, the rest are fetched in parallel batches
+        first = fetch_algolia_pages(context, algolia_api, [0], config.hits_per_page)
+        if first:
+            store_page(0, first[0])
+            page_target = first[0]["nbPages"]
+            max_pages = -(-config.max_hits // config.hits_per_page)
+            if page_target > max_pages:
+                context.log.warning(f"Stopping at page {max_pages} and target was {page_target}")
+            remaining = list(range(1, min(page_target, max_pages)))
+            batches = [remaining[i:i + config.pages_per_request] for i in range(0, len(remaining), config.pages_per_request)]
+
+            with ThreadPoolExecutor(max_workers=config.max_parallel_requests) as requests:
+                futures = {requests.submit(fetch_algolia_pages, context, algolia_api, batch, config.hits_per_page): batch for batch in batches}
+                for future in as_completed(futures):
+                    for page, result in zip(futures[future], future.result() or []):
+                        store_page(page, result)
+
+    sail_codes, fare_codes, fingerprints = [], [], []
+    for page in sorted(results_by_page):
+        for hit in results_by_page[page]["hits"]:
+            sail_codes.append(hit["cruiseCode"])
+            fare_codes.append(hit.get("fareCodes", []))
+            fingerprints.append(hit_fingerprint(hit))
+
+    # Built as Arrow so the fare_codes lists go into DuckDB without a round trip through pandas objects
+    table = pa.table({
+        "sail_code": pa.array(sail_codes, type=pa.string()),
+        "fare_codes": pa.array(fare_codes, type=pa.list_(pa.string())),
+        "fingerprint": pa.array(fingerprints, type=pa.string()),
+    })
+    context.log.info(f"Found {table.num_rows} sail codes")
+
+    # The first 2 characters of the sail_code are the ship_code
+    ship_codes = sorted({sail_code[:2] for sail_code in sail_codes})
+    known_ship_codes = set(context.instance.get_dynamic_partitions(ship_code_partition.name))
+    new_ship_codes = [ship_code for ship_code in ship_codes if ship_code not in known_ship_codes]
+    if new_ship_codes:
+        context.log.info(f"Adding ship code partitions {new_ship_codes}")
+        context.instance.add_dynamic_partitions(ship_code_partition.name, new_ship_codes)
+
+    context.add_output_metadata({
+        "pages": len(results_by_page),
+        "ship_codes": MetadataValue.json(ship_codes),
+        **algolia_api.throttle_metadata(),
+        **algolia_api.metrics_metadata(),
+        **storage_account_io_manager.metrics_metadata(),
+    })
+    return table
 
 
 
 @asset(
-    required_resource_keys={"storage_account_io_manager", "websocket"},
+    required_resource_keys={"storage_account_io_manager", "websocket", "duckdb"},
     description="Processes each combination of sail code and currency",
-    #partitions_def=StaticPartitionsDefinition(['GB', 'AS', 'CA', 'IE', 'US']),
+    partitions_def=currency_ship_partition,
 )
-def process_combination(context: AssetExecutionContext, store_sail_codes_file) -> None:
+def process_combination(context: AssetExecutionContext, config: CombinationConfig, store_sail_codes_file: LazyDuckDBTable) -> None:
     storage_account_io_manager = context.resources.storage_account_io_manager
     websocket = context.resources.websocket
-    #currency = context.partition_key
-    currency = 'US'
-
-    total_sail_codes = len(store_sail_codes_file['sail_code'])
-    context.log.info(f"Beginning to iterate through {total_sail_codes}")
-    for index, row in store_sail_codes_file.iterrows():
-            sail_code = row['sail_code']
-            fare_codes = row['fare_codes']
+    duckdb = context.resources.duckdb
+    currency, ship_code = scrape_partition(context)
+
+    # Read the ship's rows up front so the database isn't held open while scraping
+    rows = [row for row in store_sail_codes_file.iter_rows() if row['sail_code'][:2] == ship_code]
+    total_sail_codes = len(rows)
+    context.log.info(f"Beginning to iterate through {total_sail_codes} sail codes of {ship_code} in {currency}")
+
+    started_at = datetime.utcnow()
+    previous = load_fingerprints(duckdb, currency) if config.incremental else {}
+    stale_before = started_at - timedelta(days=config.refresh_after_days)
+    scraped = []
+
+    def units():
+        for index, row in enumerate(rows):
+            fingerprint = row.get('fingerprint')
+            if config.incremental and not needs_scrape(previous.get(row['sail_code']), fingerprint, stale_before):
+                continue
             context.log.info(f"at {index} of {total_sail_codes}")
-            for fare_code in fare_codes:
-                context.log.info(f"Generating combination for sail code {sail_code} and fare code {fare_code} with {currency}.")
-                get_and_store(
-                    context=context,
-                    socket=websocket,
-                    action="prices-v2",
-                    sail_code=sail_code,
-                    fare_code=fare_code,
-                    currency=currency,
-                    storage_account_io_manager=storage_account_io_manager,
-                )
+            scraped.append((row['sail_code'], fingerprint))
+            for fare_code in row['fare_codes'] or []:
+                yield ScrapeUnit(action="prices-v2", sail_code=row['sail_code'], fare_code=fare_code, currency=currency)
+
+    completed = landed_units(context, storage_account_io_manager, "prices-v2", currency) if config.resume else None
+    scheduler = ScrapeScheduler(context, websocket, storage_account_io_manager, concurrency=config.concurrency, completed=completed,
+                                max_failed_units=config.max_failed_units)
+    scheduler.run(units())
+    # Recorded on every run so an incremental run always has a baseline to compare against. Sailings
+    # with a unit that didn't land keep their old fingerprint, so the next incremental run retries them
+    save_fingerprints(
+        duckdb,
+        currency,
+        [(sail_code, fingerprint) for sail_code, fingerprint in scraped if fingerprint and sail_code not in scheduler.failed_sail_codes],
+        started_at,
+    )
+    context.log.info(f"Scraped {len(scraped)} of {total_sail_codes} sailings")
+    context.add_output_metadata({
+        "sailings_scraped": len(scraped),
+        "sailings_skipped": total_sail_codes - len(scraped),
+        "units_resumed": scheduler.units_skipped,
+        "units_failed": scheduler.units_failed,
+        **websocket.throttle_metadata(),
+        **websocket.cache_metadata(),
+        **websocket.metrics_metadata(),
+        **storage_account_io_manager.metrics_metadata(),
+    })
 
 @asset(
     required_resource_keys={"storage_account_io_manager", "websocket", "duckdb"},
-    description="Checks for each cabin category the availability of the cabins"
+    description="Checks for each cabin category the availability of the cabins",
+    partitions_def=currency_ship_partition,
 )
-def scrape_availability(context: AssetExecutionContext, store_sail_codes_file) -> None:
+def scrape_availability(context: AssetExecutionContext, config: ScrapeConfig, store_sail_codes_file: LazyDuckDBTable) -> None:
     storage_account_io_manager = context.resources.storage_account_io_manager
     websocket = context.resources.websocket
     duckdb = context.resources.duckdb
+    currency, ship_code = scrape_partition(context)
+    # Read before the duckdb resource connects, the input is read through its own connection
+    rows = [row for row in store_sail_codes_file.iter_rows() if row['sail_code'][:2] == ship_code]
     cabin_categories = get_all_full_cabin_categories(duckdb) #This is always yesterdays data
-    # Extract the first 2 characters of sail_code
-    store_sail_codes_file['ship_code'] = store_sail_codes_file['sail_code'].apply(lambda x: x[:2])
-    # Perform the merge
-    merged_df = pd.merge(cabin_categories, store_sail_codes_file, on='ship_code', how='inner')
-    total_sail_codes = len(store_sail_codes_file['sail_code'].unique())
-    context.log.info(f"Total unique sail codes: {total_sail_codes}")
-
-    # Iterate through each sail_code
-    for index, sail_code in enumerate(store_sail_codes_file['sail_code'].unique(), start=1):
-        context.log.info(f"iterating {index}-{sail_code} of {total_sail_codes}")
-        sail_code_rows = merged_df[merged_df['sail_code'] == sail_code]
-        cabin_categories = sail_code_rows['cabin_category'].unique().tolist()
-        fare_codes_list = sail_code_rows['fare_codes'].drop_duplicates()
-        for fare_code in fare_codes_list: #TODO, fix this.
-            for code in fare_code:
-                get_and_store(
-                context=context,
-                socket=websocket,
-                action="available-suites",
-                sail_code=sail_code,
-                fare_code=code,
-                cabin_categories=cabin_categories,
-                storage_account_io_manager=storage_account_io_manager,
-            )
+    cabin_categories = cabin_categories[cabin_categories['ship_code'] == ship_code]
+
+    index = build_availability_index(cabin_categories, rows)
+    units = plan_availability_units(index, currency)
+    size = plan_size(units)
+    context.log.info(f"Planned {size['plan_units']} units with {size['plan_requests']} requests for {size['plan_sail_codes']} sail codes")
+
+    completed = landed_units(context, storage_account_io_manager, "available-suites", currency) if config.resume else None
+    scheduler = ScrapeScheduler(context, websocket, storage_account_io_manager, concurrency=config.concurrency, completed=completed,
+                                max_failed_units=config.max_failed_units)
+    scheduler.run(units)
+    context.add_output_metadata({**size, "units_resumed": scheduler.units_skipped, "units_failed": scheduler.units_failed, **websocket.throttle_metadata(), **websocket.cache_metadata(),
+                               **websocket.metrics_metadata(), **storage_account_io_manager.metrics_metadata()})
@@ -0,0 +1,174 @@
+"""Typed schemas of the staged Silversea tables.
+
+Each record class declares one table's columns and their Python types, and the Arrow schema
+(and so the DuckDB table the Arrow IO manager creates) is derived from it. The parsers don't
+build a record per row, they append straight into `ColumnBuffers`: non-null integer and float
+columns go into typed arrays, everything else into lists that Arrow converts with the declared
+type. Every partition therefore gets the same column types, even when a column is all null.
+"""
+import dataclasses
+import typing
+from array import array
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Type
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+@dataclass(slots=True)
+class Price:
+    type: Optional[str]
+    webFareCode: Optional[str]
+    amount: Optional[float]
+    originalAmount: Optional[float]
+    promoConfigurationCodes: List[str]
+
+
+@dataclass(slots=True)
+class SailCode:
+    """One Algolia hit."""
+    destination_name: Optional[str]
+    is_visible: Optional[bool]
+    ship_code: str
+    ship_id: Optional[str]
+    ship_name: Optional[str]
+    special_type: Optional[str]
+    sail_code: str
+    cruise_id: Optional[str]
+    available: Optional[bool]
+    days: Optional[int]
+    departure_year_month: Optional[str]
+    departure_port: Optional[str]
+    arrival_port: Optional[str]
+    cruise_type: Optional[str]
+    combo_type: Optional[str]
+    port_codes: List[str]
+    port_names: List[str]
+    country_names: List[str]
+    departure_timestamp: Optional[int]
+    top_cruise: Optional[bool]
+    day_group: Optional[str]
+    features: List[str]
+    cruise_group: Optional[str]
+    fare_codes: List[str]
+    countries: List[str]
+    currency: Optional[str]
+    ordering_price: Optional[float]
+    ordering_webfare: Optional[str]
+    prices: List[Price]
+    promo_codes: List[str]
+    extract_date: str
+
+
+@dataclass(slots=True)
+class UnavailableCabin:
+    """A Left prices-v2 entry, the requested cabin has no availability for the occupancy."""
+    sail_code: str
+    ship_code: str
+    cabin_category: str
+    adults: int
+    kids: int
+    fare_code: str
+    air_type: str
+    extract_date: str
+
+
+@dataclass(slots=True)
+class AvailableCabin:
+    """A Right prices-v2 entry, a priced quote."""
+    sail_code: str
+    ship_code: str
+    cabin_category: str
+    adults: int
+    kids: int
+    fare_code: str
+    air_type: str
+    suite_payment_type: str
+    suite_payment_percentage: int
+    suite_payment_amount_value: float
+    suite_payment_amount_currency: str
+    balance_amount_value: float
+    balance_amount_currency: str
+    total_amount_value: float
+    total_amount_currency: str
+    final_duedate: str
+    inclusions: List[str]
+    guest_seqn: List[int]
+    pax_prices_totalvalue: List[float]
+    pax_prices_totalcurrency: List[str]
+    price_total_value: float
+    price_total_currency: str
+    extract_date: str
+
+
+_ARROW_TYPES = {str: pa.string(), int: pa.int64(), float: pa.float64(), bool: pa.bool_()}
+_DUCKDB_TYPES = {pa.string(): "VARCHAR", pa.int64(): "BIGINT", pa.float64(): "DOUBLE", pa.bool_(): "BOOLEAN"}
+# Typecodes of the arrays non-null numeric columns are buffered in
+_TYPECODES = {int: "q", float: "d"}
+
+
+def _unwrap_optional(annotation):
+    args = typing.get_args(annotation)
+    if typing.get_origin(annotation) is typing.Union and type(None) in args:
+        return next(arg for arg in args if arg is not type(None))
+    return annotation
+
+
+def _arrow_type(annotation) -> pa.DataType:
+    annotation = _unwrap_optional(annotation)
+    if typing.get_origin(annotation) in (list, List):
+        return pa.list_(_arrow_type(typing.get_args(annotation)[0]))
+    if dataclasses.is_dataclass(annotation):
+        return pa.struct(arrow_schema(annotation))
+    return _ARROW_TYPES[annotation]
+
+
+def _field_types(record_type: Type) -> Dict[str, object]:
+    return typing.get_type_hints(record_type)
+
+
+def arrow_schema(record_type: Type) -> pa.Schema:
+    return pa.schema([(name, _arrow_type(annotation)) for name, annotation in _field_types(record_type).items()])
+
+
+def duckdb_type(arrow_type: pa.DataType) -> str:
+    """The DuckDB column type an Arrow type is stored as."""
+    if pa.types.is_list(arrow_type):
+        return f"{duckdb_type(arrow_type.value_type)}[]"
+    if pa.types.is_struct(arrow_type):
+        return "STRUCT(" + ", ".join(f"{field.name} {duckdb_type(field.type)}" for field in arrow_type) + ")"
+    return _DUCKDB_TYPES[arrow_type]
+
+
+def duckdb_columns(record_type: Type) -> Dict[str, str]:
+    return {field.name: duckdb_type(field.type) for field in arrow_schema(record_type)}
+
+
+class ColumnBuffers(dict):
+    """Column name -> buffer for the rows of one record type, see the module docstring."""
+
+    def __init__(self, record_type: Type):
+        super().__init__()
+        self.record_type = record_type
+        self.schema = arrow_schema(record_type)
+        for name, annotation in _field_types(record_type).items():
+            typecode = _TYPECODES.get(annotation)
+            self[name] = array(typecode) if typecode else []
+
+    @property
+    def num_rows(self) -> int:
+        return len(next(iter(self.values())))
+
+    def to_batch(self) -> pa.RecordBatch:
+        return pa.RecordBatch.from_arrays([pa.array(self[field.name], type=field.type) for field in self.schema], schema=self.schema)
+
+    def to_table(self) -> pa.Table:
+        return pa.Table.from_batches([self.to_batch()], schema=self.schema)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            name: np.frombuffer(buffer, dtype=np.int64 if buffer.typecode == "q" else np.float64) if isinstance(buffer, array) else buffer
+            for name, buffer in self.items()
+        })
@@ -1,85 +1,62 @@
-from dagster import StaticPartitionsDefinition, asset, DailyPartitionsDefinition, multi_asset, AssetOut
+from dagster import Config, Output, StaticPartitionsDefinition, asset, DailyPartitionsDefinition, multi_asset, AssetOut
 from ...resources import StorageAccountIoManager
+from ...utils.profiling import peak_memory_mb
+from .schemas import AvailableCabin, ColumnBuffers, SailCode, UnavailableCabin, arrow_schema
 from datetime import datetime
 import duckdb
-import pandas as pd
+import os
+import pyarrow as pa
 import json
+import tempfile
+import time
 
 currency_partition = StaticPartitionsDefinition(['US','AS','CA','GB','IE'])
 daily_partition = DailyPartitionsDefinition(start_date="2024-06-14")
 
-def process_sail_code_json_data(json_data, extract_date):
-    data = []
+def process_sail_code_json_data(json_data, extract_date) -> pa.Table:
+    """Flattens Algolia results into a SailCode table, one row per hit."""
+    columns = ColumnBuffers(SailCode)
+    extract_date = str(extract_date)
     for item in json_data:
         results = item.get("results", [])
         for result in results:
             hits = result.get("hits", [])
             for hit in hits:
-                destination_name = hit.get("destinationName", {}).get("en")
-                visible = hit.get("visible")
-                ship_id = hit.get("content", {}).get("shipId")
-                ship_name = hit.get("content", {}).get("shipName")
-                special_type = hit.get("specialType")
+                content = hit.get("content", {})
                 cruise_code = hit.get("cruiseCode")
-                cruise_id = hit.get("cruiseId")
-                available = hit.get("available")
-                days = hit.get("days")
-                departure_year_month = hit.get("departureYearMonth")
-                departure_port = hit.get("departurePort", {}).get("city", {}).get("en")
-                arrival_port = hit.get("arrivalPort", {}).get("city", {}).get("en")
-                cruise_type = hit.get("cruiseType")
-                combo_type = hit.get("comboType")
-                port_codes = hit.get("portCodes")
-                port_names = hit.get("portNames")
-                country_names = hit.get("countryNames", {}).get("en")
-                departure_timestamp = hit.get("departureTimestamp")
-                top_cruise = hit.get("topCruise")
-                day_group = hit.get("dayGroup")
-                features = hit.get("features")
-                cruise_group = hit.get("cruiseGroup")
-                fare_codes = hit.get("fareCodes")
-                countries = hit.get("countries")
-                currency = hit.get("currency")
-                ordering_price = hit.get("orderingPrice")
-                ordering_webfare = hit.get("orderingWebFare")
-                prices = hit.get("prices")
-                promo_codes = hit.get("promoCodes")
-
-                data.append({
-                        "destination_name": destination_name,
-                        "is_visible": visible,
-                        "ship_code": cruise_code[:2],
-                        "ship_id": ship_id,
-                        "ship_name": ship_name,
-                        "special_type": special_type,
-                        "sail_code": cruise_code,
-                        "cruise_id": cruise_id,
-                        "available": available,
-                        "days": days,
-                        "departure_year_month": departure_year_month,
-                        "departure_port": departure_port,
-                        "arrival_port": arrival_port,
-                        "cruise_type": cruise_type,
-                        "combo_type": combo_type,
-                        "port_codes": port_codes,
-                        "port_names": port_names,
-                        "country_names": country_names,
-                        "departure_timestamp": departure_timestamp,
-                        "top_cruise": top_cruise,
-                        "day_group": day_group,
-                        "features": features,
-                        "cruise_group": cruise_group,
-                        "fare_codes": fare_codes,
-                        "countries": countries,
-                        "currency": currency,
-                        "ordering_price": ordering_price,
-                        "ordering_webfare": ordering_webfare,
-                        "prices": prices,
-                        "promo_codes": promo_codes,
-                        "extract_date": str(extract_date),
-                })
-
-    return pd.DataFrame(data)
+                columns["destination_name"].append(hit.get("destinationName", {}).get("en"))
+                columns["is_visible"].append(hit.get("visible"))
+                columns["ship_code"].append(cruise_code[:2])
+                columns["ship_id"].append(content.get("shipId"))
+                columns["ship_name"].append(content.get("shipName"))
+                columns["special_type"].append(hit.get("specialType"))
+                columns["sail_code"].append(cruise_code)
+                columns["cruise_id"].append(hit.get("cruiseId"))
+                columns["available"].append(hit.get("available"))
+                columns["days"].append(hit.get("days"))
+                columns["departure_year_month"].append(hit.get("departureYearMonth"))
+                columns["departure_port"].append(hit.get("departurePort", {}).get("city", {}).get("en"))
+                columns["arrival_port"].append(hit.get("arrivalPort", {}).get("city", {}).get("en"))
+                columns["cruise_type"].append(hit.get("cruiseType"))
+                columns["combo_type"].append(hit.get("comboType"))
+                columns["port_codes"].append(hit.get("portCodes"))
+                columns["port_names"].append(hit.get("portNames"))
+                columns["country_names"].append(hit.get("countryNames", {}).get("en"))
+                columns["departure_timestamp"].append(hit.get("departureTimestamp"))
+                columns["top_cruise"].append(hit.get("topCruise"))
+                columns["day_group"].append(hit.get("dayGroup"))
+                columns["features"].append(hit.get("features"))
+                columns["cruise_group"].append(hit.get("cruiseGroup"))
+                columns["fare_codes"].append(hit.get("fareCodes"))
+                columns["countries"].append(hit.get("countries"))
+                columns["currency"].append(hit.get("currency"))
+                columns["ordering_price"].append(hit.get("orderingPrice"))
+                columns["ordering_webfare"].append(hit.get("orderingWebFare"))
+                columns["prices"].append(hit.get("prices"))
+                columns["promo_codes"].append(hit.get("promoCodes"))
+                columns["extract_date"].append(extract_date)
+
+    return columns.to_table()
 
 @asset(
     compute_kind="python",
@@ -91,70 +68,112 @@ def process_sail_code_json_data(json_data, extract_date):
 def sail_codes(context, storage_account_io_manager: StorageAccountIoManager):
     partition_date = datetime.strptime(context.partition_key, "%Y-%m-%d")
     partition_date_str = partition_date.strftime("%Y/%m/%d")
-    json_data = storage_account_io_manager.download_blobs_from_path(context, f'silversea/{partition_date_str}/algolia')
-
-    data = process_sail_code_json_data(json_data, partition_date_str)
-
-    df = pd.DataFrame(data)
-    return df
-
-def process_left_json_data(json_data, extract_date):
-    left_data = []
-
-    for message in json_data['data']['prices']:
-        if "_tag" in message:
-            if message["_tag"] == "Left":
+    json_data = storage_account_io_manager.iter_blobs_from_path(context, f'silversea/{partition_date_str}/algolia')
+
+    table = process_sail_code_json_data(json_data, partition_date_str)
+    context.add_output_metadata({**storage_account_io_manager.cache_metadata(), **storage_account_io_manager.metrics_metadata()})
+    return table
+
+LEFT_SCHEMA = arrow_schema(UnavailableCabin)
+RIGHT_SCHEMA = arrow_schema(AvailableCabin)
+
+class PricesParser:
+    """Flattens prices-v2 messages into the Left (unavailable) and Right (available) tables.
+
+    Each message is walked once and its rows are appended straight into the ColumnBuffers of
+    UnavailableCabin and AvailableCabin, so the two tables are only built in `frames`/`tables`.
+    """
+
+    def __init__(self, extract_date):
+        self.extract_date = str(extract_date)
+        self.left = ColumnBuffers(UnavailableCabin)
+        self.right = ColumnBuffers(AvailableCabin)
+        self.messages = 0
+
+    def add(self, json_data):
+        self.messages += 1
+        left = self.left
+        right = self.right
+        for message in json_data['data']['prices']:
+            tag = message.get("_tag")
+            if tag == "Left":
                 left_request = message['left']['request']
-                left_data.append({
-                    "sail_code": str(left_request.get("cruiseCode", None)), 
-                    "ship_code": str(left_request.get("cruiseCode", None))[:2],
-                    "cabin_category": str(left_request.get("suiteCategory", None)),
-                    "adults": int(left_request['occupancy'].get("adults", None)),
-                    "kids": int(left_request['occupancy'].get("kids", None)),
-                    "fare_code": str(left_request.get("fareCode", None)),
-                    "air_type": str(left_request['air'].get("type", None)),
-                    "extract_date": str(extract_date),
-                })
-
-    left_df = pd.DataFrame(left_data)
-
-    return left_df
-
-def process_right_json_data(json_data, extract_date):
-    right_data = []
-
-    for message in json_data['data']['prices']:
-        if "_tag" in message:
-            if message["_tag"] == "Right":
-                right = message['right']
-                right_data.append({
-                    "sail_code": str(right.get("cruiseCode", None)),
-                    "ship_code": str(right.get("cruiseCode", None))[:2],
-                    "cabin_category": str(right.get("suiteCategory", None)),
-                    "adults": int(right['occupancy'].get("adults", None)),
-                    "kids": int(right['occupancy'].get("kids", None)),
-                    "fare_code": str(right.get("fareCode", None)),
-                    "air_type": str(right['air'].get("type", None)),
-                    "suite_payment_type": str(right['suitePayment'].get("type", None)),
-                    "suite_payment_percentage": int(right['suitePayment'].get("percentage", None)),
-                    "suite_payment_amount_value": float(right['suitePayment']['amount'].get("value", None)),
-                    "suite_payment_amount_currency": str(right['suitePayment']['amount'].get("currency", None)),
-                    "balance_amount_value": float(right['suitePayment']['balanceAmount'].get("value", None)),
-                    "balance_amount_currency": str(right['suitePayment']['balanceAmount'].get("currency", None)),
-                    "total_amount_value": float(right['suitePayment']['totalAmount'].get("value", None)),
-                    "total_amount_currency": str(right['suitePayment']['totalAmount'].get("currency", None)),
-                    "final_duedate": str(right['suitePayment'].get("finalDueDate", None)),
-                    "inclusions": [str(x.get("inclusionCode", None)) for x in right['price'].get("inclusions", [])],
-                    "guest_seqn": [int(x.get("number", None)) for x in right['price'].get("paxPrices", [])],
-                    "pax_prices_totalvalue": [float(x['total'].get("value", None)) for x in right['price'].get("paxPrices", [])],
-                    "pax_prices_totalcurrency": [str(x['total'].get("currency", None)) for x in right['price'].get("paxPrices", [])],
-                    "price_total_value": float(right['price']['total'].get("value", None)),
-                    "price_total_currency": str(right['price']['total'].get("currency", None)),
-                    "extract_date": str(extract_date),
-                })
-
-    right_df = pd.DataFrame(right_data)
-    return right_df
+                sail_code = str(left_request.get("cruiseCode", None))
+                left["sail_code"].append(sail_code)
+                left["ship_code"].append(sail_code[:2])
+                left["cabin_category"].append(str(left_request.get("suiteCategory", None)))
+                left["adults"].append(int(left_request['occupancy'].get("adults", None)))
+                left["kids"].append(int(left_request['occupancy'].get("kids", None)))
+                left["fare_code"].append(str(left_request.get("fareCode", None)))
+                left["air_type"].append(str(left_request['air'].get("type", None)))
+                left["extract_date"].append(self.extract_date)
+            elif tag == "Right":
+                quote = message['right']
+                suite_payment = quote['suitePayment']
+                price = quote['price']
+                pax_prices = price.get("paxPrices", [])
+                sail_code = str(quote.get("cruiseCode", None))
+                right["sail_code"].append(sail_code)
+                right["ship_code"].append(sail_code[:2])
+                right["cabin_category"].append(str(quote.get("suiteCategory", None)))
+                right["adults"].append(int(quote['occupancy'].get("adults", None)))
+                right["kids"].append(int(quote['occupancy'].get("kids", None)))
+                right["fare_code"].append(str(quote.get("fareCode", None)))
+                right["air_type"].append(str(quote['air'].get("type", None)))
+                right["suite_payment_type"].append(str(suite_payment.get("type", None)))
+                right["suite_payment_percentage"].append(int(suite_payment.get("percentage", None)))
+                right["suite_payment_amount_value"].append(float(suite_payment['amount'].get("value", None)))
+                right["suite_payment_amount_currency"].append(str(suite_payment['amount'].get("currency", None)))
+                right["balance_amount_value"].append(float(suite_payment['balanceAmount'].get("value", None)))
+                right["balance_amount_currency"].append(str(suite_payment['balanceAmount'].get("currency", None)))
+                right["total_amount_value"].append(float(suite_payment['totalAmount'].get("value", None)))
+                right["total_amount_currency"].append(str(suite_payment['totalAmount'].get("currency", None)))
+                right["final_duedate"].append(str(suite_payment.get("finalDueDate", None)))
+                right["inclusions"].append([str(x.get("inclusionCode", None)) for x in price.get("inclusions", [])])
+                right["guest_seqn"].append([int(x.get("number", None)) for x in pax_prices])
+                right["pax_prices_totalvalue"].append([float(x['total'].get("value", None)) for x in pax_prices])
+                right["pax_prices_totalcurrency"].append([str(x['total'].get("currency", None)) for x in pax_prices])
+                right["price_total_value"].append(float(price['total'].get("value", None)))
+                right["price_total_currency"].append(str(price['total'].get("currency", None)))
+                right["extract_date"].append(self.extract_date)
+
+    @property
+    def buffered_rows(self):
+        return self.left.num_rows + self.right.num_rows
+
+    def frames(self):
+        return self.left.to_frame(), self.right.to_frame()
+
+    def tables(self):
+        return self.left.to_table(), self.right.to_table()
+
+    def flush(self):
+        """Returns the buffered rows as (left, right) record batches and starts with empty buffers."""
+        batches = self.left.to_batch(), self.right.to_batch()
+        self.left = ColumnBuffers(UnavailableCabin)
+        self.right = ColumnBuffers(AvailableCabin)
+        return batches
+
+def stream_prices(parser, json_data, batch_size, unavailable_sink):
+    """Yields the available cabins in batches of about `batch_size` rows.
+
+    The unavailable cabins parsed alongside them are written to `unavailable_sink` as they are
+    flushed, so only one batch is ever held in memory.
+    """
+    for line in json_data:
+        parser.add(line)
+        if parser.buffered_rows >= batch_size:
+            left, right = parser.flush()
+            unavailable_sink.write_batch(left)
+            yield right
+    left, right = parser.flush()
+    unavailable_sink.write_batch(left)
+    yield right
+
+class CabinPricesConfig(Config):
+    # Stream the partition into DuckDB in record batches instead of building both DataFrames in memory
+    chunked: bool = False
+    batch_size: int = 50_000
 
 @multi_asset(
     compute_kind="python",
@@ -165,31 +184,56 @@ def process_right_json_data(json_data, extract_date):
         "available_cabins": AssetOut(metadata={"partition_expr": "extract_date"}),
     }
 )
-def silversea_cabin_prices(context, storage_account_io_manager: StorageAccountIoManager):
+def silversea_cabin_prices(context, config: CabinPricesConfig, storage_account_io_manager: StorageAccountIoManager):
     partition_date = datetime.strptime(context.partition_key, "%Y-%m-%d")
     partition_date_str = partition_date.strftime("%Y/%m/%d")
 
-    # Download combined JSON data from the specified path
-    json_data = storage_account_io_manager.download_blobs_from_path(context=context, path=f'silversea/{partition_date_str}/socket', target_action='prices-v2')
-    df_left_list = []  # List to store left data frames
-    df_right_list = []  # List to store right data frames
-
-    if json_data:
-        # Normalize the JSON data to flatten it into a table
-        for line in json_data:
-            context.log.info(f"Trying to normalize {line}")
-            df_left = process_left_json_data(line, partition_date_str)
-            df_right = process_right_json_data(line, partition_date_str)
-            
-            # Append data frames to respective lists
-            df_left_list.append(df_left)
-            df_right_list.append(df_right)
-
-    else:
+    # Stream the JSON records from the specified path, blobs are parsed while the rest download
+    json_data = storage_account_io_manager.iter_blobs_from_path(context=context, path=f'silversea/{partition_date_str}/socket', filters={'action': 'prices-v2'})
+
+    # Normalize the JSON data to flatten it into a table
+    parser = PricesParser(partition_date_str)
+    started = time.perf_counter()
+
+    if config.chunked:
+        # The available cabins are inserted while they are parsed, the unavailable ones wait in an
+        # Arrow stream on disk until the first output is stored
+        with tempfile.TemporaryDirectory() as directory:
+            spill_path = os.path.join(directory, "unavailable_cabins.arrows")
+            with pa.OSFile(spill_path, "wb") as sink, pa.ipc.new_stream(sink, LEFT_SCHEMA) as unavailable_sink:
+                available = pa.RecordBatchReader.from_batches(RIGHT_SCHEMA, stream_prices(parser, json_data, config.batch_size, unavailable_sink))
+                yield Output(available, output_name="available_cabins")
+
+            if not parser.messages:
+                context.log.error("Failed to download and combine JSON data.")
+            context.log.info(f"Streamed {parser.messages} messages in batches of {config.batch_size} rows")
+            context.add_output_metadata(
+                {"messages": parser.messages, "peak_memory_mb": peak_memory_mb(), **storage_account_io_manager.cache_metadata(), **storage_account_io_manager.metrics_metadata()},
+                output_name="unavailable_cabins",
+            )
+            with pa.memory_map(spill_path) as source:
+                yield Output(pa.ipc.open_stream(source), output_name="unavailable_cabins")
+        return
+
+    for line in json_data:
+        parser.add(line)
+
+    if not parser.messages:
         context.log.error("Failed to download and combine JSON data.")
 
-    # Concatenate all data frames in the list into one big data frame
-    df_left = pd.concat(df_left_list, ignore_index=True)
-    df_right = pd.concat(df_right_list, ignore_index=True)
-
-    return df_left, df_right
\ No newline at end of file
+    # Arrow tables keep the schemas' column types, so every partition lands with the same types
+    unavailable, available = parser.tables()
+    elapsed = time.perf_counter() - started
+    context.log.info(f"Normalized {parser.messages} messages into {unavailable.num_rows} unavailable and {available.num_rows} available cabins")
+
+    metadata = {
+        "messages": parser.messages,
+        "rows_per_second": round((unavailable.num_rows + available.num_rows) / elapsed, 1) if elapsed else 0.0,
+        "peak_memory_mb": peak_memory_mb(),
+        **storage_account_io_manager.cache_metadata(),
+        **storage_account_io_manager.metrics_metadata(),
+    }
+    for output_name in ["unavailable_cabins", "available_cabins"]:
+        context.add_output_metadata(metadata, output_name=output_name)
+    yield Output(unavailable, output_name="unavailable_cabins")
+    yield Output(available, output_name="available_cabins")
@@ -0,0 +1,86 @@
+import tempfile
+from datetime import datetime
+from typing import Dict, Optional
+
+from dagster import asset
+from dagster_duckdb import DuckDBResource
+
+from ...resources import StorageAccountIoManager
+from .silversea import daily_partition
+
+# These assets land the raw JSON in DuckDB and leave the flattening to the stg_* dbt models,
+# which use DuckDB's multi-threaded JSON reader instead of walking every message in Python.
+
+
+def load_landed_json(
+    context,
+    duckdb: DuckDBResource,
+    storage_account_io_manager: StorageAccountIoManager,
+    path: str,
+    table: str,
+    extract_date: str,
+    filters: Optional[Dict[str, str]] = None,
+) -> int:
+    """Replaces the `extract_date` partition of public.<table> with one JSON row per landed record."""
+    with tempfile.TemporaryDirectory() as directory:
+        files = storage_account_io_manager.download_blobs_to_directory(context, path, directory, filters)
+
+        with duckdb.get_connection() as conn:
+            conn.execute("create schema if not exists public")
+            conn.execute(f"create table if not exists public.{table} (extract_date varchar, payload json)")
+            conn.execute(f"delete from public.{table} where extract_date = ?", [extract_date])
+            if files:
+                conn.execute(
+                    f"""
+                    insert into public.{table}
+                    select ?, json
+                    from read_json_objects(?, format = 'newline_delimited', compression = 'auto_detect')
+                    """,
+                    [extract_date, files],
+                )
+            rows = conn.execute(f"select count(*) from public.{table} where extract_date = ?", [extract_date]).fetchone()[0]
+
+    if not rows:
+        context.log.error(f"No records were landed in {path}")
+    context.add_output_metadata({"num_rows": rows, "num_files": len(files)})
+    return rows
+
+
+@asset(
+    key_prefix=["duckdb", "public"],
+    compute_kind="duckdb",
+    description="Raw Algolia result pages loaded into DuckDB, flattened by the stg_sail_codes model",
+    tags={"source": "aloglia"},
+    partitions_def=daily_partition,
+)
+def raw_algolia_results(context, duckdb: DuckDBResource, storage_account_io_manager: StorageAccountIoManager) -> None:
+    partition_date = datetime.strptime(context.partition_key, "%Y-%m-%d")
+    partition_date_str = partition_date.strftime("%Y/%m/%d")
+    load_landed_json(
+        context,
+        duckdb,
+        storage_account_io_manager,
+        path=f"silversea/{partition_date_str}/algolia",
+        table="raw_algolia_results",
+        extract_date=partition_date_str,
+    )
+
+
+@asset(
+    key_prefix=["duckdb", "public"],
+    compute_kind="duckdb",
+    description="Raw prices-v2 socket messages loaded into DuckDB, flattened by the stg_*_cabins models",
+    partitions_def=daily_partition,
+)
+def raw_socket_prices(context, duckdb: DuckDBResource, storage_account_io_manager: StorageAccountIoManager) -> None:
+    partition_date = datetime.strptime(context.partition_key, "%Y-%m-%d")
+    partition_date_str = partition_date.strftime("%Y/%m/%d")
+    load_landed_json(
+        context,
+        duckdb,
+        storage_account_io_manager,
+        path=f"silversea/{partition_date_str}/socket",
+        table="raw_socket_prices",
+        extract_date=partition_date_str,
+        filters={"action": "prices-v2"},
+    )
@@ -1,5 +1,6 @@
 from .algolia_api import AlgoliaAPI
+from .duckdb_arrow_io_manager import DuckDBArrowIOManager, LazyDuckDBTable
 from .silversea_websocket_client import SilverSeaWebSocketClient
 from .storage_account_io_manager import StorageAccountIoManager
 
-__all__ = ["AlgoliaAPI", "SilverSeaWebSocketClient", "StorageAccountIoManager"]
\ No newline at end of file
+__all__ = ["AlgoliaAPI", "DuckDBArrowIOManager", "LazyDuckDBTable", "SilverSeaWebSocketClient", "StorageAccountIoManager"]
\ No newline at end of file
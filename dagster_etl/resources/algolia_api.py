@@ -1,20 +1,70 @@
-import http.client
+import time
 from dagster import ConfigurableResource,InitResourceContext, InitResourceContext
 from pydantic import PrivateAttr
+import urllib3
+from urllib3.util import Retry, make_headers
+from ..utils import fastjson
+from ..utils.metrics import RequestMetrics
+from ..utils.rate_limiter import AdaptiveRateLimiter, ERROR, OK, THROTTLED
 
 
+class AlgoliaError(Exception):
+    pass
+
+
+class AlgoliaResponse:
+    """The parts of http.client.HTTPResponse our callers use, with the body already decompressed."""
+
+    def __init__(self, status: int, reason: str, headers, body: bytes):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self._body = body
+
+    def read(self) -> bytes:
+        return self._body
+
 
 class AlgoliaAPI(ConfigurableResource):
     algolia_url: str
     algolia_api_key: str
     algolia_application_id: str
+    # Requests per second to start from, the limiter speeds up while Algolia stays healthy
+    initial_rate: float = 4.0
+    max_rate: float = 20.0
+    # Keep-alive connections kept open to Algolia, also the most requests in flight at once
+    max_connections: int = 8
+    # Requests in flight to start from, the same as AlgoliaConfig.max_parallel_requests so its
+    # parallel page batches aren't serialized until the limiter has warmed up
+    initial_concurrency: int = 4
+    timeout: float = 30.0
+    metrics_log_interval: float = 30.0
     _headers_list: dict[str, str] = PrivateAttr()
-    _client: http.client.HTTPSConnection = PrivateAttr()
+    _client: urllib3.HTTPConnectionPool = PrivateAttr()
+    _limiter: AdaptiveRateLimiter = PrivateAttr()
+    _metrics: RequestMetrics = PrivateAttr()
 
     def setup_for_execution(self, context: InitResourceContext) -> None:
-        self._client = http.client.HTTPSConnection(self.algolia_url)
+        # Dropped keep-alive connections are reopened and the request retried by the pool
+        url = self.algolia_url if "://" in self.algolia_url else f"https://{self.algolia_url}"
+        self._client = urllib3.connection_from_url(
+            url,
+            maxsize=self.max_connections,
+            block=True,
+            timeout=self.timeout,
+            retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=None, raise_on_status=False),
+        )
+        self._limiter = AdaptiveRateLimiter(
+            rate=self.initial_rate,
+            max_rate=self.max_rate,
+            concurrency=min(self.initial_concurrency, self.max_connections),
+            max_concurrency=self.max_connections,
+        )
+        self._metrics = RequestMetrics("algolia", log_interval=self.metrics_log_interval)
         self._headers_list = {
             "Accept": "*/*",
+            # gzip and deflate, plus br when brotli is installed
+            **make_headers(accept_encoding=True),
             "User-Agent": "Thunder Client (https://www.thunderclient.com)",
             "X-Algolia-API-Key": f"{self.algolia_api_key}",
             "X-Algolia-Application-Id": f"{self.algolia_application_id}",
@@ -22,6 +72,49 @@ class AlgoliaAPI(ConfigurableResource):
             "Referer": "https://www.silversea.com/" 
             }
 
-    def request(self, action, url, payload):
-        self._client.request(action, url, payload, self._headers_list)
-        return self._client.getresponse()
+    def teardown_after_execution(self, context: InitResourceContext) -> None:
+        context.log.info(self._metrics.summary())
+        self._client.close()
+
+    def request(self, action, url, payload) -> AlgoliaResponse:
+        self._limiter.acquire()
+        self._metrics.observe_queue_depth(self._limiter.in_flight)
+        start = time.monotonic()
+        outcome = ERROR
+        response_type = "error"
+        body = b""
+        try:
+            response = self._client.request(action, url, body=payload, headers=self._headers_list, decode_content=True)
+            body = response.data
+            if response.status == 429:
+                outcome = THROTTLED
+            elif response.status < 500:
+                outcome = OK
+            response_type = "ok" if response.status == 200 else f"http_{response.status}"
+            return AlgoliaResponse(response.status, response.reason, response.headers, body)
+        except Exception as e:
+            response_type = type(e).__name__
+            raise
+        finally:
+            latency = time.monotonic() - start
+            self._limiter.release(latency, outcome)
+            self._metrics.record(latency, response_type, len(payload or b""), len(body))
+
+    def query(self, payload: str) -> dict:
+        """Posts a multi-query and returns the decoded body."""
+        try:
+            response = self.request("POST", "/1/indexes/*/queries", payload)
+        except urllib3.exceptions.HTTPError as e:
+            raise AlgoliaError(str(e)) from e
+        if response.status != 200:
+            raise AlgoliaError(f"{response.status} - {response.reason}")
+        return fastjson.loads(response.read())
+
+    def throttle_metadata(self) -> dict:
+        return self._limiter.metadata("algolia")
+
+    def metrics_metadata(self) -> dict:
+        return self._metrics.metadata()
+
+    def log_metrics(self, log) -> None:
+        self._metrics.maybe_log(log)
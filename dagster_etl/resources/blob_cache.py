@@ -0,0 +1,132 @@
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+from typing import Callable, Iterable, Iterator, Optional
+
+
+class BlobCache:
+    """On-disk cache of blobs, each file named by a hash of the blob name and its ETag.
+
+    Each blob name has a small `.ref` file pointing at the ETag that is cached for it, so a
+    reader can revalidate with a conditional request before reusing the data. Files are
+    evicted least recently used first once the cache grows past `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, use_mmap: bool = False, chunk_size: int = 4 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.use_mmap = use_mmap
+        self.chunk_size = chunk_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith(".blob"))
+
+    def _key(self, *parts: str) -> str:
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def _data_path(self, blob_name: str, etag: str) -> str:
+        return os.path.join(self.directory, f"{self._key(blob_name, etag)}.blob")
+
+    def _ref_path(self, blob_name: str) -> str:
+        return os.path.join(self.directory, f"{self._key(blob_name)}.ref")
+
+    def cached_etag(self, blob_name: str) -> Optional[str]:
+        """The ETag of the cached copy of `blob_name`, if its data is still on disk."""
+        try:
+            with open(self._ref_path(blob_name), "r") as ref:
+                etag = ref.read()
+        except FileNotFoundError:
+            return None
+        return etag if os.path.exists(self._data_path(blob_name, etag)) else None
+
+    def read_chunks(self, blob_name: str, etag: str) -> Iterator[bytes]:
+        path = self._data_path(blob_name, etag)
+        # Mark as recently used for eviction
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+        with open(path, "rb") as file:
+            if self.use_mmap and os.path.getsize(path) > 0:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for offset in range(0, len(mapped), self.chunk_size):
+                        yield mapped[offset:offset + self.chunk_size]
+                return
+            while chunk := file.read(self.chunk_size):
+                yield chunk
+
+    def write_through(self, blob_name: str, etag: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Yields `chunks` while copying them into the cache, the entry is only kept if all of them arrive."""
+        with self._lock:
+            self.misses += 1
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        size = 0
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            with self._lock:
+                self._size += size - self._replace(blob_name, etag, temp_path)
+                if self._size > self.max_bytes:
+                    self._evict()
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _replace(self, blob_name: str, etag: str, temp_path: str) -> int:
+        """Moves a downloaded file into place, returning the size of the cached data it replaces.
+
+        That is a copy of the same ETag written by a concurrent reader, and the data of the
+        previous ETag, which is removed right away instead of waiting for eviction.
+        """
+        path = self._data_path(blob_name, etag)
+        replaced = _file_size(path)
+        previous_etag = self.cached_etag(blob_name)
+        if previous_etag is not None and previous_etag != etag:
+            previous_path = self._data_path(blob_name, previous_etag)
+            replaced += _file_size(previous_path)
+            os.remove(previous_path)
+        os.replace(temp_path, path)
+        with open(self._ref_path(blob_name), "w") as ref:
+            ref.write(etag)
+        return replaced
+
+    def get_or_fetch(self, blob_name: str, fetch: Callable[[Optional[str]], Optional[tuple]]) -> Iterator[bytes]:
+        """Yields the chunks of `blob_name`.
+
+        `fetch(cached_etag)` must return None when the cached ETag is still current, or an
+        `(etag, chunks)` tuple with the fresh content otherwise.
+        """
+        etag = self.cached_etag(blob_name)
+        fetched = fetch(etag)
+        if fetched is None:
+            return self.read_chunks(blob_name, etag)
+        fresh_etag, chunks = fetched
+        return self.write_through(blob_name, fresh_etag, chunks)
+
+    def _evict(self) -> None:
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.name.endswith(".blob")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in entries:
+            if self._size <= self.max_bytes:
+                return
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
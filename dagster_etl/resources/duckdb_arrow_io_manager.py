@@ -0,0 +1,161 @@
+import time
+from typing import Iterator, Optional, Sequence, Type
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+from dagster import InputContext, MetadataValue, OutputContext, TableColumn, TableSchema
+from dagster._core.storage.db_io_manager import DbTypeHandler, TableSlice
+from dagster_duckdb.io_manager import DuckDbClient, DuckDBIOManager
+from dagster_duckdb_pandas import DuckDBPandasTypeHandler
+
+from ..utils.profiling import peak_memory_mb
+
+
+class LazyDuckDBTable:
+    """A table slice that is only read from DuckDB when asked for.
+
+    Each read opens its own connection and closes it before returning, `iter_batches` reads the
+    slice as Arrow first and then hands it out in record batches. An open connection would stop
+    writers in the same process from connecting, see `_connect`.
+    """
+
+    def __init__(self, database: str, query: str):
+        self.database = database
+        self.query = query
+
+    def _connect(self, max_retries: int = 10) -> duckdb.DuckDBPyConnection:
+        # Only reads, so runs of other partitions reading the same table don't lock each other out.
+        # A writer may still hold the database for a moment, retry with backoff like DuckDbClient does
+        delay = 0.1
+        for attempt in range(max_retries + 1):
+            try:
+                return duckdb.connect(database=self.database, read_only=True)
+            except duckdb.ConnectionException:
+                # This process already has it open for writing, DuckDB only shares one configuration per file
+                return duckdb.connect(database=self.database, read_only=False)
+            except (RuntimeError, duckdb.IOException):
+                if attempt == max_retries:
+                    raise
+                time.sleep(delay)
+                delay *= 2
+
+    def count(self) -> int:
+        with self._connect() as conn:
+            return conn.execute(f"select count(*) from ({self.query})").fetchone()[0]
+
+    def to_arrow(self) -> pa.Table:
+        with self._connect() as conn:
+            return conn.execute(self.query).to_arrow_table()
+
+    def to_pandas(self) -> pd.DataFrame:
+        return self.to_arrow().to_pandas()
+
+    def iter_batches(self, batch_size: int = 100_000) -> Iterator[pa.RecordBatch]:
+        # Read before the first batch is handed out, so the connection is closed however long the caller takes
+        return iter(self.to_arrow().to_batches(max_chunksize=batch_size))
+
+    def iter_rows(self, batch_size: int = 100_000) -> Iterator[dict]:
+        for batch in self.iter_batches(batch_size):
+            yield from batch.to_pylist()
+
+
+def _table_schema(schema: pa.Schema) -> TableSchema:
+    return TableSchema(columns=[TableColumn(name=field.name, type=str(field.type)) for field in schema])
+
+
+def _add_missing_columns(connection, table_slice: TableSlice) -> None:
+    """Adds columns that are new in the output to an existing table, so the insert by name still works."""
+    existing = {
+        name
+        for (name,) in connection.execute(
+            "select column_name from information_schema.columns where table_schema = ? and table_name = ?",
+            [table_slice.schema, table_slice.table],
+        ).fetchall()
+    }
+    for name, column_type, *_ in connection.execute("describe select * from arrow_schema").fetchall():
+        if name not in existing:
+            connection.execute(f'alter table {table_slice.schema}.{table_slice.table} add column "{name}" {column_type}')
+
+
+class DuckDBArrowTypeHandler(DbTypeHandler[pa.Table]):
+    """Stores Arrow tables and record batch readers in DuckDB and loads tables back as Arrow.
+
+    Record batch readers are streamed into the table batch by batch, so the whole output never
+    has to be in memory at once.
+    """
+
+    def handle_output(self, context: OutputContext, table_slice: TableSlice, obj, connection):
+        table_name = f"{table_slice.schema}.{table_slice.table}"
+        schema = obj.schema
+        # A reader can only be scanned once, so the table is created from its schema alone
+        connection.register("arrow_schema", schema.empty_table())
+        connection.register("arrow_obj", obj)
+        try:
+            connection.execute(f"create table if not exists {table_name} as select * from arrow_schema")
+            _add_missing_columns(connection, table_slice)
+            before = connection.execute(f"select count(*) from {table_name}").fetchone()[0]
+            started = time.perf_counter()
+            connection.execute(f"insert into {table_name} by name select * from arrow_obj")
+            elapsed = time.perf_counter() - started
+            row_count = connection.execute(f"select count(*) from {table_name}").fetchone()[0] - before
+        finally:
+            connection.unregister("arrow_obj")
+            connection.unregister("arrow_schema")
+
+        metadata = {
+            "row_count": row_count,
+            "dataframe_columns": MetadataValue.table_schema(_table_schema(schema)),
+        }
+        if isinstance(obj, pa.RecordBatchReader):
+            # The reader is produced while it is inserted, so this times the whole upstream stream
+            metadata["rows_per_second"] = round(row_count / elapsed, 1) if elapsed else 0.0
+            metadata["peak_memory_mb"] = peak_memory_mb()
+        context.add_output_metadata(metadata)
+
+    def load_input(self, context: InputContext, table_slice: TableSlice, connection) -> pa.Table:
+        if table_slice.partition_dimensions and len(context.asset_partition_keys) == 0:
+            return pa.table({})
+        return connection.execute(DuckDbClient.get_select_statement(table_slice)).to_arrow_table()
+
+    @property
+    def supported_types(self):
+        return [pa.Table, pa.RecordBatchReader, pa.ipc.RecordBatchStreamReader]
+
+
+class DuckDBLazyTableTypeHandler(DbTypeHandler[LazyDuckDBTable]):
+    """Loads inputs annotated as LazyDuckDBTable without reading any rows."""
+
+    def handle_output(self, context: OutputContext, table_slice: TableSlice, obj, connection):
+        raise NotImplementedError("LazyDuckDBTable can only be used to load inputs")
+
+    def load_input(self, context: InputContext, table_slice: TableSlice, connection) -> LazyDuckDBTable:
+        database = connection.execute(
+            "select path from duckdb_databases() where database_name = current_database()"
+        ).fetchone()[0]
+        query = DuckDbClient.get_select_statement(table_slice)
+        if table_slice.partition_dimensions and len(context.asset_partition_keys) == 0:
+            query = f"{query} limit 0"
+        return LazyDuckDBTable(database, query)
+
+    @property
+    def supported_types(self):
+        return [LazyDuckDBTable]
+
+
+class DuckDBArrowIOManager(DuckDBIOManager):
+    """DuckDB I/O manager that moves data as Arrow.
+
+    Outputs may be Arrow tables, record batch readers or pandas DataFrames. Inputs are loaded
+    according to their annotation: pa.Table, LazyDuckDBTable for streaming, or pandas for
+    unannotated inputs. Partitioned outputs replace their partition through `partition_expr`
+    like DuckDBPandasIOManager.
+    """
+
+    @staticmethod
+    def type_handlers() -> Sequence[DbTypeHandler]:
+        return [DuckDBArrowTypeHandler(), DuckDBLazyTableTypeHandler(), DuckDBPandasTypeHandler()]
+
+    @staticmethod
+    def default_load_type() -> Optional[Type]:
+        return pd.DataFrame
@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, Optional
+
+
+class ResponseCache:
+    """Request-keyed cache of response futures with a TTL.
+
+    Identical requests made while one is still in flight share its future, so only one goes
+    over the network. Once it resolves the response is kept for `ttl` seconds, or `negative_ttl`
+    for responses `is_negative` says carry no data. Failed requests, and responses `is_error`
+    rejects, are never cached.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        negative_ttl: float,
+        max_entries: int,
+        is_negative: Callable[[Hashable, str], bool],
+        is_error: Optional[Callable[[str], bool]] = None,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.is_negative = is_negative
+        self.is_error = is_error
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        # key -> (future, expires_at), expires_at is None while the request is in flight
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get_or_submit(self, key: Hashable, submit: Callable[[], Future]) -> Future:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                future, expires_at = entry
+                if expires_at is None:
+                    self.coalesced += 1
+                    return future
+                if expires_at > time.monotonic():
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return future
+                del self._entries[key]
+            self.misses += 1
+            future = submit()
+            self._entries[key] = (future, None)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        # Outside the lock, the callback runs right away if the future is already done
+        future.add_done_callback(lambda done: self._resolved(key, done))
+        return future
+
+    def _resolved(self, key: Hashable, future: Future) -> None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not future:
+                return
+            if future.cancelled() or future.exception() is not None or (self.is_error and self.is_error(future.result())):
+                del self._entries[key]
+                return
+            ttl = self.negative_ttl if self.is_negative(key, future.result()) else self.ttl
+            if ttl <= 0:
+                del self._entries[key]
+                return
+            self._entries[key] = (future, time.monotonic() + ttl)
+
+    def metadata(self, prefix: str) -> Dict[str, int]:
+        return {
+            f"{prefix}_cache_hits": self.hits,
+            f"{prefix}_cache_misses": self.misses,
+            f"{prefix}_cache_coalesced": self.coalesced,
+        }
@@ -1,45 +1,144 @@
+import asyncio
+import time
+from concurrent.futures import Future
 from dagster import ConfigurableResource,InitResourceContext
 from pydantic import PrivateAttr
-import websocket
+from ..utils import fastjson
+from ..utils.metrics import RequestMetrics
+from ..utils.rate_limiter import AdaptiveRateLimiter, ERROR, OK, THROTTLED
+from .response_cache import ResponseCache
+from .socket_responses import BAD_REQUEST, is_error_response, is_negative_response, response_outcome
+from .websocket_multiplexer import BackgroundEventLoop, WebSocketPool
 import uuid
-import json
 
 
 class SilverSeaWebSocketClient(ConfigurableResource):
-    
-    # Copy the web brower header and input as a dictionary
-    _headers = json.dumps({
+    url: str = 'wss://api-ws.booking.digital.silversea.com/'
+    # Number of sockets kept open to the booking api
+    pool_size: int = 4
+    # How many requests may be waiting for a reply on each socket at once
+    max_in_flight: int = 50
+    request_timeout: float = 60.0
+    health_check_interval: float = 30.0
+    # How often a request is retried on another socket when its socket drops or its reply times out
+    max_replays: int = 3
+    # Requests per second to start from, the limiter speeds up while the api stays healthy
+    initial_rate: float = 20.0
+    max_rate: float = 500.0
+    # Identical requests are answered from memory for this many seconds
+    cache_ttl: float = 300.0
+    # Replies without data (unknown fare code, no suites) are remembered for longer
+    negative_cache_ttl: float = 3600.0
+    cache_max_entries: int = 100_000
+    # Log every message sent, otherwise only a summary of the requests every metrics_log_interval seconds
+    log_requests: bool = False
+    metrics_log_interval: float = 30.0
+
+    # Copy the web brower header and input as a dictionary.
+    # The handshake headers (Upgrade, Sec-WebSocket-*, ...) are generated by the websocket library.
+    _headers = {
         'Accept-Encoding': 'gzip, deflate, br',
         'Accept-Language': 'en-GB,en-US;q=0.9,en;q=0.8',
         'Cache-Control': 'no-cache',
-        'Connection': 'Upgrade',
-        'Host': 'api-ws.booking.digital.silversea.com',
         'Origin': 'https://quote.silversea.com',
         'Pragma': 'no-cache',
-        'Sec-WebSocket-Extensions': 'permessage-deflate; client_max_window_bits',
-        'Sec-WebSocket-Key': 'in6dCK/XY9j+9rWAeNRDXQ==',
-        'Sec-WebSocket-Version': '13',
-        'Upgrade': 'websocket',
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.132 Safari/537.36'
-    })
+    }
 
-    _url = 'wss://api-ws.booking.digital.silversea.com/'
-    _ws: websocket.WebSocket = PrivateAttr()
+    _loop: BackgroundEventLoop = PrivateAttr()
+    _pool: WebSocketPool = PrivateAttr()
+    _limiter: AdaptiveRateLimiter = PrivateAttr()
+    _cache: ResponseCache = PrivateAttr()
+    _metrics: RequestMetrics = PrivateAttr()
 
     def setup_for_execution(self, context: InitResourceContext) -> None:
-        self._ws = websocket.create_connection(self._url, headers=self._headers)
+        self._loop = BackgroundEventLoop(name="silversea-websocket")
+        self._pool = WebSocketPool(
+            self.url,
+            headers=self._headers,
+            size=self.pool_size,
+            max_in_flight=self.max_in_flight,
+            request_timeout=self.request_timeout,
+            health_check_interval=self.health_check_interval,
+            max_replays=self.max_replays,
+        )
+        self._limiter = AdaptiveRateLimiter(
+            rate=self.initial_rate,
+            max_rate=self.max_rate,
+            concurrency=self.max_in_flight,
+            max_concurrency=self.pool_size * self.max_in_flight,
+            target_latency=self.request_timeout / 10,
+        )
+        self._cache = ResponseCache(
+            ttl=self.cache_ttl,
+            negative_ttl=self.negative_cache_ttl,
+            max_entries=self.cache_max_entries,
+            is_negative=is_negative_response,
+            is_error=is_error_response,
+        )
+        self._metrics = RequestMetrics("websocket", log_interval=self.metrics_log_interval)
+        self._loop.run(self._pool.connect())
 
     def teardown_after_execution(self, context:InitResourceContext) -> None:
-        if self._ws:
-            self._ws.close()
+        if self._loop:
+            context.log.info(self._metrics.summary())
+            context.log.info(f"Closing websocket pool after {self._pool.reconnects} reconnects, {self._pool.timeouts} timeouts and {self._pool.replays} replayed requests")
+            self._loop.run(self._pool.close())
+            self._loop.stop()
+
+    def submit(self, context, action, fare_code, sail_code, adults, kids, currency, cabin_category) -> Future:
+        """Sends a request without waiting for the reply; the returned future resolves to the matching response.
+
+        Identical requests share one reply through the response cache.
+        """
+        def send() -> Future:
+            if self.log_requests:
+                context.log.info(f"sending socket message for {sail_code}, {cabin_category}, {action}-{fare_code}, {adults}, {kids}")
+            message = self.build_message(action=action, fare_code=fare_code, sail_code=sail_code, adults=adults, kids=kids, currency=currency, cabin_category=cabin_category)
+            return self._loop.submit(self._throttled_request(message))
+
+        self._metrics.maybe_log(context.log)
+        key = (action, sail_code, fare_code, adults, kids, currency, cabin_category)
+        return self._cache.get_or_submit(key, send)
+
+    def send_and_receive(self,context, action, fare_code, sail_code, adults, kids, currency, cabin_category) -> bytes:
+        return self.submit(context, action, fare_code, sail_code, adults, kids, currency, cabin_category).result()
+
+    async def _throttled_request(self, message: dict) -> bytes:
+        payload = fastjson.dumps(message)
+        await self._limiter.acquire_async()
+        self._metrics.observe_queue_depth(self._pool.in_flight)
+        start = time.monotonic()
+        outcome = ERROR
+        response_type = "error"
+        received_message = b""
+        try:
+            received_message = await self._pool.request(message, payload)
+            response_type = response_outcome(received_message)
+            outcome = ERROR if response_type == BAD_REQUEST else OK
+            return received_message
+        except asyncio.TimeoutError:
+            outcome = THROTTLED
+            response_type = "timeout"
+            raise
+        except Exception as e:
+            response_type = type(e).__name__
+            raise
+        finally:
+            latency = time.monotonic() - start
+            self._limiter.release(latency, outcome)
+            self._metrics.record(latency, response_type, len(payload), len(received_message))
+
+    def throttle_metadata(self) -> dict:
+        return self._limiter.metadata("websocket")
+
+    def cache_metadata(self) -> dict:
+        return self._cache.metadata("websocket")
 
-    def send_and_receive(self,context, action, fare_code, sail_code, adults, kids, currency, cabin_category) -> str:
-        context.log.info(f"sending socket message for {sail_code}, {cabin_category}, {action}-{fare_code}, {adults}, {kids}")
-        self.send_message(action=action, fare_code=fare_code, sail_code=sail_code, adults=adults, kids=kids, currency=currency, cabin_category=cabin_category)
-        received_message = self.receive_message()   
-        return str(received_message)
+    def metrics_metadata(self) -> dict:
+        return self._metrics.metadata()
 
-    def send_message(self, action, sail_code, adults:int, kids:int, fare_code, cabin_category=None, currency='US'):
+    def build_message(self, action, sail_code, adults:int, kids:int, fare_code, cabin_category=None, currency='US') -> dict:
         string_uuid = str(uuid.uuid4())
         data = {
                 "cruiseCode":f"{sail_code}",
@@ -51,11 +150,7 @@ class SilverSeaWebSocketClient(ConfigurableResource):
                 "availabilities":["standard","guaranteed","partial"],
                 "air":{"type":"notAvailable"}
                 }
-        if self._ws:
-            self._ws.send(json.dumps({"country":f"{currency}", "action":action,
+        return {"country":f"{currency}", "action":action,
             "data":data,
-            "requestId":string_uuid}))
+            "requestId":string_uuid}
 
-    def receive_message(self):
-        if self._ws:
-            return self._ws.recv()
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""Classifies booking api replies without decoding them.
+
+The scraper only needs to know whether a reply carries data, so it looks for the response type
+and an empty suites list in the raw frame and passes the bytes on to the landing blob as they
+are. The full decode happens once, when the blob is staged.
+"""
+import re
+from typing import Optional, Union
+
+from ..utils import fastjson
+
+OK = "ok"
+PRICES_ERROR = "PricesErrorResponseV2"
+BAD_REQUEST = "BadRequestResponse"
+EMPTY_SUITES = "empty_suites"
+# Replies without prices or suites, worth remembering but not worth storing
+NEGATIVE = {PRICES_ERROR, EMPTY_SUITES}
+
+_SUCCESS_TYPES = {"PricesResponseV2", "SuitesResponse"}
+# Nested objects have "type" keys too (air, suitePayment, ...), only response types end in Response
+_RESPONSE_TYPE = re.compile(rb'"type"\s*:\s*"(\w*Response\w*)"')
+# Older replies put the error type elsewhere (e.g. under "$type" or in an error message)
+_ERROR_TOKEN = re.compile(rb"(%s|%s)" % (PRICES_ERROR.encode("ascii"), BAD_REQUEST.encode("ascii")))
+_EMPTY_SUITES = re.compile(rb'"suites"\s*:\s*\[\s*\]')
+_REQUEST_ID = re.compile(rb'"requestId"\s*:\s*"([^"\\]*)"')
+
+
+def _bytes(frame: Union[str, bytes]) -> bytes:
+    return frame.encode("utf-8") if isinstance(frame, str) else frame
+
+
+def response_outcome(received_message: Union[str, bytes]) -> str:
+    """"ok" for replies with data, otherwise what went wrong: the response type or empty_suites."""
+    received_message = _bytes(received_message)
+    match = _RESPONSE_TYPE.search(received_message)
+    response_type = match.group(1).decode("ascii") if match else None
+    if response_type is not None and response_type not in _SUCCESS_TYPES:
+        return response_type
+    if _EMPTY_SUITES.search(received_message):
+        return EMPTY_SUITES
+    if response_type is not None:
+        return OK
+    match = _ERROR_TOKEN.search(received_message)
+    return match.group(1).decode("ascii") if match else "unknown"
+
+
+def is_negative_response(key, received_message: Union[str, bytes]) -> bool:
+    """Replies that carry no prices or suites."""
+    return response_outcome(received_message) in NEGATIVE
+
+
+def is_error_response(received_message: Union[str, bytes]) -> bool:
+    return response_outcome(received_message) == BAD_REQUEST
+
+
+def request_id(frame: Union[str, bytes]) -> Optional[str]:
+    """The requestId of a reply, read from the raw frame when it is a plain string."""
+    match = _REQUEST_ID.search(_bytes(frame))
+    if match:
+        return match.group(1).decode("utf-8")
+    try:
+        return fastjson.loads(frame).get("requestId")
+    except (ValueError, AttributeError, fastjson.JSONDecodeError):
+        return None
@@ -1,41 +1,196 @@
 from azure.storage.blob import BlobServiceClient
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError, ResourceNotModifiedError
 from datetime import datetime
 from dagster import ConfigurableResource, InitResourceContext
 from pydantic import PrivateAttr
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Union
+from ..utils import fastjson
+from ..utils.metrics import RequestMetrics
+from .blob_cache import BlobCache
+import gzip
 import json
+import os
+import posixpath
+import queue
+import threading
+import time
+import zlib
 
 class StorageAccountIoManager(ConfigurableResource):
     account_name : str
     account_key : str
     container_name : str
+    # Local directory to cache downloaded blobs in, caching is off when unset
+    cache_dir : Optional[str] = None
+    cache_max_bytes : int = 10 * 1024 ** 3
+    cache_mmap : bool = False
+    # How new blobs are written: plain "json" NDJSON, or compressed "json.gz" / "json.zst".
+    # Reads pick the codec from the blob name, so older days stay readable.
+    landing_format : str = "json"
+    # Log every blob uploaded or downloaded, otherwise only a summary every metrics_log_interval seconds
+    log_requests : bool = False
+    metrics_log_interval : float = 30.0
 
     _blob_service_client:BlobServiceClient = PrivateAttr()
+    # Prefix -> the manifest segment this process appends to, for the manifests it already created
+    _manifests: Dict[str, int] = PrivateAttr()
+    _manifests_lock: threading.Lock = PrivateAttr()
+    _cache: Optional[BlobCache] = PrivateAttr(default=None)
+    _upload_metrics: RequestMetrics = PrivateAttr()
+    _download_metrics: RequestMetrics = PrivateAttr()
 
     def setup_for_execution(self, context: InitResourceContext) -> None:
+        if self.landing_format not in LANDING_FORMATS:
+            raise ValueError(f"landing_format must be one of {LANDING_FORMATS}, got {self.landing_format}")
         self._blob_service_client = BlobServiceClient(account_url=f"https://{self.account_name}.blob.core.windows.net", credential=self.account_key)
-        
+        self._manifests = {}
+        self._manifests_lock = threading.Lock()
+        self._upload_metrics = RequestMetrics("blob_upload", log_interval=self.metrics_log_interval)
+        self._download_metrics = RequestMetrics("blob_download", log_interval=self.metrics_log_interval)
+        if self.cache_dir:
+            self._cache = BlobCache(self.cache_dir, max_bytes=self.cache_max_bytes, use_mmap=self.cache_mmap)
 
-    def upload_blob(self, context, json_data: str, blob_name: str, competitor: str) -> None:
-        context.log.info(f"Attempting to store {blob_name}")
+    def teardown_after_execution(self, context: InitResourceContext) -> None:
+        for metrics in [self._upload_metrics, self._download_metrics]:
+            if metrics.requests:
+                context.log.info(metrics.summary())
+
+    def upload_blob(self, context, json_data: Union[str, bytes], blob_name: str, competitor: str) -> bool:
+        """Lands `json_data` under today's prefix, returns whether it was stored. Errors are logged, not raised."""
+        if self.log_requests:
+            context.log.info(f"Attempting to store {blob_name}")
+        self._upload_metrics.maybe_log(context.log)
         try:
             # Get a reference to the container
             container_client = self._blob_service_client.get_container_client(self.container_name)
 
             current_date = datetime.now()
             year_month_date = current_date.strftime("%Y/%m/%d")
-            blob_name = f"{competitor}/{year_month_date}/{blob_name}.json"
+            blob_name = f"{competitor}/{year_month_date}/{blob_name}.{self.landing_format}"
 
             # Create a blob client using the container client and blob name
             blob_client = container_client.get_blob_client(blob_name)
 
-            blob_client.upload_blob(json_data, overwrite=True)
+            data = encode_landing(json_data, self.landing_format)
+            # Recorded before the upload too, so a run killed between the upload and the manifest
+            # append still leaves a trace of the blob for the readers to check
+            self._record_in_manifest(context, container_client, blob_name, pending=True)
+            start = time.monotonic()
+            try:
+                blob_client.upload_blob(data, overwrite=True)
+            except Exception as e:
+                self._upload_metrics.record(time.monotonic() - start, type(e).__name__, len(data))
+                raise
+            self._upload_metrics.record(time.monotonic() - start, bytes_sent=len(data))
+
+            if self.log_requests:
+                context.log.info(f"Data uploaded successfully to blob: {blob_name}")
+
+            self._record_in_manifest(context, container_client, blob_name)
+            return True
+
+        except Exception as e:
+            context.log.warning(f"Error uploading data to blob: {blob_name}")
+            context.log.error(e)
+            return False
 
-            context.log.info(f"Data uploaded successfully to blob: {blob_name}")
+    def _record_in_manifest(self, context, container_client, blob_name: str, pending: bool = False) -> None:
+        """Appends partitioned blobs (`.../key=value/...`) to the manifest of their day.
 
+        Every blob gets a `pending` entry before it is uploaded and a plain one once it is stored.
+        An append blob holds at most 50,000 blocks, so the manifest is split into segments and
+        writers move on to the next one when the current one is nearly full.
+        """
+        prefix = partition_prefix(blob_name)
+        if prefix is None:
+            return
+        entry = {"blob": blob_name, **parse_partition_keys(blob_name)}
+        if pending:
+            entry["pending"] = True
+        entry = json.dumps(entry) + "\n"
+        try:
+            segment = self._manifest_segment(container_client, prefix)
+            while True:
+                manifest_client = container_client.get_blob_client(manifest_name(prefix, segment))
+                try:
+                    result = manifest_client.append_block(entry)
+                except HttpResponseError as e:
+                    # Other runs filled the segment before this one noticed
+                    if getattr(e, "error_code", None) != "BlockCountExceedsLimit":
+                        raise
+                    segment = self._next_manifest_segment(container_client, prefix, segment)
+                    continue
+                if (result or {}).get("blob_committed_block_count", 0) >= MANIFEST_ROLLOVER_BLOCKS:
+                    self._next_manifest_segment(container_client, prefix, segment)
+                return
         except Exception as e:
-            context.log.warn(f"Error uploading data to blob: {blob_name}")
+            # Readers fall back to listing the prefix once a manifest is known to be incomplete
+            context.log.warning(f"Error adding {blob_name} to manifest, marking it incomplete")
             context.log.error(e)
+            container_client.get_blob_client(manifest_name(prefix) + ".incomplete").upload_blob(b"", overwrite=True)
+
+    def _manifest_segment(self, container_client, prefix: str) -> int:
+        with self._manifests_lock:
+            if prefix not in self._manifests:
+                _create_manifest(container_client, manifest_name(prefix, 0))
+                self._manifests[prefix] = 0
+            return self._manifests[prefix]
+
+    def _next_manifest_segment(self, container_client, prefix: str, full_segment: int) -> int:
+        with self._manifests_lock:
+            if self._manifests.get(prefix, 0) <= full_segment:
+                _create_manifest(container_client, manifest_name(prefix, full_segment + 1))
+                self._manifests[prefix] = full_segment + 1
+            return self._manifests[prefix]
+
+    def list_blob_names(self, context, path: str, filters: Optional[Dict[str, str]] = None) -> List[str]:
+        """Names of the blobs under `path` whose partition keys match `filters`.
+
+        Reads the day's manifest when there is a complete one, otherwise lists the prefix and
+        parses the partition keys out of each blob name. Blobs the manifest only has a pending
+        entry for, because their run stopped mid-upload, are kept if they exist.
+        """
+        filters = filters or {}
+        container_client = self._blob_service_client.get_container_client(self.container_name)
+        try:
+            if not container_client.get_blob_client(manifest_name(path) + ".incomplete").exists():
+                entries = [json.loads(line) for line in self._read_manifest(container_client, path).splitlines() if line.strip()]
+                context.log.info(f"Using manifest {manifest_name(path)} with {len(entries)} entries")
+                stored = {entry["blob"] for entry in entries if not entry.get("pending")}
+                blob_names = list(dict.fromkeys(entry["blob"] for entry in entries if matches_filters(entry, filters)))
+                unfinished = [name for name in blob_names if name not in stored]
+                if unfinished:
+                    context.log.info(f"Checking {len(unfinished)} blobs whose upload wasn't recorded as finished")
+                    missing = {name for name in unfinished if not container_client.get_blob_client(name).exists()}
+                    blob_names = [name for name in blob_names if name not in missing]
+                return blob_names
+        except ResourceNotFoundError:
+            context.log.info(f"No manifest for {path}, listing blobs instead")
+
+        blob_names = []
+        # The trailing slash keeps socket/ from matching socket_archive/
+        for blob in container_client.list_blobs(name_starts_with=path.rstrip("/") + "/"):
+            if matches_filters(parse_partition_keys(blob.name), filters):
+                blob_names.append(blob.name)
+            else:
+                context.log.info(f"Skipping blob: {blob.name}")
+        return blob_names
+
+    def _read_manifest(self, container_client, path: str) -> bytes:
+        """All segments of the manifest of `path`, raises ResourceNotFoundError when there is none."""
+        segments = [container_client.get_blob_client(manifest_name(path)).download_blob().readall()]
+        while True:
+            try:
+                segments.append(container_client.get_blob_client(manifest_name(path, len(segments))).download_blob().readall())
+            except ResourceNotFoundError:
+                return b"".join(segments)
+
+    def landed_blob_names(self, context, competitor: str, path: str, filters: Optional[Dict[str, str]] = None) -> Set[str]:
+        """Blob names, as passed to `upload_blob`, that have already landed today under `path`."""
+        day = f"{competitor}/{datetime.now().strftime('%Y/%m/%d')}/"
+        return {strip_landing_extension(name[len(day):]) for name in self.list_blob_names(context, day + path, filters)}
 
     def download_blob(self, context, blob_name:str):
         context.log.info(f"Attempting to download {blob_name}")
@@ -47,65 +202,274 @@ class StorageAccountIoManager(ConfigurableResource):
             blob_client = container_client.get_blob_client(blob_name)
 
             # Download the blob data
-            blob_data = blob_client.download_blob().readall()
+            blob_data = b"".join(decode_landing_chunks(blob_name, self._blob_chunks(container_client, blob_name)))
 
             context.log.info(f"Blob downloaded successfully: {blob_name}")
 
             return blob_data.decode("utf-8")
 
         except ResourceNotFoundError as e:
-            context.log.warn(f"Blob not found: {blob_name}")
+            context.log.warning(f"Blob not found: {blob_name}")
             context.log.error(e)
             return None
 
         except Exception as e:
-            context.log.warn(f"Error downloading blob: {blob_name}")
+            context.log.warning(f"Error downloading blob: {blob_name}")
             context.log.error(e)
             return None
 
-    def download_blobs_from_path(self, context, path: str, target_action=None):
-        context.log.info(f"Attempting to download blobs from path: {path}")
+    def _blob_chunks(self, container_client, blob_name: str) -> Iterator[bytes]:
+        """Streams a blob, from the local cache when its ETag is still current."""
+        blob_client = container_client.get_blob_client(blob_name)
+        if self._cache is None:
+            return self._measured_download(lambda: blob_client.download_blob())
+
+        def fetch(cached_etag):
+            if cached_etag is None:
+                return self._measured_download(lambda: blob_client.download_blob(), with_etag=True)
+            try:
+                return self._measured_download(
+                    lambda: blob_client.download_blob(etag=cached_etag, match_condition=MatchConditions.IfModified), with_etag=True
+                )
+            except ResourceNotModifiedError:
+                return None
+
+        return self._cache.get_or_fetch(blob_name, fetch)
+
+    def _measured_download(self, download: Callable, with_etag: bool = False):
+        """Starts a download and streams its chunks, recording its latency and size once it is read to the end."""
+        start = time.monotonic()
         try:
-            # Get a reference to the container
-            container_client = self._blob_service_client.get_container_client(self.container_name)
+            downloader = download()
+        except ResourceNotModifiedError:
+            self._download_metrics.record(time.monotonic() - start, "not_modified")
+            raise
+        except Exception as e:
+            self._download_metrics.record(time.monotonic() - start, type(e).__name__)
+            raise
 
-            # List all blobs with the specified path prefix
-            blobs_list = container_client.list_blobs(name_starts_with=path)
-            downloaded_blobs = []
-            
-            if not blobs_list:
-                context.log.error("No blobs found for this path.")
-                return []
+        def chunks():
+            size, outcome = 0, "ok"
+            try:
+                for chunk in downloader.chunks():
+                    size += len(chunk)
+                    yield chunk
+            except Exception as e:
+                outcome = type(e).__name__
+                raise
+            finally:
+                self._download_metrics.record(time.monotonic() - start, outcome, bytes_received=size)
 
+        return (downloader.properties.etag, chunks()) if with_etag else chunks()
 
-            for blob in blobs_list:
-                blob_name = blob.name
-                if target_action and target_action not in blob_name: # TODO, make this better
-                    context.log.info(f"Skipping blob: {blob_name}")
-                    continue
+    def metrics_metadata(self) -> dict:
+        return {**self._upload_metrics.metadata(), **self._download_metrics.metadata()}
 
-                context.log.info(f"Downloading blob: {blob_name}")
+    def cache_metadata(self) -> dict:
+        if self._cache is None:
+            return {}
+        return {"blob_cache_hits": self._cache.hits, "blob_cache_misses": self._cache.misses}
 
-                # Get a blob client using the blob name
-                blob_client = container_client.get_blob_client(blob_name)
+    def download_blobs_to_directory(self, context, path: str, directory: str, filters: Optional[Dict[str, str]] = None, max_concurrency: int = 8) -> List[str]:
+        """Copies the blobs under `path` matching `filters` into `directory` as they are stored.
 
-                # Download the blob data
-                blob_data = blob_client.download_blob().readall().decode("utf-8")
+        Compressed blobs keep their extension so readers such as DuckDB's read_json can
+        decompress them. Returns the local file paths.
+        """
+        container_client = self._blob_service_client.get_container_client(self.container_name)
+        blob_names = self.list_blob_names(context, path, filters)
+        os.makedirs(directory, exist_ok=True)
 
-                # Split the blob data into individual JSON messages
-                json_messages = blob_data.strip().split('\n')
+        def download(blob_name: str) -> str:
+            file_name = os.path.join(directory, blob_name[len(path):].strip("/").replace("/", "__") or posixpath.basename(blob_name))
+            with open(file_name, "wb") as file:
+                for chunk in self._blob_chunks(container_client, blob_name):
+                    file.write(chunk)
+            return file_name
 
-                # Parse each JSON message and add it to the list
-                for message in json_messages:
-                    try:
-                        downloaded_blobs.append(json.loads(message))
-                    except json.JSONDecodeError as e:
-                        context.log.warn(f"Error decoding JSON message in blob {blob_name}: {e}")
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            file_names = list(executor.map(download, blob_names))
+        context.log.info(f"Downloaded {len(file_names)} blobs from {path} to {directory}")
+        return file_names
 
-            context.log.info(f"Blobs downloaded successfully from path: {path}")
+    def download_blobs_from_path(self, context, path: str, target_action=None, filters: Optional[Dict[str, str]] = None):
+        try:
+            downloaded_blobs = list(self.iter_blobs_from_path(context, path, target_action=target_action, filters=filters))
             return downloaded_blobs
 
         except Exception as e:
-            context.log.warn(f"Error downloading blobs from path: {path}")
+            context.log.warning(f"Error downloading blobs from path: {path}")
             context.log.error(e)
-            return []
\ No newline at end of file
+            return []
+
+    def iter_blobs_from_path(self, context, path: str, target_action=None, filters: Optional[Dict[str, str]] = None, max_concurrency: int = 8) -> Iterator[dict]:
+        """Yields the JSON records of every blob under `path` matching `filters` as they are downloaded.
+
+        Up to `max_concurrency` blobs are downloaded at once and parsed chunk by chunk, so
+        records are available before the last blob has finished and memory stays bounded.
+        """
+        context.log.info(f"Attempting to download blobs from path: {path}")
+        # Get a reference to the container
+        container_client = self._blob_service_client.get_container_client(self.container_name)
+
+        filters = dict(filters or {})
+        if target_action:
+            filters["action"] = target_action
+        blob_names = self.list_blob_names(context, path, filters)
+
+        if not blob_names:
+            context.log.error("No blobs found for this path.")
+            return
+
+        batches: queue.Queue = queue.Queue(maxsize=max_concurrency * 4)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def download(blob_name: str) -> None:
+            if stop.is_set():
+                return
+            try:
+                if self.log_requests:
+                    context.log.info(f"Downloading blob: {blob_name}")
+                self._download_metrics.maybe_log(context.log)
+                chunks = decode_landing_chunks(blob_name, self._blob_chunks(container_client, blob_name))
+                for batch in iter_ndjson_batches(chunks, lambda e: context.log.warning(f"Error decoding JSON message in blob {blob_name}: {e}")):
+                    if not put(batch):
+                        return
+                put(_BLOB_DONE)
+            except Exception as e:
+                put(e)
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            for blob_name in blob_names:
+                executor.submit(download, blob_name)
+            try:
+                remaining = len(blob_names)
+                while remaining:
+                    self._download_metrics.observe_queue_depth(batches.qsize())
+                    item = batches.get()
+                    if item is _BLOB_DONE:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield from item
+            finally:
+                stop.set()
+                executor.shutdown(wait=True, cancel_futures=True)
+
+        context.log.info(f"Blobs downloaded successfully from path: {path}")
+
+
+_BLOB_DONE = object()
+
+# Azure caps append blobs at 50,000 blocks, the manifest rolls over to a new segment before that
+MANIFEST_ROLLOVER_BLOCKS = 49_000
+
+LANDING_FORMATS = ("json", "json.gz", "json.zst")
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("The json.zst landing format needs the zstandard package, install dagster_etl[zstd]") from e
+    return zstandard
+
+
+def encode_landing(json_data: Union[str, bytes], landing_format: str) -> bytes:
+    data = json_data.encode("utf-8") if isinstance(json_data, str) else json_data
+    if landing_format == "json.gz":
+        return gzip.compress(data, compresslevel=6)
+    if landing_format == "json.zst":
+        return _zstandard().ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def decode_landing_chunks(blob_name: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Decompresses a blob's chunks as they stream in, based on the blob name's extension."""
+    if blob_name.endswith(".gz"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif blob_name.endswith(".zst"):
+        decompressor = _zstandard().ZstdDecompressor().decompressobj()
+    else:
+        yield from chunks
+        return
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if hasattr(decompressor, "flush"):
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def strip_landing_extension(blob_name: str) -> str:
+    for landing_format in sorted(LANDING_FORMATS, key=len, reverse=True):
+        if blob_name.endswith(f".{landing_format}"):
+            return blob_name[:-len(landing_format) - 1]
+    return blob_name
+
+
+def parse_partition_keys(blob_name: str) -> Dict[str, str]:
+    """The `key=value` segments of a blob name, e.g. sail_code, action, currency and fare_code."""
+    return dict(segment.split("=", 1) for segment in blob_name.split("/") if "=" in segment)
+
+
+def partition_prefix(blob_name: str) -> Optional[str]:
+    """The part of a blob name before its first `key=value` segment."""
+    segments = blob_name.split("/")
+    for index, segment in enumerate(segments):
+        if "=" in segment:
+            return "/".join(segments[:index]) if index else None
+    return None
+
+
+def manifest_name(prefix: str, segment: int = 0) -> str:
+    """silversea/2024/06/20/socket -> silversea/2024/06/20/_manifest/socket.ndjson, later segments are socket.1.ndjson, ..."""
+    prefix = prefix.rstrip("/")
+    suffix = f".{segment}" if segment else ""
+    return posixpath.join(posixpath.dirname(prefix), "_manifest", f"{posixpath.basename(prefix)}{suffix}.ndjson")
+
+
+def _create_manifest(container_client, name: str) -> None:
+    try:
+        container_client.get_blob_client(name).create_append_blob(etag="*", match_condition=MatchConditions.IfMissing)
+    except (ResourceExistsError, ResourceModifiedError):
+        pass
+
+
+def matches_filters(partition_keys: Dict[str, str], filters: Dict[str, str]) -> bool:
+    return all(partition_keys.get(key) == value for key, value in filters.items())
+
+
+def iter_ndjson_batches(chunks: Iterable[bytes], on_error: Callable[[Exception], None]) -> Iterator[List[dict]]:
+    """Parses newline delimited JSON from a stream of byte chunks, one list of records per chunk."""
+    remainder = b""
+    for chunk in chunks:
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        yield _parse_lines(lines, on_error)
+    if remainder.strip():
+        yield _parse_lines([remainder], on_error)
+
+
+def _parse_lines(lines: List[bytes], on_error: Callable[[Exception], None]) -> List[dict]:
+    records = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            records.append(fastjson.loads(line))
+        except (ValueError, fastjson.JSONDecodeError) as e:
+            on_error(e)
+    return records
@@ -0,0 +1,274 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Coroutine, Dict, List, Optional, Union
+
+from websockets.asyncio.client import connect
+from websockets.exceptions import ConnectionClosed, WebSocketException
+
+from ..utils import fastjson
+from .socket_responses import request_id
+
+
+class BackgroundEventLoop:
+    """Runs an asyncio event loop on a daemon thread so synchronous code can submit coroutines to it."""
+
+    def __init__(self, name: str = "websocket-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, coro: Coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine) -> Any:
+        return self.submit(coro).result()
+
+    def stop(self) -> None:
+        if self.loop.is_closed():
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+def get_request_id(frame: Union[str, bytes]) -> Optional[str]:
+    return request_id(frame)
+
+
+class MultiplexedWebSocket:
+    """A single websocket connection that keeps up to `max_in_flight` requests outstanding.
+
+    Every outgoing message carries a `requestId`; a background reader matches each incoming
+    frame to the caller waiting on that id, so replies can arrive in any order.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        max_in_flight: int = 50,
+        request_timeout: float = 60.0,
+    ):
+        self.url = url
+        self.headers = dict(headers or {})
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._load = 0
+        self._window: Optional[asyncio.Semaphore] = None
+        self._ws = None
+        self._reader: Optional[asyncio.Task] = None
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._pending)
+
+    @property
+    def load(self) -> int:
+        """Requests sent or waiting for a slot in the in-flight window."""
+        return self._load
+
+    @property
+    def is_open(self) -> bool:
+        return self._reader is not None and not self._reader.done()
+
+    async def connect(self) -> None:
+        self._window = asyncio.Semaphore(self.max_in_flight)
+        headers = dict(self.headers)
+        user_agent = headers.pop("User-Agent", None)
+        self._ws = await connect(
+            self.url,
+            additional_headers=headers,
+            user_agent_header=user_agent,
+            max_size=None,
+        )
+        self._reader = asyncio.create_task(self._read_loop())
+
+    async def close(self) -> None:
+        if self._ws is not None:
+            await self._ws.close()
+        if self._reader is not None:
+            await asyncio.gather(self._reader, return_exceptions=True)
+
+    async def ping(self, timeout: float) -> bool:
+        if not self.is_open:
+            return False
+        try:
+            pong = await self._ws.ping()
+            await asyncio.wait_for(pong, timeout)
+            return True
+        except (ConnectionClosed, asyncio.TimeoutError):
+            return False
+
+    async def request(self, message: Dict[str, Any], payload: Optional[bytes] = None) -> bytes:
+        """Sends `message`, or its already encoded `payload`, and returns the raw reply frame."""
+        request_id = message["requestId"]
+        self._load += 1
+        try:
+            async with self._window:
+                if not self.is_open:
+                    raise ConnectionError(f"Websocket to {self.url} is closed")
+                reply = asyncio.get_running_loop().create_future()
+                self._pending[request_id] = reply
+                try:
+                    await self._ws.send(payload if payload is not None else fastjson.dumps(message), text=True)
+                    return await asyncio.wait_for(reply, self.request_timeout)
+                except ConnectionClosed as e:
+                    raise ConnectionError(f"Websocket to {self.url} was closed: {e}") from e
+                finally:
+                    self._pending.pop(request_id, None)
+                    # The reader may have failed the reply after send raised, nobody awaits it then
+                    if reply.done() and not reply.cancelled():
+                        reply.exception()
+        finally:
+            self._load -= 1
+
+    async def _read_loop(self) -> None:
+        error: Exception = ConnectionError(f"Websocket to {self.url} was closed")
+        try:
+            while True:
+                # Frames stay bytes, they are classified and landed without being decoded
+                frame = await self._ws.recv(decode=False)
+                reply = self._pending.get(get_request_id(frame))
+                if reply is not None and not reply.done():
+                    reply.set_result(frame)
+        except ConnectionClosed as e:
+            error = ConnectionError(f"Websocket to {self.url} was closed: {e}")
+        finally:
+            for reply in self._pending.values():
+                if not reply.done():
+                    reply.set_exception(error)
+
+
+class WebSocketPool:
+    """Spreads requests over `size` multiplexed connections.
+
+    Requests go to the open connection with the lowest load. A background task pings every
+    connection each `health_check_interval` seconds and replaces the ones that stopped answering.
+    When a connection drops or a reply doesn't arrive within `request_timeout`, the request is
+    replayed on another connection, up to `max_replays` times each.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        size: int = 4,
+        max_in_flight: int = 50,
+        request_timeout: float = 60.0,
+        health_check_interval: float = 30.0,
+        max_replays: int = 3,
+        reconnect_backoff: float = 1.0,
+    ):
+        self.url = url
+        self.headers = dict(headers or {})
+        self.size = size
+        self.max_in_flight = max_in_flight
+        self.request_timeout = request_timeout
+        self.health_check_interval = health_check_interval
+        self.max_replays = max_replays
+        self.reconnect_backoff = reconnect_backoff
+        self.reconnects = 0
+        self.replays = 0
+        self.timeouts = 0
+        self.reconnect_failures = 0
+        self.last_reconnect_error: Optional[BaseException] = None
+        self._connections: List[MultiplexedWebSocket] = []
+        self._reconnecting: Dict[int, asyncio.Task] = {}
+        self._health_check: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @property
+    def in_flight(self) -> int:
+        return sum(connection.in_flight for connection in self._connections)
+
+    def _new_connection(self) -> MultiplexedWebSocket:
+        return MultiplexedWebSocket(
+            self.url,
+            headers=self.headers,
+            max_in_flight=self.max_in_flight,
+            request_timeout=self.request_timeout,
+        )
+
+    async def connect(self) -> None:
+        self._connections = [self._new_connection() for _ in range(self.size)]
+        await asyncio.gather(*(connection.connect() for connection in self._connections))
+        self._health_check = asyncio.create_task(self._health_check_loop())
+
+    async def close(self) -> None:
+        self._closed = True
+        for task in [self._health_check, *self._reconnecting.values()]:
+            if task is not None:
+                task.cancel()
+        await asyncio.gather(*(connection.close() for connection in self._connections), return_exceptions=True)
+
+    async def request(self, message: Dict[str, Any], payload: Optional[bytes] = None) -> bytes:
+        for attempt in range(self.max_replays + 1):
+            connection = await self._least_loaded()
+            try:
+                return await connection.request(message, payload)
+            except ConnectionError:
+                if attempt == self.max_replays:
+                    raise
+                self.replays += 1
+                self._schedule_reconnect(connection)
+            except asyncio.TimeoutError:
+                # One slow reply is no reason to drop the connection, the health check catches dead ones
+                self.timeouts += 1
+                if attempt == self.max_replays:
+                    raise
+                self.replays += 1
+
+    async def _least_loaded(self) -> MultiplexedWebSocket:
+        deadline = asyncio.get_running_loop().time() + self.request_timeout
+        while True:
+            open_connections = [connection for connection in self._connections if connection.is_open]
+            if open_connections:
+                return min(open_connections, key=lambda connection: connection.load)
+            if self._closed:
+                raise ConnectionError(f"Websocket pool for {self.url} is closed")
+            if asyncio.get_running_loop().time() > deadline:
+                raise ConnectionError(f"No open websocket to {self.url}")
+            for connection in self._connections:
+                self._schedule_reconnect(connection)
+            await asyncio.sleep(self.reconnect_backoff)
+
+    def _schedule_reconnect(self, connection: MultiplexedWebSocket) -> None:
+        if self._closed or connection not in self._connections:
+            return
+        index = self._connections.index(connection)
+        task = self._reconnecting.get(index)
+        if task is None or task.done():
+            self._reconnecting[index] = asyncio.create_task(self._reconnect(index, connection))
+
+    async def _reconnect(self, index: int, connection: MultiplexedWebSocket) -> None:
+        await connection.close()
+        backoff = self.reconnect_backoff
+        while not self._closed:
+            replacement = self._new_connection()
+            try:
+                await replacement.connect()
+            except (OSError, asyncio.TimeoutError, WebSocketException) as e:
+                # Rejected handshakes (e.g. a 503 while the server is busy) are retried like refused connections
+                self.reconnect_failures += 1
+                self.last_reconnect_error = e
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            self._connections[index] = replacement
+            self.reconnects += 1
+            return
+
+    async def _health_check_loop(self) -> None:
+        while not self._closed:
+            await asyncio.sleep(self.health_check_interval)
+            connections = list(self._connections)
+            healthy = await asyncio.gather(
+                *(connection.ping(self.request_timeout) for connection in connections),
+                return_exceptions=True,
+            )
+            for connection, is_healthy in zip(connections, healthy):
+                # A ping that raised counts as unhealthy rather than ending the health check
+                if is_healthy is not True:
+                    self._schedule_reconnect(connection)
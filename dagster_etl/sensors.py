@@ -1,6 +1,31 @@
-import os
-from dagster import sensor, RunRequest, RunConfig
+from dagster import AssetKey, AssetSelection, MultiPartitionKey, RunRequest, asset_sensor, define_asset_job
 
-@sensor()
-def my_directory_sensor_cursor(context):
-    pass
\ No newline at end of file
+from .assets.scraping.scrape import currency_ship_partition
+from .assets.staging.silversea import currency_partition
+
+# Every run of the job carries this tag, so the run queue's tag_concurrency_limits can cap how
+# many partitions scrape Silversea (and write scraped.duckdb) at once, see the README
+SCRAPE_TARGET_TAG = "scrape/target"
+
+scrape_partitions_job = define_asset_job(
+    name="scrape_partitions_job",
+    selection=AssetSelection.keys("process_combination", "scrape_availability"),
+    partitions_def=currency_ship_partition,
+    tags={SCRAPE_TARGET_TAG: "silversea"},
+)
+
+
+@asset_sensor(asset_key=AssetKey("store_sail_codes_file"), job=scrape_partitions_job)
+def scrape_partitions_sensor(context, asset_event):
+    """Starts one scraping run per currency and ship code found by the latest store_sail_codes_file.
+
+    Like every sensor it is STOPPED when first deployed, turn it on under Overview > Sensors.
+    Each run has its own rate limiter and socket pool, so limit the runs tagged
+    scrape/target=silversea with tag_concurrency_limits rather than starting them all at once.
+    """
+    metadata = asset_event.asset_materialization.metadata
+    ship_codes = metadata["ship_codes"].value if "ship_codes" in metadata else []
+    for currency in currency_partition.get_partition_keys():
+        for ship_code in ship_codes:
+            partition_key = MultiPartitionKey({"currency": currency, "ship_code": ship_code})
+            yield RunRequest(run_key=f"{asset_event.timestamp}-{partition_key}", partition_key=partition_key)
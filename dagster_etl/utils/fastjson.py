@@ -0,0 +1,48 @@
+"""JSON through orjson or msgspec when one is installed (`pip install dagster_etl[fastjson]`), the standard library otherwise.
+
+`loads` takes str or bytes and `dumps` returns compact UTF-8 bytes, whichever backend is used.
+"""
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+if orjson is not None:
+    BACKEND = "orjson"
+    JSONDecodeError = orjson.JSONDecodeError
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return orjson.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+elif msgspec is not None:
+    BACKEND = "msgspec"
+    JSONDecodeError = msgspec.DecodeError
+    _decoder = msgspec.json.Decoder()
+    _encoder = msgspec.json.Encoder()
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return _decoder.decode(data)
+
+    def dumps(obj: Any) -> bytes:
+        return _encoder.encode(obj)
+
+else:
+    BACKEND = "json"
+    JSONDecodeError = json.JSONDecodeError
+
+    def loads(data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
@@ -0,0 +1,110 @@
+import bisect
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+OK = "ok"
+
+# How long this process spent loading the code location, the dbt assets attach it to their materializations
+LOAD_METADATA: Dict[str, float] = {}
+
+# Upper bounds of the latency histogram buckets in milliseconds, the last bucket is unbounded
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class RequestMetrics:
+    """Latency histogram, bytes transferred, outcomes by type and queue depth of one resource's requests.
+
+    Recording is a few counter updates under a lock, so it can be done for every request from
+    any thread. `metadata` reports the totals for asset materializations and `maybe_log` writes
+    a one-line summary at most every `log_interval` seconds, in place of a log line per request.
+    """
+
+    def __init__(self, name: str, log_interval: float = 30.0):
+        self.name = name
+        self.log_interval = log_interval
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.outcomes: Counter = Counter()
+        self.queue_depth = 0
+        self.peak_queue_depth = 0
+
+        self._lock = threading.Lock()
+        self._buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self._latency_total = 0.0
+        self._started = time.monotonic()
+        self._last_log = self._started
+        self._last_log_requests = 0
+
+    def record(self, latency: float, outcome: str = OK, bytes_sent: int = 0, bytes_received: int = 0) -> None:
+        bucket = bisect.bisect_left(LATENCY_BUCKETS_MS, latency * 1000)
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+            self.outcomes[outcome] += 1
+            self._buckets[bucket] += 1
+            self._latency_total += latency
+
+    def observe_queue_depth(self, depth: int) -> None:
+        with self._lock:
+            self.queue_depth = depth
+            self.peak_queue_depth = max(self.peak_queue_depth, depth)
+
+    @property
+    def errors(self) -> Dict[str, int]:
+        return {outcome: count for outcome, count in self.outcomes.items() if outcome != OK}
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """Upper bound in milliseconds of the bucket holding the percentile, None for the unbounded bucket."""
+        with self._lock:
+            buckets, total = list(self._buckets), self.requests
+        if not total:
+            return 0.0
+        rank = percentile / 100 * total
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, buckets):
+            seen += count
+            if seen >= rank:
+                return float(bound)
+        return None
+
+    def histogram(self) -> Dict[str, int]:
+        with self._lock:
+            buckets = list(self._buckets)
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {label: count for label, count in zip(labels, buckets) if count}
+
+    def metadata(self, prefix: Optional[str] = None) -> dict:
+        prefix = prefix or self.name
+        elapsed = time.monotonic() - self._started
+        return {
+            f"{prefix}_latency_mean_ms": round(self._latency_total / self.requests * 1000, 2) if self.requests else 0.0,
+            f"{prefix}_latency_p50_ms": self.latency_percentile(50),
+            f"{prefix}_latency_p99_ms": self.latency_percentile(99),
+            f"{prefix}_latency_histogram": self.histogram(),
+            f"{prefix}_requests_per_second": round(self.requests / elapsed, 2) if elapsed else 0.0,
+            f"{prefix}_bytes_sent": self.bytes_sent,
+            f"{prefix}_bytes_received": self.bytes_received,
+            f"{prefix}_errors_by_type": self.errors,
+            f"{prefix}_peak_queue_depth": self.peak_queue_depth,
+        }
+
+    def summary(self) -> str:
+        errors = ", ".join(f"{outcome}={count}" for outcome, count in sorted(self.errors.items())) or "none"
+        return (
+            f"{self.name}: {self.requests} requests, p50 {self.latency_percentile(50)}ms, p99 {self.latency_percentile(99)}ms, "
+            f"{self.bytes_sent} bytes sent, {self.bytes_received} bytes received, queue depth {self.queue_depth}, errors {errors}"
+        )
+
+    def maybe_log(self, log) -> None:
+        """Logs the summary if `log_interval` has passed since the last one and there were new requests."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_log < self.log_interval or self.requests == self._last_log_requests:
+                return
+            self._last_log = now
+            self._last_log_requests = self.requests
+        log.info(self.summary())
@@ -0,0 +1,184 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+OK = "ok"
+ERROR = "error"
+THROTTLED = "throttled"
+
+
+class AdaptiveRateLimiter:
+    """Token bucket plus concurrency limit, both tuned with AIMD.
+
+    Every request takes a token (refilled at `rate` per second, the bucket starts full so the first
+    `rate` requests can go out together) and a concurrency slot. After each
+    `window` healthy responses whose mean latency stays under `target_latency`, the rate and the
+    concurrency limit grow additively; an error or throttled response shrinks both
+    multiplicatively, at most once per `target_latency` so a burst of failures from requests that
+    were already in flight only counts once.
+
+    It is safe to share between threads, and `acquire_async` lets coroutines wait without
+    blocking their event loop. Callers waiting for a concurrency slot are woken by `release`, on
+    whichever thread or event loop they wait.
+    """
+
+    def __init__(
+        self,
+        rate: float = 10.0,
+        min_rate: float = 1.0,
+        max_rate: float = 100.0,
+        concurrency: int = 10,
+        min_concurrency: int = 1,
+        max_concurrency: int = 100,
+        target_latency: float = 2.0,
+        rate_increase: float = 1.0,
+        decrease_factor: float = 0.5,
+        window: int = 20,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.rate_increase = rate_increase
+        self.decrease_factor = decrease_factor
+        self.window = window
+
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.peak_rate = rate
+
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._async_waiters: Deque[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = deque()
+        self._tokens = max(rate, 1.0)
+        self._last_refill = time.monotonic()
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._window_count = 0
+        self._window_latency = 0.0
+
+    def _try_acquire(self) -> Optional[float]:
+        """Takes a token and a slot if both are free, otherwise returns how long to wait for a token.
+
+        None means every slot is taken, wait for `release`. Call it with the lock held.
+        """
+        now = time.monotonic()
+        self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+        if self._in_flight >= self.concurrency:
+            return None
+        if self._tokens < 1.0:
+            return (1.0 - self._tokens) / self.rate
+        self._tokens -= 1.0
+        self._in_flight += 1
+        return 0.0
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                wait = self._try_acquire()
+                if wait is None:
+                    self._slot_freed.wait()
+                    continue
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                wait = self._try_acquire()
+                if wait is None:
+                    slot_freed = loop.create_future()
+                    self._async_waiters.append((loop, slot_freed))
+            if wait is None:
+                try:
+                    await slot_freed
+                except asyncio.CancelledError:
+                    # Cancelled right after being woken up, the slot goes to the next waiter
+                    if slot_freed.done() and not slot_freed.cancelled():
+                        with self._lock:
+                            self._wake_async_waiters(1)
+                    raise
+            elif wait > 0:
+                await asyncio.sleep(wait)
+            else:
+                return
+
+    def _wake_async_waiters(self, count: int) -> None:
+        """Wakes up to `count` coroutines waiting for a slot, with the lock held."""
+        for _ in range(min(count, len(self._async_waiters))):
+            loop, slot_freed = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(self._resolve, slot_freed)
+            except RuntimeError:
+                # Its event loop is closed, nobody is waiting there anymore
+                self._wake_async_waiters(1)
+
+    def _resolve(self, slot_freed: asyncio.Future) -> None:
+        if slot_freed.cancelled():
+            with self._lock:
+                self._wake_async_waiters(1)
+        else:
+            slot_freed.set_result(None)
+
+    def _wake_waiters(self) -> None:
+        free = self.concurrency - self._in_flight
+        if free > 0:
+            self._slot_freed.notify(free)
+            self._wake_async_waiters(free)
+
+    def release(self, latency: float, outcome: str = OK) -> None:
+        """Returns the slot taken by `acquire` and feeds the response back into the controller."""
+        with self._lock:
+            self._in_flight -= 1
+            self.requests += 1
+            self._adjust(latency, outcome)
+            self._wake_waiters()
+
+    def _adjust(self, latency: float, outcome: str) -> None:
+        """The AIMD step for one response, with the lock held."""
+        if outcome == OK:
+            self._window_count += 1
+            self._window_latency += latency
+            if self._window_count >= self.window:
+                if self._window_latency / self._window_count <= self.target_latency:
+                    self.rate = min(self.max_rate, self.rate + self.rate_increase)
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                    self.peak_rate = max(self.peak_rate, self.rate)
+                self._window_count = 0
+                self._window_latency = 0.0
+            return
+
+        if outcome == THROTTLED:
+            self.throttled += 1
+        else:
+            self.errors += 1
+        now = time.monotonic()
+        if now - self._last_decrease >= self.target_latency:
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.concurrency = max(self.min_concurrency, int(self.concurrency * self.decrease_factor))
+        self._window_count = 0
+        self._window_latency = 0.0
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def metadata(self, prefix: str) -> Dict[str, float]:
+        return {
+            f"{prefix}_rate_per_second": round(self.rate, 2),
+            f"{prefix}_peak_rate_per_second": round(self.peak_rate, 2),
+            f"{prefix}_concurrency_limit": self.concurrency,
+            f"{prefix}_requests": self.requests,
+            f"{prefix}_errors": self.errors,
+            f"{prefix}_throttled": self.throttled,
+        }
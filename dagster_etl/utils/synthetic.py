@@ -0,0 +1,285 @@
+"""Synthetic Silversea data at any scale, for load and staging benchmarks.
+
+Sailings are drawn from the ships.csv and cabin_categories.csv dbt seeds. All random draws are
+made up front as numpy arrays, the Algolia hit pages and prices-v2 messages are only assembled
+from them while they are written, so memory stays flat however many sailings are generated.
+
+    python -m dagster_etl.utils.synthetic --sailings 100000 --output /tmp/landing --landing-format json.gz
+"""
+import argparse
+import csv
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+
+from ..resources.storage_account_io_manager import LANDING_FORMATS, encode_landing, manifest_name, parse_partition_keys
+
+SEEDS_DIR = os.path.join(os.path.dirname(__file__), "..", "..", "dbt_project", "seeds")
+
+FARE_CODES = np.array(["DoorToDoorV2", "PortToPortV2", "EssentialV2", "ElevatedV2"])
+PORTS = np.array([
+    ("INBOM", "Mumbai"), ("OMMCT", "Muscat"), ("SAJED", "Jeddah"), ("JOAQJ", "Aqaba (Petra)"), ("GRPIR", "Athens (Piraeus)"),
+    ("ITCVV", "Civitavecchia (Rome)"), ("ESBCN", "Barcelona"), ("FRNCE", "Nice"), ("USMIA", "Miami"), ("SGSIN", "Singapore"),
+    ("AUSYD", "Sydney"), ("NOOSL", "Oslo"), ("ISREY", "Reykjavik"), ("ARUSH", "Ushuaia"), ("PTLIS", "Lisbon"),
+])
+DESTINATIONS = np.array(["Africa & Indian Ocean", "Mediterranean", "Northern Europe", "Caribbean", "Asia", "Antarctica", "Australia & New Zealand"])
+FEATURES = np.array(["BridgeSailings", "GentlemenHosts", "Kids", "Gala"])
+PROMO_CODES = np.array(["CATEGORY_UPGRADE", "SAVE_10", "FREE_AIR"])
+INCLUSIONS = ["FreeShorex", "Butler", "FoodAndBeverage", "Wifi"]
+# The occupancies the scraper asks for, see scheduler.OCCUPANCY_COMBINATIONS
+OCCUPANCIES = [(1, 0), (1, 1), (1, 2), (1, 3), (2, 0), (2, 1), (2, 2), (3, 0), (3, 1), (4, 0)]
+CURRENCIES = {"US": "USD", "GB": "GBP", "AS": "AUD", "CA": "CAD", "IE": "EUR"}
+
+
+def load_seeds(seeds_dir: str = SEEDS_DIR):
+    """(ships, cabin categories by ship code) from the dbt seeds."""
+    with open(os.path.join(seeds_dir, "ships.csv"), newline="") as file:
+        ships = [{key: value.strip() for key, value in row.items()} for row in csv.DictReader(file)]
+    categories: Dict[str, List[str]] = {}
+    with open(os.path.join(seeds_dir, "cabin_categories.csv"), newline="") as file:
+        for row in csv.DictReader(file):
+            categories.setdefault(row["ship_code"].strip(), []).append(row["cabin_category"].strip())
+    ships = [ship for ship in ships if ship["ship_code"] in categories]
+    return ships, categories
+
+
+@dataclass
+class Sailings:
+    """Column arrays describing `len(self)` sailings."""
+    ships: List[dict]
+    categories: Dict[str, List[str]]
+    ship: np.ndarray
+    departure: np.ndarray
+    days: np.ndarray
+    sequence: np.ndarray
+    ports: np.ndarray
+    destination: np.ndarray
+    fare_mask: np.ndarray
+    base_price: np.ndarray
+    available: np.ndarray
+    promo_mask: np.ndarray
+    feature_mask: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.ship)
+
+    def sail_code(self, index: int) -> str:
+        ship_code = self.ships[self.ship[index]]["ship_code"]
+        departure = START_DATE + timedelta(days=int(self.departure[index]))
+        return f"{ship_code}{departure:%y%m%d}{self.sequence[index]:03d}"
+
+    def fare_codes(self, index: int) -> List[str]:
+        return FARE_CODES[self.fare_mask[index]].tolist()
+
+
+START_DATE = datetime(2024, 6, 1)
+DEPARTURE_DAYS = 3 * 365
+
+
+def generate_sailings(count: int, seed: int = 0, seeds_dir: str = SEEDS_DIR) -> Sailings:
+    """Draws `count` sailings with unique sail codes spread over the seed ships and three years of departures."""
+    ships, categories = load_seeds(seeds_dir)
+    rng = np.random.default_rng(seed)
+
+    # Every (ship, departure day, sequence) slot is used at most once, so sail codes never collide
+    slots = rng.permutation(count)
+    ship = slots % len(ships)
+    departure = (slots // len(ships)) % DEPARTURE_DAYS
+    sequence = slots // (len(ships) * DEPARTURE_DAYS)
+
+    fare_mask = rng.random((count, len(FARE_CODES))) < 0.5
+    fare_mask[np.arange(count), rng.integers(0, len(FARE_CODES), count)] = True
+
+    return Sailings(
+        ships=ships,
+        categories=categories,
+        ship=ship,
+        departure=departure,
+        days=rng.integers(5, 30, count),
+        sequence=sequence,
+        ports=rng.integers(0, len(PORTS), (count, 6)),
+        destination=rng.integers(0, len(DESTINATIONS), count),
+        fare_mask=fare_mask,
+        base_price=rng.integers(30, 300, count) * 100,
+        available=rng.random(count) < 0.9,
+        promo_mask=rng.random((count, len(PROMO_CODES))) < 0.2,
+        feature_mask=rng.random((count, len(FEATURES))) < 0.3,
+    )
+
+
+def algolia_hit(sailings: Sailings, index: int, country: str = "US") -> dict:
+    ship = sailings.ships[sailings.ship[index]]
+    sail_code = sailings.sail_code(index)
+    departure = START_DATE + timedelta(days=int(sailings.departure[index]))
+    days = int(sailings.days[index])
+    ports = PORTS[sailings.ports[index]]
+    fare_codes = sailings.fare_codes(index)
+    prices = [
+        {"type": "price", "webFareCode": fare_code, "amount": int(sailings.base_price[index]) + 2000 * rank}
+        for rank, fare_code in enumerate(reversed(fare_codes))
+    ]
+    return {
+        "destinationName": {"en": str(DESTINATIONS[sailings.destination[index]])},
+        "visible": True,
+        "content": {"shipId": f"ship-{ship['ship_name'].lower().replace(' ', '-')}", "shipName": ship["ship_name"], "specialType": None},
+        "cruiseCode": sail_code,
+        "cruiseId": str(10_000 + index),
+        "available": bool(sailings.available[index]),
+        "days": days,
+        "departureYearMonth": f"{departure:%Y-%m}",
+        "departurePort": {"cityCode": ports[0][0], "city": {"en": ports[0][1]}},
+        "arrivalPort": {"cityCode": ports[-1][0], "city": {"en": ports[-1][1]}},
+        "cruiseType": ship["type"],
+        "comboType": "Single",
+        "portCodes": ports[:, 0].tolist(),
+        "portNames": ports[:, 1].tolist(),
+        "countryNames": {"en": []},
+        "departureTimestamp": int(departure.timestamp() * 1000),
+        "topCruise": False,
+        "dayGroup": "1-12" if days <= 12 else "13-18" if days <= 18 else "19+",
+        "features": FEATURES[sailings.feature_mask[index]].tolist(),
+        "cruiseGroup": str(DESTINATIONS[sailings.destination[index]]).replace(" ", "").replace("&", ""),
+        "fareCodes": fare_codes,
+        "countries": [country],
+        "currency": CURRENCIES[country],
+        "orderingPrice": prices[-1]["amount"],
+        "orderingWebFare": fare_codes[0],
+        "prices": prices,
+        "promoCodes": PROMO_CODES[sailings.promo_mask[index]].tolist(),
+    }
+
+
+def algolia_pages(sailings: Sailings, hits_per_page: int = 100, country: str = "US") -> Iterator[dict]:
+    """The multi-query result of every page, as store_sail_codes_file lands them."""
+    pages = -(-len(sailings) // hits_per_page)
+    for page in range(pages):
+        hits = [algolia_hit(sailings, index, country) for index in range(page * hits_per_page, min(len(sailings), (page + 1) * hits_per_page))]
+        yield {"results": [{"hits": hits, "nbHits": len(sailings), "page": page, "nbPages": pages, "hitsPerPage": hits_per_page}]}
+
+
+def prices_message(sailings: Sailings, index: int, fare_code: str, adults: int, kids: int, rng: np.random.Generator, country: str = "US") -> dict:
+    """A prices-v2 reply with one Left (unavailable) or Right (priced) entry per cabin category of the ship."""
+    sail_code = sailings.sail_code(index)
+    categories = sailings.categories[sailings.ships[sailings.ship[index]]["ship_code"]]
+    guests = adults + kids
+    currency = CURRENCIES[country]
+    # Bigger parties fit in fewer cabins
+    available = rng.random(len(categories)) < (0.9 - 0.15 * guests)
+    multipliers = 1 + rng.random(len(categories)) * 3
+    final_due = START_DATE + timedelta(days=int(sailings.departure[index]) - 90)
+
+    entries = []
+    for category, is_available, multiplier in zip(categories, available, multipliers):
+        request = {
+            "cruiseCode": sail_code, "suiteCategory": category, "occupancy": {"adults": adults, "kids": kids},
+            "fareCode": fare_code, "vsMember": False, "air": {"type": "notAvailable"},
+        }
+        if not is_available:
+            entries.append({"_tag": "Left", "left": {"request": request, "errorCode": "noAvailabilityForOccupancy"}})
+            continue
+        per_guest = round(float(sailings.base_price[index]) * float(multiplier), 2)
+        total = round(per_guest * guests, 2)
+        deposit = round(total * 0.25, 2)
+        entries.append({"_tag": "Right", "right": {
+            **request,
+            "suitePayment": {
+                "type": "deposit", "percentage": 25,
+                "amount": {"value": deposit, "currency": currency},
+                "balanceAmount": {"value": round(total - deposit, 2), "currency": currency},
+                "totalAmount": {"value": total, "currency": currency},
+                "finalDueDate": f"{final_due:%Y-%m-%d}",
+            },
+            "price": {
+                "total": {"value": total, "currency": currency},
+                "paxPrices": [{"number": number, "total": {"value": per_guest, "currency": currency}} for number in range(1, guests + 1)],
+                "inclusions": [{"inclusionCode": code} for code in INCLUSIONS],
+            },
+            "availability": "standard",
+        }})
+    return {"requestId": f"{sail_code}-{fare_code}-{adults}-{kids}", "action": "prices-v2", "type": "PricesResponseV2", "data": {"prices": entries}}
+
+
+def price_units(sailings: Sailings, seed: int = 0, country: str = "US") -> Iterator[tuple]:
+    """(blob name, messages) of every prices-v2 unit, the blob name as the scraper uploads it."""
+    rng = np.random.default_rng(seed)
+    for index in range(len(sailings)):
+        sail_code = sailings.sail_code(index)
+        for fare_code in sailings.fare_codes(index):
+            messages = [prices_message(sailings, index, fare_code, adults, kids, rng, country) for adults, kids in OCCUPANCIES]
+            yield f"socket/sail_code={sail_code}/action=prices-v2/currency={country}/fare_code={fare_code}/data", messages
+
+
+def write_landing(
+    output: str,
+    sailings: Sailings,
+    day: datetime,
+    landing_format: str = "json",
+    hits_per_page: int = 100,
+    country: str = "US",
+    seed: int = 0,
+    max_units: Optional[int] = None,
+) -> Dict[str, int]:
+    """Writes Algolia pages and prices-v2 units under `output` in the landing-blob layout, with the day's manifest.
+
+    Returns how many files, price messages and price rows were written.
+    """
+    if landing_format not in LANDING_FORMATS:
+        raise ValueError(f"landing_format must be one of {LANDING_FORMATS}, got {landing_format}")
+    prefix = f"silversea/{day:%Y/%m/%d}"
+    counts = {"files": 0, "messages": 0, "rows": 0}
+
+    def write(blob_name: str, lines: List[dict]) -> str:
+        name = f"{prefix}/{blob_name}.{landing_format}"
+        path = os.path.join(output, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(encode_landing("\n".join(json.dumps(line) for line in lines) + "\n", landing_format))
+        counts["files"] += 1
+        return name
+
+    for page, result in enumerate(algolia_pages(sailings, hits_per_page, country)):
+        write(f"algolia/{page}", [result])
+
+    manifest_path = os.path.join(output, manifest_name(f"{prefix}/socket"))
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    with open(manifest_path, "w") as manifest:
+        for number, (blob_name, messages) in enumerate(price_units(sailings, seed, country)):
+            if max_units is not None and number >= max_units:
+                break
+            name = write(blob_name, messages)
+            manifest.write(json.dumps({"blob": name, **parse_partition_keys(name)}) + "\n")
+            counts["messages"] += len(messages)
+            counts["rows"] += sum(len(message["data"]["prices"]) for message in messages)
+    return counts
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Write synthetic Silversea landing files")
+    parser.add_argument("--sailings", type=int, default=1000)
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--day", default=datetime.now().strftime("%Y-%m-%d"))
+    parser.add_argument("--landing-format", default="json", choices=LANDING_FORMATS)
+    parser.add_argument("--currency", default="US", choices=sorted(CURRENCIES))
+    parser.add_argument("--max-units", type=int, default=None, help="Stop after this many prices-v2 units")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    sailings = generate_sailings(args.sailings, seed=args.seed)
+    counts = write_landing(
+        args.output,
+        sailings,
+        datetime.strptime(args.day, "%Y-%m-%d"),
+        landing_format=args.landing_format,
+        country=args.currency,
+        seed=args.seed,
+        max_units=args.max_units,
+    )
+    print(f"Wrote {counts['files']} files with {counts['messages']} messages and {counts['rows']} price rows to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
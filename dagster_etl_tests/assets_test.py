@@ -1,11 +1,35 @@
+import itertools
+import json
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
 import pytest
 from unittest.mock import MagicMock, Mock
-from dagster import build_op_context, resource
-from dagster_etl.resources import StorageAccountIoManager
-from dagster_etl.assets.staging import silversea
+from dagster import DagsterInstance, MultiPartitionKey, ResourceDefinition, SourceAsset, build_init_resource_context, build_op_context, materialize, resource
+from dagster_duckdb import DuckDBResource
+from dagster_etl.resources import AlgoliaAPI, DuckDBArrowIOManager, StorageAccountIoManager
+from dagster_etl.resources.storage_account_io_manager import strip_landing_extension
+from dagster_etl.assets.staging import silversea, silversea_duckdb
+from dagster_etl.assets.staging.schemas import AvailableCabin, SailCode, UnavailableCabin, arrow_schema, duckdb_columns
+from dagster_etl.assets.dbt import DBT_PROJECT_DIR
+from dagster_etl.assets.dbt.manifest import cached_manifest_path
+from dagster_etl.assets.scraping import scrape
+from dagster_etl.assets.scraping.fingerprints import hit_fingerprint, load_fingerprints, needs_scrape, save_fingerprints
+from dagster_etl.assets.scraping.planning import build_availability_index, plan_availability_units, plan_size
+from dagster_etl.assets.scraping.scheduler import OCCUPANCY_COMBINATIONS, ScrapeScheduler, ScrapeUnit
+from dagster_etl.utils import synthetic
+from dagster_etl.utils.metrics import LOAD_METADATA
+import duckdb
 import pandas as pd
 import os
 
+from .fakes import FAKE_BLOB_STORES, FakeAlgoliaServer, FakeBlobStore, FakeStorageAccountIoManager, load_example, recorded_hits
+
 
 # Create a mock resource definition for StorageAccountIoManager
 @resource
@@ -14,58 +38,490 @@ def mock_storage_account_io_manager(_):
 
     # Read JSON data from file
     file_path = os.path.join(
-        os.path.dirname(__file__), "examples", "ship_page_data.json"
+        os.path.dirname(__file__), "examples", "scrape_sail_codes.json"
     )
     with open(file_path, "r") as file:
-        json_data = file.read()
+        json_data = json.load(file)
 
-    mock_io_manager.download_blob = MagicMock(return_value=json_data)
+    mock_io_manager.iter_blobs_from_path = MagicMock(return_value=iter([json_data]))
+    mock_io_manager.cache_metadata = MagicMock(return_value={})
+    mock_io_manager.metrics_metadata = MagicMock(return_value={})
     return mock_io_manager
 
 
 @pytest.fixture
 def mock_context():
     partition_date = "2024-05-20"
-    context = build_op_context(partition_key=partition_date)
+    context = build_op_context(partition_key=partition_date, resources={"storage_account_io_manager": mock_storage_account_io_manager})
     return context
 
 
-def test_silversea_ships(mock_context):
-    # Call the silversea_ships function
-    result = silversea.silversea_ships(mock_context, mock_storage_account_io_manager)
-
-    pandas_df = pd.DataFrame(
-        {
-            "name": [
-                "Silver Cloud",
-                "Silver Dawn",
-                "Silver Endeavour",
-                "Silver Moon",
-                "Silver Muse",
-                "Silver Nova",
-                "Silver Origin",
-                "Silver Ray",
-                "Silver Shadow",
-                "Silver Spirit",
-                "Silver Whisper",
-                "Silver Wind",
-            ],
-            "type": [
-                "Expedition",
-                "Classic",
-                "Expedition",
-                "Classic",
-                "Classic",
-                "Classic",
-                "Expedition",
-                "Classic",
-                "Classic",
-                "Classic",
-                "Classic",
-                "Expedition",
-            ]
-        }
+def test_silversea_sail_codes(mock_context):
+    table = silversea.sail_codes(mock_context)
+    assert table.schema == arrow_schema(SailCode)
+    result = table.to_pandas()
+
+    mock_context.resources.storage_account_io_manager.iter_blobs_from_path.assert_called_once_with(mock_context, "silversea/2024/05/20/algolia")
+    assert len(result) == 10
+    assert set(result["ship_code"]) == {"MO", "SN"}
+    assert (result["ship_code"] == result["sail_code"].str[:2]).all()
+    assert (result["extract_date"] == "2024/05/20").all()
+
+
+class FakeSocket:
+    """Answers every request from a thread pool and records the peak number of requests in flight."""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=32)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def _reply(self, sail_code, adults, kids):
+        time.sleep(0.001)
+        with self.lock:
+            self.in_flight -= 1
+        return json.dumps({"requestId": f"{sail_code}-{adults}-{kids}", "type": "PricesResponseV2"})
+
+    def submit(self, context, action, fare_code, sail_code, adults, kids, currency, cabin_category):
+        with self.lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return self.executor.submit(self._reply, sail_code, adults, kids)
+
+
+def test_scrape_scheduler_uploads_every_unit_within_concurrency():
+    socket = FakeSocket()
+    storage = Mock(spec=StorageAccountIoManager)
+    units = [ScrapeUnit(action="prices-v2", sail_code=f"SC{i:03}", fare_code="Essential") for i in range(20)]
+
+    with build_op_context() as context:
+        ScrapeScheduler(context, socket, storage, concurrency=8).run(units)
+
+    assert socket.peak_in_flight <= 8
+    uploaded = {call.kwargs["blob_name"]: call.kwargs["json_data"] for call in storage.upload_blob.call_args_list}
+    assert set(uploaded) == {unit.blob_name for unit in units}
+    assert all(len(data.splitlines()) == len(OCCUPANCY_COMBINATIONS) for data in uploaded.values())
+
+
+def _price_messages():
+    file_path = os.path.join(os.path.dirname(__file__), "examples", "sail_code_prices.json")
+    with open(file_path, "r") as file:
+        text = file.read()
+    # The example holds several JSON documents one after the other
+    decoder, messages, index = json.JSONDecoder(), [], 0
+    while index < len(text):
+        if text[index].isspace():
+            index += 1
+            continue
+        message, index = decoder.raw_decode(text, index)
+        messages.append(message)
+    return messages
+
+
+def test_chunked_cabin_prices_match_in_memory_staging(tmp_path):
+    messages = _price_messages() * 5
+    storage = Mock()
+    storage.iter_blobs_from_path = lambda **kwargs: iter(messages)
+    storage.cache_metadata.return_value = {}
+    storage.metrics_metadata.return_value = {}
+    tables = {}
+
+    for chunked in [False, True]:
+        database = str(tmp_path / f"chunked_{chunked}.duckdb")
+        result = materialize(
+            [silversea.silversea_cabin_prices],
+            partition_key="2024-06-20",
+            resources={"io_manager": DuckDBArrowIOManager(database=database), "storage_account_io_manager": storage},
+            run_config={"ops": {"silversea_cabin_prices": {"config": {"chunked": chunked, "batch_size": 7}}}},
+        )
+        assert result.success
+        with duckdb.connect(database) as conn:
+            tables[chunked] = {
+                table: conn.execute(f"select * from public.{table} order by all").fetchall()
+                for table in ["unavailable_cabins", "available_cabins"]
+            }
+        metadata = result.asset_materializations_for_node("silversea_cabin_prices")[-1].metadata
+        assert "peak_memory_mb" in metadata
+
+    assert tables[True] == tables[False]
+    assert tables[True]["available_cabins"]
+
+
+def test_fingerprints_only_rescrape_changed_or_stale_sailings(tmp_path):
+    duckdb_resource = DuckDBResource(database=str(tmp_path / "fingerprints.duckdb"))
+    hit = {"cruiseCode": "WH260316C28", "orderingPrice": 4200, "prices": {"US": 4200}, "available": True, "promoCodes": [], "fareCodes": ["Essential"]}
+    now = datetime(2024, 6, 20)
+
+    save_fingerprints(duckdb_resource, "US", [("WH260316C28", hit_fingerprint(hit))], now - timedelta(days=7))
+    previous = load_fingerprints(duckdb_resource, "US")
+
+    # Key order and unrelated fields don't change the fingerprint
+    same = {**dict(reversed(list(hit.items()))), "visible": False}
+    assert not needs_scrape(previous.get("WH260316C28"), hit_fingerprint(same), now - timedelta(days=28))
+    assert needs_scrape(previous.get("WH260316C28"), hit_fingerprint({**hit, "orderingPrice": 3900}), now - timedelta(days=28))
+    assert needs_scrape(previous.get("WH260316C28"), hit_fingerprint(hit), now - timedelta(days=1))
+    assert needs_scrape(previous.get("NEW0001"), hit_fingerprint(hit), now - timedelta(days=28))
+    assert load_fingerprints(duckdb_resource, "GB") == {}
+
+
+def test_availability_plan_groups_fare_codes_and_cabin_categories_per_sail_code():
+    cabin_categories = pd.DataFrame({"ship_code": ["WH", "WH", "WH", "SD"], "cabin_category": ["VI", "SL", "VI", "OC"]})
+    sail_codes = [
+        {"sail_code": "WH260316C28", "fare_codes": ["Essential", "DoorToDoor"]},
+        {"sail_code": "WH260316C28", "fare_codes": ["DoorToDoor", "PortToPort"]},
+        {"sail_code": "XX240101C01", "fare_codes": ["Essential"]},
+        {"sail_code": "SD240701C10", "fare_codes": None},
+    ]
+
+    index = build_availability_index(cabin_categories, sail_codes)
+    units = plan_availability_units(index)
+
+    assert index["WH260316C28"].cabin_categories == ("VI", "SL")
+    assert [unit.fare_code for unit in units] == ["Essential", "DoorToDoor", "PortToPort"]
+    assert plan_size(units) == {"plan_sail_codes": 1, "plan_units": 3, "plan_requests": 6}
+
+
+def test_scrape_scheduler_skips_units_that_already_landed():
+    socket = FakeSocket()
+    storage = Mock(spec=StorageAccountIoManager)
+    units = [ScrapeUnit(action="prices-v2", sail_code=f"SC{i:03}", fare_code="Essential") for i in range(10)]
+    landed = [f"silversea/2024/06/20/{unit.blob_name}.json.gz" for unit in units[:7]]
+
+    with build_op_context() as context:
+        scheduler = ScrapeScheduler(context, socket, storage, concurrency=8, completed={strip_landing_extension(name[len("silversea/2024/06/20/"):]) for name in landed})
+        scheduler.run(units)
+
+    assert scheduler.units_skipped == 7
+    assert {call.kwargs["blob_name"] for call in storage.upload_blob.call_args_list} == {unit.blob_name for unit in units[7:]}
+
+
+class TimingOutSocket(FakeSocket):
+    """Times out every request for the given sail codes."""
+
+    def __init__(self, failing):
+        super().__init__()
+        self.failing = failing
+
+    def _reply(self, sail_code, adults, kids):
+        reply = super()._reply(sail_code, adults, kids)
+        if sail_code in self.failing:
+            raise TimeoutError(f"No reply for {sail_code}")
+        return reply
+
+
+def test_scrape_scheduler_fails_only_the_units_whose_requests_failed():
+    socket = TimingOutSocket({"SC001", "SC004"})
+    storage = Mock(spec=StorageAccountIoManager)
+    units = [ScrapeUnit(action="prices-v2", sail_code=f"SC{i:03}", fare_code="Essential") for i in range(6)]
+
+    with build_op_context() as context:
+        scheduler = ScrapeScheduler(context, socket, storage, concurrency=8, max_failed_units=2)
+        scheduler.run(units)
+
+    assert scheduler.units_failed == 2
+    assert {call.kwargs["blob_name"] for call in storage.upload_blob.call_args_list} == {
+        unit.blob_name for unit in units if unit.sail_code not in socket.failing
+    }
+
+
+def test_scrape_scheduler_fails_the_run_above_max_failed_units():
+    socket = TimingOutSocket({"SC001", "SC004"})
+    storage = Mock(spec=StorageAccountIoManager)
+    units = [ScrapeUnit(action="prices-v2", sail_code=f"SC{i:03}", fare_code="Essential") for i in range(6)]
+
+    with build_op_context() as context:
+        with pytest.raises(Exception, match="max_failed_units=1"):
+            ScrapeScheduler(context, socket, storage, concurrency=8, max_failed_units=1).run(units)
+
+
+class PricesErrorSocket(FakeSocket):
+    """Answers every request for the given sail codes with a PricesErrorResponseV2."""
+
+    def __init__(self, unpriced):
+        super().__init__()
+        self.unpriced = unpriced
+        self.requests = 0
+
+    def _reply(self, sail_code, adults, kids):
+        reply = super()._reply(sail_code, adults, kids)
+        if sail_code in self.unpriced:
+            return json.dumps({"requestId": f"{sail_code}-{adults}-{kids}", "type": "PricesErrorResponseV2"})
+        return reply
+
+    def submit(self, *args, **kwargs):
+        self.requests += 1
+        return super().submit(*args, **kwargs)
+
+
+def test_resumed_scrape_skips_units_that_only_got_error_replies():
+    FAKE_BLOB_STORES["resume-test"] = FakeBlobStore()
+    storage = FakeStorageAccountIoManager(account_name="resume-test", account_key="fake", container_name="landing-blob")
+    storage.setup_for_execution(build_init_resource_context())
+    units = [ScrapeUnit(action="prices-v2", sail_code=f"SC{i:03}", fare_code="Essential") for i in range(4)]
+
+    with build_op_context() as context:
+        ScrapeScheduler(context, PricesErrorSocket({"SC001", "SC002"}), storage, concurrency=8).run(units)
+        landed = storage.landed_blob_names(context, "silversea", "socket", filters={"action": "prices-v2"})
+        resumed_socket = PricesErrorSocket({"SC001", "SC002"})
+        resumed = ScrapeScheduler(context, resumed_socket, storage, concurrency=8, completed=landed)
+        resumed.run(units)
+    del FAKE_BLOB_STORES["resume-test"]
+
+    assert landed == {unit.blob_name for unit in units}
+    assert resumed.units_skipped == 4 and resumed_socket.requests == 0
+
+
+def test_store_sail_codes_file_fetches_pages_concurrently_by_default(tmp_path):
+    FAKE_BLOB_STORES["algolia-test"] = FakeBlobStore()
+    with FakeAlgoliaServer(recorded_hits(), latency=0.2) as server:
+        result = materialize(
+            [scrape.store_sail_codes_file],
+            instance=DagsterInstance.ephemeral(),
+            resources={
+                "io_manager": DuckDBArrowIOManager(database=str(tmp_path / "scraped.duckdb")),
+                "storage_account_io_manager": FakeStorageAccountIoManager(account_name="algolia-test", account_key="fake", container_name="landing-blob"),
+                # Only the connection settings, the limiter runs on its defaults
+                "algolia_api": AlgoliaAPI(algolia_url=server.url, algolia_api_key="fake", algolia_application_id="fake"),
+            },
+            run_config={"ops": {"store_sail_codes_file": {"config": {"hits_per_page": 1, "pages_per_request": 1}}}},
+        )
+    del FAKE_BLOB_STORES["algolia-test"]
+
+    assert result.success
+    assert server.requests == 10
+    assert server.peak_in_flight == scrape.AlgoliaConfig().max_parallel_requests
+
+
+def test_process_combination_scrapes_only_its_currency_and_ship_partition(tmp_path):
+    database = str(tmp_path / "scraped.duckdb")
+    with duckdb.connect(database) as conn:
+        conn.execute("create schema public")
+        conn.execute(
+            "create table public.store_sail_codes_file as select * from "
+            "(values ('WH260316C28', ['Essential']), ('SD240701C10', ['Essential', 'DoorToDoor'])) v(sail_code, fare_codes)"
+        )
+    socket = FakeSocket()
+    socket.throttle_metadata = lambda: {}
+    socket.cache_metadata = lambda: {}
+    socket.metrics_metadata = lambda: {}
+    storage = Mock(spec=StorageAccountIoManager)
+    storage.landed_blob_names.return_value = set()
+    storage.metrics_metadata.return_value = {}
+    instance = DagsterInstance.ephemeral()
+    instance.add_dynamic_partitions("ship_codes", ["SD", "WH"])
+
+    result = materialize(
+        [SourceAsset("store_sail_codes_file"), scrape.process_combination],
+        partition_key=MultiPartitionKey({"currency": "GB", "ship_code": "SD"}),
+        instance=instance,
+        resources={
+            "io_manager": DuckDBArrowIOManager(database=database),
+            "duckdb": DuckDBResource(database=database),
+            "websocket": socket,
+            "storage_account_io_manager": ResourceDefinition.hardcoded_resource(storage),
+        },
+    )
+
+    assert result.success
+    assert {call.kwargs["blob_name"] for call in storage.upload_blob.call_args_list} == {
+        "socket/sail_code=SD240701C10/action=prices-v2/currency=GB/fare_code=Essential/data",
+        "socket/sail_code=SD240701C10/action=prices-v2/currency=GB/fare_code=DoorToDoor/data",
+    }
+
+
+def test_process_combination_only_saves_fingerprints_of_sailings_that_landed(tmp_path):
+    database = str(tmp_path / "scraped.duckdb")
+    with duckdb.connect(database) as conn:
+        conn.execute("create schema public")
+        conn.execute(
+            "create table public.store_sail_codes_file as select * from "
+            "(values ('SD240701C10', ['Essential'], 'f1'), ('SD240801C11', ['Essential', 'DoorToDoor'], 'f2')) v(sail_code, fare_codes, fingerprint)"
+        )
+    socket = FakeSocket()
+    socket.throttle_metadata = lambda: {}
+    socket.cache_metadata = lambda: {}
+    socket.metrics_metadata = lambda: {}
+    storage = Mock(spec=StorageAccountIoManager)
+    storage.landed_blob_names.return_value = set()
+    storage.metrics_metadata.return_value = {}
+    # One of the second sailing's blobs doesn't land
+    storage.upload_blob.side_effect = lambda context, json_data, blob_name, competitor: "fare_code=DoorToDoor" not in blob_name
+    instance = DagsterInstance.ephemeral()
+    instance.add_dynamic_partitions("ship_codes", ["SD"])
+
+    result = materialize(
+        [SourceAsset("store_sail_codes_file"), scrape.process_combination],
+        partition_key=MultiPartitionKey({"currency": "US", "ship_code": "SD"}),
+        instance=instance,
+        resources={
+            "io_manager": DuckDBArrowIOManager(database=database),
+            "duckdb": DuckDBResource(database=database),
+            "websocket": socket,
+            "storage_account_io_manager": ResourceDefinition.hardcoded_resource(storage),
+        },
+        run_config={"ops": {"process_combination": {"config": {"incremental": True}}}},
+    )
+
+    assert result.success
+    assert set(load_fingerprints(DuckDBResource(database=database), "US")) == {"SD240701C10"}
+    materialization = result.asset_materializations_for_node("process_combination")[0]
+    assert materialization.metadata["units_failed"].value == 1
+
+
+def test_dbt_manifest_is_only_parsed_again_when_the_project_changes(tmp_path):
+    (tmp_path / "dbt_project.yml").write_text("name: test")
+    (tmp_path / "models").mkdir()
+    (tmp_path / "models" / "stg.sql").write_text("select 1")
+    parse_target = tmp_path / "target" / "run"
+    parse_target.mkdir(parents=True)
+
+    def parse(args):
+        parse_target.mkdir(exist_ok=True)
+        (parse_target / "manifest.json").write_text("{}")
+        return Mock(wait=Mock(return_value=Mock(target_path=parse_target)))
+
+    dbt_resource = Mock()
+    dbt_resource.cli.side_effect = parse
+
+    assert cached_manifest_path(dbt_resource, str(tmp_path)).read_text() == "{}"
+    cached_manifest_path(dbt_resource, str(tmp_path))
+    assert dbt_resource.cli.call_count == 1
+
+    assert LOAD_METADATA["dbt_manifest_parsed"] == 0
+
+    (tmp_path / "models" / "stg.sql").write_text("select 2")
+    cached_manifest_path(dbt_resource, str(tmp_path))
+    assert dbt_resource.cli.call_count == 2
+    assert LOAD_METADATA["dbt_manifest_parsed"] == 1
+
+    # Installing or upgrading a package changes the manifest too
+    (tmp_path / "dbt_packages" / "dbt_utils" / "macros").mkdir(parents=True)
+    (tmp_path / "dbt_packages" / "dbt_utils" / "macros" / "star.sql").write_text("{% macro star() %}{% endmacro %}")
+    cached_manifest_path(dbt_resource, str(tmp_path))
+    assert dbt_resource.cli.call_count == 3
+
+
+def test_definitions_are_only_built_when_dagster_asks_for_them():
+    code = (
+        "import sys, dagster_etl\n"
+        "from dagster._core.workspace.autodiscovery import loadable_targets_from_loaded_module\n"
+        "assert 'dagster_dbt' not in sys.modules\n"
+        "[target] = loadable_targets_from_loaded_module(dagster_etl)\n"
+        "assert target.attribute == 'defs' and target.target_definition is dagster_etl.defs\n"
+        "assert dagster_etl.LOAD_METADATA['definitions_load_seconds'] > 0\n"
     )
+    subprocess.run([sys.executable, "-c", code], check=True, capture_output=True)
+
+
+def test_synthetic_landing_files_parse_like_scraped_ones(tmp_path):
+    sailings = synthetic.generate_sailings(30, seed=1)
+    assert len({sailings.sail_code(index) for index in range(len(sailings))}) == 30
+
+    sail_codes = silversea.process_sail_code_json_data(list(synthetic.algolia_pages(sailings, hits_per_page=20)), "2024-06-20")
+    assert len(sail_codes) == 30
+    assert set(sail_codes["ship_code"].to_pylist()) <= set(sailings.categories)
+
+    counts = synthetic.write_landing(str(tmp_path), sailings, datetime(2024, 6, 20), landing_format="json.gz", max_units=5)
+    with open(tmp_path / "silversea/2024/06/20/_manifest/socket.ndjson") as manifest:
+        entries = [json.loads(line) for line in manifest]
+    assert len(entries) == 5 and counts["files"] == 1 + 5
+    assert all(entry["action"] == "prices-v2" and entry["blob"].endswith("/data.json.gz") for entry in entries)
+
+    parser = silversea.PricesParser("2024-06-20")
+    for _, messages in itertools.islice(synthetic.price_units(sailings), 5):
+        for message in messages:
+            parser.add(message)
+    unavailable, available = parser.frames()
+    assert parser.messages == counts["messages"]
+    assert len(unavailable) + len(available) == counts["rows"]
+
+
+def _run_dbt_models(tmp_path, database: str, models: list) -> None:
+    """Runs `models` of a copy of the dbt project against `database`."""
+    from dbt.cli.main import dbtRunner
+
+    project_dir = tmp_path / "dbt_project"
+    shutil.copytree(DBT_PROJECT_DIR, project_dir, ignore=shutil.ignore_patterns("target", "logs", "dbt_packages", "*.duckdb"))
+    (project_dir / "profiles.yml").write_text(
+        f"dbt_project:\n  target: local\n  outputs:\n    local:\n      type: duckdb\n      path: {database}\n      schema: public\n"
+    )
+    result = dbtRunner().invoke([
+        "run", "--select", *models, "--project-dir", str(project_dir), "--profiles-dir", str(project_dir),
+        "--target-path", str(project_dir / "target"), "--log-path", str(project_dir / "logs"),
+    ])
+    assert result.success, result.exception
+
+
+def test_dbt_staging_models_match_the_python_parsers(tmp_path):
+    # The source tables live in the scraped database, so the file name matters
+    database = str(tmp_path / "scraped.duckdb")
+    algolia = load_example("scrape_sail_codes.json")
+    messages = _price_messages()
+    store = FakeBlobStore()
+    store._put("silversea/2024/06/20/algolia/0.json", "".join(json.dumps(page) + "\n" for page in algolia).encode("utf-8"))
+    for i, message in enumerate(messages):
+        store._put(f"silversea/2024/06/20/socket/sail_code=SC{i}/action=prices-v2/currency=US/fare_code=Essential.json", (json.dumps(message) + "\n").encode("utf-8"))
+    FAKE_BLOB_STORES["dbt-test"] = store
+
+    result = materialize(
+        [silversea_duckdb.raw_algolia_results, silversea_duckdb.raw_socket_prices],
+        partition_key="2024-06-20",
+        resources={
+            "duckdb": DuckDBResource(database=database),
+            "storage_account_io_manager": FakeStorageAccountIoManager(account_name="dbt-test", account_key="fake", container_name="landing-blob"),
+        },
+    )
+    del FAKE_BLOB_STORES["dbt-test"]
+    assert result.success
+    _run_dbt_models(tmp_path, database, ["stg_sail_codes", "stg_unavailable_cabins", "stg_available_cabins"])
+
+    parser = silversea.PricesParser("2024/06/20")
+    for message in messages:
+        parser.add(message)
+    unavailable, available = parser.tables()
+    expected = {
+        "stg_sail_codes": (SailCode, silversea.process_sail_code_json_data(algolia, "2024/06/20")),
+        "stg_unavailable_cabins": (UnavailableCabin, unavailable),
+        "stg_available_cabins": (AvailableCabin, available),
+    }
+
+    def rows(table):
+        return sorted(table.to_pylist(), key=lambda row: json.dumps(row, sort_keys=True))
+
+    with duckdb.connect(database) as conn:
+        for model, (record_type, table) in expected.items():
+            columns = conn.execute(
+                "select column_name, data_type from information_schema.columns where table_name = ? order by ordinal_position", [model]
+            ).fetchall()
+            assert {name: data_type.replace('"', "") for name, data_type in columns} == duckdb_columns(record_type)
+            assert table.num_rows > 0
+            assert rows(conn.execute(f"select * from public.{model}").fetch_arrow_table()) == rows(table)
+
+
+def test_staged_tables_keep_the_schema_types_in_every_partition(tmp_path):
+    database = str(tmp_path / "staged.duckdb")
+    with open(os.path.join(os.path.dirname(__file__), "examples", "scrape_sail_codes.json")) as file:
+        algolia = json.load(file)
+    # Every optional field of the hit is missing, pandas would have inferred other types from it
+    sparse = {"results": [{"hits": [{"cruiseCode": "MO240523017"}]}]}
+
+    for partition_key, sail_codes, messages in [("2024-06-20", algolia, _price_messages()), ("2024-06-21", sparse, [])]:
+        storage = Mock(spec=StorageAccountIoManager)
+        storage.iter_blobs_from_path.side_effect = lambda *args, path=None, **kwargs: iter(messages if path else [sail_codes])
+        storage.cache_metadata.return_value = {}
+        storage.metrics_metadata.return_value = {}
+        result = materialize(
+            [silversea.sail_codes, silversea.silversea_cabin_prices],
+            partition_key=partition_key,
+            resources={"io_manager": DuckDBArrowIOManager(database=database), "storage_account_io_manager": ResourceDefinition.hardcoded_resource(storage)},
+        )
+        assert result.success
 
-    # Assert that the "ships" element exists in the result
-    pd.testing.assert_frame_equal(result, pandas_df, check_dtype=False)
+    with duckdb.connect(database) as conn:
+        for table, record_type in [("sail_codes", SailCode), ("unavailable_cabins", UnavailableCabin), ("available_cabins", AvailableCabin)]:
+            columns = conn.execute(
+                "select column_name, data_type from information_schema.columns where table_name = ? order by ordinal_position", [table]
+            ).fetchall()
+            assert {name: data_type.replace('"', "") for name, data_type in columns} == duckdb_columns(record_type)
+        assert conn.execute("select count(*) from public.sail_codes where extract_date = '2024/06/21'").fetchone()[0] == 1
@@ -0,0 +1,325 @@
+"""Local stand-ins for Silversea, Algolia and Azure blob storage.
+
+They replay the recorded responses in `examples/` with configurable latency and error rates,
+so the scraping and staging assets can be run and benchmarked without the network.
+"""
+import asyncio
+import copy
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError, ResourceNotModifiedError, ServiceResponseError
+from websockets.asyncio.server import serve
+
+from dagster_etl.resources import StorageAccountIoManager
+from dagster_etl.resources.websocket_multiplexer import BackgroundEventLoop
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), "examples")
+
+
+def load_example(name: str) -> List[dict]:
+    """The JSON documents of an example file, some of them hold several one after the other."""
+    with open(os.path.join(EXAMPLES_DIR, name), "r") as file:
+        text = file.read()
+    decoder, documents, index = json.JSONDecoder(), [], 0
+    while index < len(text):
+        if text[index].isspace():
+            index += 1
+            continue
+        document, index = decoder.raw_decode(text, index)
+        documents.append(document)
+    return documents
+
+
+def recorded_hits(copies: int = 1) -> List[dict]:
+    """The recorded Algolia hits, repeated `copies` times with distinct sail codes."""
+    hits = load_example("scrape_sail_codes.json")[0]["results"][0]["hits"]
+    replicated = []
+    for copy_number in range(copies):
+        for hit in hits:
+            hit = copy.deepcopy(hit)
+            if copy_number:
+                hit["cruiseCode"] = f"{hit['cruiseCode']}-{copy_number}"
+            replicated.append(hit)
+    return replicated
+
+
+class FakeSilverseaServer:
+    """WebSocket server speaking the prices-v2 / available-suites protocol.
+
+    Replies are the recorded prices message with the request's ids filled in. `error_rate` of
+    the requests get a PricesErrorResponseV2 and `drop_rate` of them close the connection
+    without a reply, which the client has to replay on another socket.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, drop_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._prices = load_example("sail_code_prices.json")[0]
+        self._loop: Optional[BackgroundEventLoop] = None
+        self._server = None
+        self.url = ""
+
+    def reply(self, request: dict) -> Optional[str]:
+        roll = self._random.random()
+        if roll < self.drop_rate:
+            return None
+        data = request["data"]
+        if roll < self.drop_rate + self.error_rate:
+            return json.dumps({"requestId": request["requestId"], "action": request["action"], "type": "PricesErrorResponseV2", "data": {}})
+        if request["action"] == "available-suites":
+            suites = [{"suiteNumber": f"{data['suiteCategory']}{number}", "suiteCategory": data["suiteCategory"]} for number in range(3)]
+            return json.dumps({"requestId": request["requestId"], "action": "available-suites", "type": "SuitesResponse", "suites": suites})
+
+        message = copy.deepcopy(self._prices)
+        message["requestId"] = request["requestId"]
+        for price in message["data"]["prices"]:
+            quote = price["right"] if price["_tag"] == "Right" else price["left"]["request"]
+            quote["cruiseCode"] = data["cruiseCode"]
+            quote["fareCode"] = data["fareCode"]
+            quote["occupancy"] = dict(data["occupancy"])
+        return json.dumps(message)
+
+    async def _handler(self, websocket):
+        async def answer(message):
+            self.requests += 1
+            await asyncio.sleep(self.latency)
+            reply = self.reply(json.loads(message))
+            if reply is None:
+                await websocket.close()
+                return
+            await websocket.send(reply)
+
+        tasks = set()
+        try:
+            async for message in websocket:
+                task = asyncio.create_task(answer(message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def __enter__(self) -> "FakeSilverseaServer":
+        self._loop = BackgroundEventLoop(name="fake-silversea")
+
+        async def start():
+            return await serve(self._handler, "127.0.0.1", 0, max_size=None)
+
+        self._server = self._loop.run(start())
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"ws://127.0.0.1:{port}/"
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        async def stop():
+            self._server.close()
+            await self._server.wait_closed()
+
+        self._loop.run(stop())
+        self._loop.stop()
+
+
+class FakeAlgoliaServer:
+    """HTTP server answering Algolia's /1/indexes/*/queries multi-query endpoint.
+
+    Every query gets the page of `hits` it asks for. `error_rate` of the requests are answered
+    with a 503, which the client retries. `peak_in_flight` is the most requests it was serving at once.
+    """
+
+    def __init__(self, hits: List[dict], latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.hits = hits
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self.url = ""
+
+    def page(self, query: dict) -> dict:
+        params = {key: values[0] for key, values in parse_qs(query["params"]).items()}
+        hits_per_page = int(params.get("hitsPerPage", 20))
+        page = int(params.get("page", 0))
+        return {
+            "hits": self.hits[page * hits_per_page:(page + 1) * hits_per_page],
+            "nbHits": len(self.hits),
+            "nbPages": -(-len(self.hits) // hits_per_page),
+            "page": page,
+            "hitsPerPage": hits_per_page,
+        }
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                with fake._lock:
+                    fake.requests += 1
+                    fake.in_flight += 1
+                    fake.peak_in_flight = max(fake.peak_in_flight, fake.in_flight)
+                    failed = fake._random.random() < fake.error_rate
+                time.sleep(fake.latency)
+                with fake._lock:
+                    fake.in_flight -= 1
+                if failed or self.path != "/1/indexes/*/queries":
+                    self.send_response(503 if failed else 404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                results = [fake.page(query) for query in json.loads(body)["requests"]]
+                data = json.dumps({"results": results}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def __enter__(self) -> "FakeAlgoliaServer":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeBlobStore:
+    """In-memory stand-in for the parts of BlobServiceClient that StorageAccountIoManager uses.
+
+    Blobs carry ETags and append blobs are supported, so the manifest, the conditional
+    downloads of the blob cache and the listing fallback all behave as against Azure.
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed: int = 0, chunk_size: int = 64 * 1024, max_append_blocks: int = 50_000):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.max_append_blocks = max_append_blocks
+        self.blobs: Dict[str, bytes] = {}
+        self.append_blocks: Dict[str, int] = {}
+        # Blobs whose downloads always fail
+        self.broken: set = set()
+        self.etags: Dict[str, str] = {}
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _io(self) -> None:
+        time.sleep(self.latency)
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+        if failed:
+            raise ServiceResponseError("Injected blob storage error")
+
+    def _put(self, name: str, data: bytes) -> None:
+        with self._lock:
+            self.blobs[name] = data
+            self.etags[name] = hashlib.md5(data).hexdigest()
+
+    def get_container_client(self, container_name: str) -> "_FakeContainer":
+        return _FakeContainer(self)
+
+
+class _FakeContainer:
+    def __init__(self, store: FakeBlobStore):
+        self.store = store
+
+    def get_blob_client(self, blob_name: str) -> "_FakeBlob":
+        return _FakeBlob(self.store, blob_name)
+
+    def list_blobs(self, name_starts_with: str = ""):
+        with self.store._lock:
+            names = sorted(name for name in self.store.blobs if name.startswith(name_starts_with))
+        return [SimpleNamespace(name=name) for name in names]
+
+
+class _FakeBlob:
+    def __init__(self, store: FakeBlobStore, name: str):
+        self.store = store
+        self.name = name
+
+    def exists(self) -> bool:
+        return self.name in self.store.blobs
+
+    def upload_blob(self, data, overwrite: bool = False) -> None:
+        self.store._io()
+        data = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+        if not overwrite and self.exists():
+            raise ResourceExistsError(f"{self.name} already exists")
+        self.store._put(self.name, data)
+        self.store.bytes_uploaded += len(data)
+
+    def create_append_blob(self, etag=None, match_condition=None) -> None:
+        if match_condition == MatchConditions.IfMissing and self.exists():
+            raise ResourceExistsError(f"{self.name} already exists")
+        self.store._put(self.name, b"")
+        self.store.append_blocks[self.name] = 0
+
+    def append_block(self, data) -> dict:
+        data = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+        with self.store._lock:
+            if self.name not in self.store.blobs:
+                raise ResourceNotFoundError(f"{self.name} does not exist")
+            if self.store.append_blocks[self.name] >= self.store.max_append_blocks:
+                error = HttpResponseError(message=f"{self.name} has {self.store.max_append_blocks} blocks")
+                error.error_code = "BlockCountExceedsLimit"
+                raise error
+            self.store.blobs[self.name] += data
+            self.store.etags[self.name] = hashlib.md5(self.store.blobs[self.name]).hexdigest()
+            self.store.append_blocks[self.name] += 1
+            return {"blob_committed_block_count": self.store.append_blocks[self.name]}
+
+    def download_blob(self, etag=None, match_condition=None):
+        self.store._io()
+        if self.name in self.store.broken:
+            raise ServiceResponseError(f"Injected error downloading {self.name}")
+        with self.store._lock:
+            if self.name not in self.store.blobs:
+                raise ResourceNotFoundError(f"{self.name} does not exist")
+            data, current_etag = self.store.blobs[self.name], self.store.etags[self.name]
+        if match_condition == MatchConditions.IfModified and etag == current_etag:
+            raise ResourceNotModifiedError(f"{self.name} not modified")
+        self.store.bytes_downloaded += len(data)
+        chunk_size = self.store.chunk_size
+        return SimpleNamespace(
+            properties=SimpleNamespace(etag=current_etag),
+            readall=lambda: data,
+            chunks=lambda: iter([data[offset:offset + chunk_size] for offset in range(0, len(data), chunk_size)] or [b""]),
+        )
+
+
+# account_name -> store, FakeStorageAccountIoManager is rebuilt for every run so the store lives here
+FAKE_BLOB_STORES: Dict[str, FakeBlobStore] = {}
+
+
+class FakeStorageAccountIoManager(StorageAccountIoManager):
+    """StorageAccountIoManager talking to the FakeBlobStore registered for its account_name."""
+
+    def setup_for_execution(self, context) -> None:
+        super().setup_for_execution(context)
+        self._blob_service_client = FAKE_BLOB_STORES[self.account_name]
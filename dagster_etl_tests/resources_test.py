@@ -0,0 +1,630 @@
+import asyncio
+import gzip
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import duckdb
+import pyarrow as pa
+import pytest
+from azure.core.exceptions import ServiceResponseError
+from dagster import StaticPartitionsDefinition, asset, build_init_resource_context, build_op_context, materialize
+from dagster_duckdb import DuckDBResource
+from websockets.asyncio.server import serve
+from websockets.exceptions import InvalidStatus
+
+from dagster_etl.resources import AlgoliaAPI, DuckDBArrowIOManager, LazyDuckDBTable
+from dagster_etl.resources.blob_cache import BlobCache
+from dagster_etl.resources.response_cache import ResponseCache
+from dagster_etl.resources.socket_responses import is_negative_response, request_id, response_outcome
+from dagster_etl.resources.storage_account_io_manager import LANDING_FORMATS, decode_landing_chunks, encode_landing, iter_ndjson_batches, manifest_name
+from dagster_etl.utils.metrics import RequestMetrics
+from dagster_etl.utils.rate_limiter import AdaptiveRateLimiter, OK, THROTTLED
+from dagster_etl.resources.websocket_multiplexer import BackgroundEventLoop, MultiplexedWebSocket, WebSocketPool
+
+from .fakes import FAKE_BLOB_STORES, FakeBlobStore, FakeStorageAccountIoManager
+
+
+async def _echo_out_of_order(websocket):
+    # Reply to every message after a random delay so replies overtake each other
+    async def reply(message):
+        await asyncio.sleep(random.uniform(0, 0.05))
+        request = json.loads(message)
+        await websocket.send(json.dumps({"requestId": request["requestId"], "data": request["data"]}))
+
+    tasks = []
+    async for message in websocket:
+        tasks.append(asyncio.create_task(reply(message)))
+    await asyncio.gather(*tasks)
+
+
+def _drop_first_connection():
+    dropped = []
+
+    async def handler(websocket):
+        # The first connection dies while it has requests in flight
+        if not dropped:
+            dropped.append(websocket)
+            await websocket.recv()
+            await websocket.close()
+            return
+        await _echo_out_of_order(websocket)
+
+    return handler
+
+
+def _ignore_first_message():
+    ignored = []
+
+    async def handler(websocket):
+        # The first request never gets a reply, the connection stays up
+        async for message in websocket:
+            if not ignored:
+                ignored.append(message)
+                continue
+            request = json.loads(message)
+            await websocket.send(json.dumps({"requestId": request["requestId"], "data": request["data"]}))
+
+    return handler
+
+
+def _reject_handshakes(rejections: list):
+    def process_request(connection, request):
+        # While there are rejections left, upgrades are refused like a busy server would
+        if rejections:
+            rejections.pop()
+            return connection.respond(HTTPStatus.SERVICE_UNAVAILABLE, "busy\n")
+
+    return process_request
+
+
+async def _start_server(handler, **kwargs):
+    return await serve(handler, "127.0.0.1", 0, **kwargs)
+
+
+def _serve(handler, **kwargs):
+    loop = BackgroundEventLoop()
+    server = loop.run(_start_server(handler, **kwargs))
+    port = server.sockets[0].getsockname()[1]
+    yield f"ws://127.0.0.1:{port}"
+    server.close()
+    loop.run(server.wait_closed())
+    loop.stop()
+
+
+@pytest.fixture
+def websocket_url():
+    yield from _serve(_echo_out_of_order)
+
+
+@pytest.fixture
+def flaky_websocket_url():
+    yield from _serve(_drop_first_connection())
+
+
+def test_multiplexed_websocket_routes_replies_by_request_id(websocket_url):
+    loop = BackgroundEventLoop()
+    connection = MultiplexedWebSocket(websocket_url, max_in_flight=5)
+    loop.run(connection.connect())
+
+    futures = {
+        str(i): loop.submit(connection.request({"requestId": str(i), "data": i}))
+        for i in range(50)
+    }
+    for request_id, future in futures.items():
+        assert json.loads(future.result(timeout=10))["data"] == int(request_id)
+
+    assert connection.in_flight == 0
+    loop.run(connection.close())
+    loop.stop()
+
+
+def test_websocket_pool_replays_requests_from_dropped_connection(flaky_websocket_url):
+    loop = BackgroundEventLoop()
+    pool = WebSocketPool(flaky_websocket_url, size=2, max_in_flight=5, reconnect_backoff=0.01)
+    loop.run(pool.connect())
+
+    futures = [loop.submit(pool.request({"requestId": str(i), "data": i})) for i in range(20)]
+    assert [json.loads(future.result(timeout=10))["data"] for future in futures] == list(range(20))
+    assert pool.replays > 0
+
+    loop.run(pool.close())
+    loop.stop()
+
+
+def test_websocket_pool_replays_requests_that_timed_out():
+    urls = _serve(_ignore_first_message())
+    url = next(urls)
+    loop = BackgroundEventLoop()
+    pool = WebSocketPool(url, size=1, max_in_flight=5, request_timeout=0.2, max_replays=1)
+    loop.run(pool.connect())
+
+    futures = [loop.submit(pool.request({"requestId": str(i), "data": i})) for i in range(3)]
+    assert [json.loads(future.result(timeout=10))["data"] for future in futures] == [0, 1, 2]
+    assert pool.timeouts == 1 and pool.replays == 1 and pool.reconnects == 0
+
+    loop.run(pool.close())
+    loop.stop()
+    next(urls, None)
+
+
+def test_websocket_pool_keeps_reconnecting_when_handshakes_are_rejected():
+    rejections = []
+    urls = _serve(_drop_first_connection(), process_request=_reject_handshakes(rejections))
+    url = next(urls)
+    loop = BackgroundEventLoop()
+    pool = WebSocketPool(url, size=2, max_in_flight=5, reconnect_backoff=0.01)
+    loop.run(pool.connect())
+    rejections.extend([None, None])
+
+    futures = [loop.submit(pool.request({"requestId": str(i), "data": i})) for i in range(10)]
+    assert [json.loads(future.result(timeout=10))["data"] for future in futures] == list(range(10))
+    # The other connection served everything meanwhile, the dropped slot still came back
+    deadline = time.monotonic() + 10
+    while pool.reconnects == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pool.reconnects == 1 and pool.reconnect_failures == 2
+    assert isinstance(pool.last_reconnect_error, InvalidStatus)
+    assert all(connection.is_open for connection in pool._connections)
+
+    loop.run(pool.close())
+    loop.stop()
+    next(urls, None)
+
+
+def test_websocket_pool_health_check_survives_pings_that_raise(websocket_url):
+    loop = BackgroundEventLoop()
+    pool = WebSocketPool(websocket_url, size=2, health_check_interval=0.01, reconnect_backoff=0.01)
+    loop.run(pool.connect())
+
+    async def broken_ping(timeout):
+        raise RuntimeError("ping failed")
+
+    pool._connections[0].ping = broken_ping
+    deadline = time.monotonic() + 10
+    while pool.reconnects == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pool.reconnects == 1 and not pool._health_check.done()
+
+    loop.run(pool.close())
+    loop.stop()
+
+
+def test_adaptive_rate_limiter_increases_when_healthy_and_backs_off_on_errors():
+    limiter = AdaptiveRateLimiter(rate=1000.0, max_rate=2000.0, concurrency=2, window=5, target_latency=0.5)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(0.1, OK)
+    assert limiter.rate == 1002.0
+    assert limiter.concurrency == 4
+
+    limiter.acquire()
+    limiter.release(0.1, THROTTLED)
+    assert limiter.rate == 501.0
+    assert limiter.concurrency == 2
+    assert limiter.metadata("test")["test_throttled"] == 1
+
+
+def test_adaptive_rate_limiter_wakes_waiters_on_release_instead_of_polling(monkeypatch):
+    limiter = AdaptiveRateLimiter(rate=1000.0, max_rate=1000.0, concurrency=2, window=1000)
+    checks = []
+    try_acquire = limiter._try_acquire
+    monkeypatch.setattr(limiter, "_try_acquire", lambda: checks.append(1) or try_acquire())
+    limiter.acquire()
+    limiter.acquire()
+
+    loop = BackgroundEventLoop()
+    waiters = [loop.submit(limiter.acquire_async()) for _ in range(2)]
+    # A cancelled waiter doesn't swallow the slot it would have been woken for
+    cancelled = loop.submit(limiter.acquire_async())
+    time.sleep(0.1)
+    cancelled.cancel()
+    blocked = Future()
+    threading.Thread(target=lambda: blocked.set_result(limiter.acquire())).start()
+    time.sleep(0.1)
+    assert not any(waiter.done() for waiter in waiters) and not blocked.done()
+    assert len(checks) == 5
+
+    for _ in range(3):
+        limiter.release(0.01, OK)
+    for waiter in waiters:
+        waiter.result(timeout=5)
+    blocked.result(timeout=5)
+    assert limiter.in_flight == 2 and len(checks) < 15
+    loop.stop()
+
+
+class _GzipQueriesHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        body = gzip.compress(json.dumps({"results": [{"hits": [], "query": request}]}).encode())
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_algolia_api_decompresses_concurrent_responses():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _GzipQueriesHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    algolia_api = AlgoliaAPI(
+        algolia_url=f"http://127.0.0.1:{server.server_address[1]}",
+        algolia_api_key="key",
+        algolia_application_id="app",
+        initial_rate=1000.0,
+        max_rate=1000.0,
+    )
+    algolia_api.setup_for_execution(build_init_resource_context())
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: algolia_api.query(json.dumps({"page": i})), range(32)))
+
+    assert [result["results"][0]["query"]["page"] for result in results] == list(range(32))
+    response = algolia_api.request("POST", "/1/indexes/*/queries", json.dumps({"page": 0}))
+    assert response.status == 200 and json.loads(response.read())["results"][0]["hits"] == []
+    algolia_api.teardown_after_execution(build_init_resource_context())
+    server.shutdown()
+
+
+def test_iter_ndjson_batches_handles_records_split_across_chunks():
+    data = b"".join(json.dumps({"i": i, "text": "x" * i}).encode() + b"\n" for i in range(100)) + b"not json\n"
+    chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+    errors = []
+
+    records = [record for batch in iter_ndjson_batches(chunks, errors.append) for record in batch]
+
+    assert [record["i"] for record in records] == list(range(100))
+    assert len(errors) == 1
+
+
+def test_blob_cache_revalidates_by_etag_and_evicts_least_recently_used(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=25, use_mmap=True)
+    remote = {"a": ("etag-1", b"0123456789"), "b": ("etag-1", b"abcdefghij")}
+
+    def fetcher(name):
+        def fetch(cached_etag):
+            etag, data = remote[name]
+            return None if cached_etag == etag else (etag, [data[:4], data[4:]])
+        return fetch
+
+    assert b"".join(cache.get_or_fetch("a", fetcher("a"))) == b"0123456789"
+    assert b"".join(cache.get_or_fetch("a", fetcher("a"))) == b"0123456789"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    remote["a"] = ("etag-2", b"9876543210")
+    assert b"".join(cache.get_or_fetch("a", fetcher("a"))) == b"9876543210"
+    assert cache.cached_etag("a") == "etag-2"
+
+    b"".join(cache.get_or_fetch("b", fetcher("b")))
+    assert cache.cached_etag("b") == "etag-1"
+    assert len(list(tmp_path.glob("*.blob"))) == 2
+
+
+def test_blob_cache_counts_each_entry_once_when_it_is_rewritten(tmp_path):
+    cache = BlobCache(str(tmp_path), max_bytes=1000)
+
+    def fetch(etag, data):
+        return lambda cached_etag: (etag, [data])
+
+    for _ in range(3):
+        b"".join(cache.get_or_fetch("a", fetch("etag-1", b"0123456789")))
+    b"".join(cache.get_or_fetch("a", fetch("etag-2", b"01234")))
+
+    assert cache._size == 5
+    assert [path.stat().st_size for path in tmp_path.glob("*.blob")] == [5]
+    assert (cache.hits, cache.misses) == (0, 4)
+
+
+@pytest.mark.parametrize("landing_format", LANDING_FORMATS)
+def test_landing_formats_round_trip_in_chunks(landing_format):
+    if landing_format == "json.zst":
+        pytest.importorskip("zstandard")
+    data = "".join(json.dumps({"i": i}) + "\n" for i in range(1000))
+    encoded = encode_landing(data, landing_format)
+    chunks = [encoded[i:i + 100] for i in range(0, len(encoded), 100)]
+
+    decoded = b"".join(decode_landing_chunks(f"socket/data.{landing_format}", chunks))
+
+    assert decoded == data.encode("utf-8")
+
+
+@pytest.fixture
+def blob_store():
+    FAKE_BLOB_STORES["resources-test"] = FakeBlobStore(max_append_blocks=3)
+    yield FAKE_BLOB_STORES["resources-test"]
+    del FAKE_BLOB_STORES["resources-test"]
+
+
+@pytest.fixture
+def storage(blob_store):
+    storage = FakeStorageAccountIoManager(account_name="resources-test", account_key="fake", container_name="landing-blob")
+    storage.setup_for_execution(build_init_resource_context())
+    return storage
+
+
+def _socket_blob(sail_code: str, currency: str = "US") -> str:
+    return f"socket/sail_code={sail_code}/action=prices-v2/currency={currency}/fare_code=Essential/adults=2/kids=0"
+
+
+def test_manifest_lists_landed_blobs_across_segments(storage, blob_store):
+    with build_op_context() as context:
+        for i in range(8):
+            storage.upload_blob(context, "{}", _socket_blob(f"SC{i}", "US" if i % 2 else "GB"), "silversea")
+        day = next(name for name in blob_store.blobs if "/socket/" in name).split("/socket/")[0]
+        # Only the manifest is read, a blob it doesn't list isn't returned
+        blob_store._put(f"{day}/socket/sail_code=XX/action=prices-v2/currency=US/fare_code=Essential/adults=2/kids=0.json", b"{}")
+
+        landed = storage.landed_blob_names(context, "silversea", "socket", filters={"currency": "US"})
+
+    assert landed == {_socket_blob(f"SC{i}") for i in range(1, 8, 2)}
+    segments = [name for name in blob_store.blobs if "/_manifest/" in name]
+    assert sorted(segments) == sorted(manifest_name(f"{day}/socket", segment) for segment in range(len(segments)))
+    assert len(segments) > 1 and all(blob_store.append_blocks[name] <= 3 for name in segments)
+
+
+def test_incomplete_manifest_falls_back_to_listing_the_prefix(storage, blob_store):
+    with build_op_context() as context:
+        storage.upload_blob(context, "{}", _socket_blob("SC0"), "silversea")
+        day = next(name for name in blob_store.blobs if "/socket/" in name).split("/socket/")[0]
+        blob_store._put(f"{day}/socket/sail_code=SC1/action=prices-v2/currency=US/fare_code=Essential/adults=2/kids=0.json", b"{}")
+        blob_store._put(f"{day}/socket_archive/sail_code=SC2/action=prices-v2/currency=US/fare_code=Essential/adults=2/kids=0.json", b"{}")
+        blob_store._put(manifest_name(f"{day}/socket") + ".incomplete", b"")
+
+        landed = storage.landed_blob_names(context, "silversea", "socket", filters={"action": "prices-v2"})
+
+    assert landed == {_socket_blob("SC0"), _socket_blob("SC1")}
+
+
+def test_failed_manifest_append_marks_the_manifest_incomplete(storage, blob_store, monkeypatch):
+    def fail(self, data):
+        raise ConnectionError("append failed")
+
+    with build_op_context() as context:
+        storage.upload_blob(context, "{}", _socket_blob("SC0"), "silversea")
+        monkeypatch.setattr(type(blob_store.get_container_client("").get_blob_client("")), "append_block", fail)
+        storage.upload_blob(context, "{}", _socket_blob("SC1"), "silversea")
+
+        landed = storage.landed_blob_names(context, "silversea", "socket")
+
+    assert any(name.endswith(".incomplete") for name in blob_store.blobs)
+    assert landed == {_socket_blob("SC0"), _socket_blob("SC1")}
+
+
+class Killed(BaseException):
+    pass
+
+
+def test_blobs_of_a_run_killed_before_the_manifest_append_are_still_listed(storage, blob_store, monkeypatch):
+    blob_type = type(blob_store.get_container_client("").get_blob_client(""))
+    upload = blob_type.upload_blob
+
+    def upload_then_die(self, data, overwrite=False):
+        upload(self, data, overwrite=overwrite)
+        raise Killed()
+
+    def die(self, data, overwrite=False):
+        raise Killed()
+
+    with build_op_context() as context:
+        storage.upload_blob(context, "{}", _socket_blob("SC0"), "silversea")
+        monkeypatch.setattr(blob_type, "upload_blob", upload_then_die)
+        with pytest.raises(Killed):
+            storage.upload_blob(context, "{}", _socket_blob("SC1"), "silversea")
+        # Killed before the blob got there, nothing to list
+        monkeypatch.setattr(blob_type, "upload_blob", die)
+        with pytest.raises(Killed):
+            storage.upload_blob(context, "{}", _socket_blob("SC2"), "silversea")
+        monkeypatch.setattr(blob_type, "upload_blob", upload)
+
+        resumed = FakeStorageAccountIoManager(account_name="resources-test", account_key="fake", container_name="landing-blob")
+        resumed.setup_for_execution(build_init_resource_context())
+        landed = resumed.landed_blob_names(context, "silversea", "socket")
+
+    assert not any(name.endswith(".incomplete") for name in blob_store.blobs)
+    assert landed == {_socket_blob("SC0"), _socket_blob("SC1")}
+
+
+def _put_ndjson_blobs(blob_store, count: int, records: int) -> list:
+    names = [f"silversea/2024/06/20/socket/sail_code=SC{i}/action=prices-v2/fare_code=Essential.json" for i in range(count)]
+    for i, name in enumerate(names):
+        blob_store._put(name, "".join(json.dumps({"blob": i, "i": j}) + "\n" for j in range(records)).encode("utf-8"))
+    return names
+
+
+def test_iter_blobs_from_path_keeps_the_order_within_each_blob(storage, blob_store):
+    blob_store.chunk_size = 64
+    _put_ndjson_blobs(blob_store, 5, 50)
+
+    with build_op_context() as context:
+        records = list(storage.iter_blobs_from_path(context, "silversea/2024/06/20/socket", max_concurrency=3))
+        # One blob at a time, the blobs come in listing order too
+        sequential = list(storage.iter_blobs_from_path(context, "silversea/2024/06/20/socket", max_concurrency=1))
+
+    assert len(records) == 250
+    for blob in range(5):
+        assert [record["i"] for record in records if record["blob"] == blob] == list(range(50))
+    assert [(record["blob"], record["i"]) for record in sequential] == [(blob, i) for blob in range(5) for i in range(50)]
+
+
+def test_iter_blobs_from_path_stops_its_workers_when_the_consumer_stops(storage, blob_store):
+    # Tiny chunks fill the bounded queue long before the consumer is done
+    blob_store.chunk_size = 16
+    _put_ndjson_blobs(blob_store, 8, 200)
+
+    with build_op_context() as context:
+        records = storage.iter_blobs_from_path(context, "silversea/2024/06/20/socket", max_concurrency=2)
+        next(records)
+        closer = threading.Thread(target=records.close)
+        closer.start()
+        closer.join(timeout=10)
+
+    assert not closer.is_alive()
+
+
+def test_blob_download_errors_surface_in_the_consumer(storage, blob_store, tmp_path):
+    names = _put_ndjson_blobs(blob_store, 4, 10)
+    blob_store.broken.add(names[2])
+
+    with build_op_context() as context:
+        with pytest.raises(ServiceResponseError):
+            list(storage.iter_blobs_from_path(context, "silversea/2024/06/20/socket"))
+        with pytest.raises(ServiceResponseError):
+            storage.download_blobs_to_directory(context, "silversea/2024/06/20/socket", str(tmp_path / "download"))
+
+
+def test_download_blobs_to_directory_writes_one_file_per_blob(storage, blob_store, tmp_path):
+    names = _put_ndjson_blobs(blob_store, 3, 10)
+
+    with build_op_context() as context:
+        files = storage.download_blobs_to_directory(context, "silversea/2024/06/20/socket", str(tmp_path), filters={"action": "prices-v2"})
+
+    assert [os.path.basename(file) for file in files] == [name.split("/socket/")[1].replace("/", "__") for name in names]
+    for name, file in zip(names, files):
+        with open(file, "rb") as downloaded:
+            assert downloaded.read() == blob_store.blobs[name]
+
+
+def test_duckdb_arrow_io_manager_replaces_partitions_and_loads_lazily(tmp_path):
+    partitions = StaticPartitionsDefinition(["a", "b"])
+
+    @asset(partitions_def=partitions, metadata={"partition_expr": "part"})
+    def codes(context) -> pa.Table:
+        part = context.partition_key
+        return pa.table({"part": [part, part], "fare_codes": [[f"{part}1"], [f"{part}2", f"{part}3"]]})
+
+    loaded = {}
+
+    @asset
+    def downstream(codes: LazyDuckDBTable) -> None:
+        loaded["count"] = codes.count()
+        loaded["rows"] = [row for batch in codes.iter_batches(batch_size=1) for row in batch.to_pylist()]
+        loaded["frame"] = codes.to_pandas()
+
+    io_manager = DuckDBArrowIOManager(database=str(tmp_path / "test.duckdb"))
+    for partition in ["a", "b", "a"]:
+        assert materialize([codes], partition_key=partition, resources={"io_manager": io_manager}).success
+    assert materialize([codes, downstream], selection=[downstream], resources={"io_manager": io_manager}).success
+
+    assert loaded["count"] == 4
+    assert sorted(row["part"] for row in loaded["rows"]) == ["a", "a", "b", "b"]
+    assert {"part": "b", "fare_codes": ["b2", "b3"]} in loaded["rows"]
+    assert sorted(loaded["frame"]["part"]) == ["a", "a", "b", "b"]
+
+
+def test_lazy_duckdb_table_reads_never_block_writers_in_the_same_process(tmp_path):
+    database = str(tmp_path / "test.duckdb")
+    with duckdb.connect(database) as conn:
+        conn.execute("create table codes as select range as i from range(10)")
+    table = LazyDuckDBTable(database, "select * from codes")
+
+    batches = table.iter_batches(batch_size=3)
+    next(batches)
+    # A generator still being worked through, then a reader while a writer is connected
+    with DuckDBResource(database=database).get_connection() as writer:
+        writer.execute("insert into codes values (10)")
+        assert table.count() == 11
+    assert sum(batch.num_rows for batch in batches) == 7
+
+
+def test_duckdb_arrow_io_manager_loads_arrow_annotated_inputs_as_tables(tmp_path):
+    @asset
+    def codes() -> pa.Table:
+        return pa.table({"sail_code": ["SC1", "SC2"], "fare_codes": [["Essential"], ["Essential", "DoorToDoor"]]})
+
+    loaded = {}
+
+    @asset
+    def downstream(codes: pa.Table) -> None:
+        loaded["codes"] = codes
+
+    io_manager = DuckDBArrowIOManager(database=str(tmp_path / "test.duckdb"))
+    assert materialize([codes, downstream], resources={"io_manager": io_manager}).success
+
+    assert isinstance(loaded["codes"], pa.Table)
+    assert loaded["codes"].sort_by("sail_code").to_pylist() == [
+        {"sail_code": "SC1", "fare_codes": ["Essential"]},
+        {"sail_code": "SC2", "fare_codes": ["Essential", "DoorToDoor"]},
+    ]
+
+
+def test_response_cache_coalesces_and_remembers_negative_replies():
+    cache = ResponseCache(ttl=0, negative_ttl=60, max_entries=10, is_negative=is_negative_response, is_error=lambda reply: "Bad" in reply)
+    sent = []
+
+    def send():
+        sent.append(Future())
+        return sent[-1]
+
+    # Concurrent identical requests share the one in flight
+    first = cache.get_or_submit(("prices-v2", "A"), send)
+    assert cache.get_or_submit(("prices-v2", "A"), send) is first
+    first.set_result('{"type": "PricesResponseV2"}')
+    # ttl=0 so a positive reply is not kept once it resolved
+    cache.get_or_submit(("prices-v2", "A"), send).set_result('{"type": "PricesResponseV2"}')
+
+    empty = cache.get_or_submit(("available-suites", "B"), send)
+    empty.set_result('{"suites": []}')
+    assert cache.get_or_submit(("available-suites", "B"), send) is empty
+
+    # Bad requests are errors and are sent again
+    cache.get_or_submit(("prices-v2", "C"), send).set_result('{"type": "BadRequestResponse"}')
+    cache.get_or_submit(("prices-v2", "C"), send)
+
+    assert len(sent) == 5
+    assert cache.metadata("websocket") == {"websocket_cache_hits": 1, "websocket_cache_misses": 5, "websocket_cache_coalesced": 1}
+
+
+def test_request_metrics_summarize_latency_bytes_and_errors_by_type():
+    metrics = RequestMetrics("websocket", log_interval=0)
+    replies = [
+        '{"type": "PricesResponseV2", "data": {"prices": [{"air": {"type": "notAvailable"}}]}}',
+        '{"data": {}, "type": "PricesErrorResponseV2"}',
+        '{"type": "SuitesResponse", "suites": []}',
+        '{"type": "SuitesResponse", "suites": [{"suiteNumber": "VI1"}]}',
+        '{"type": "BadRequestResponse"}',
+    ]
+    for latency, reply in zip([0.003, 0.02, 0.02, 0.2, 40], replies):
+        metrics.record(latency, response_outcome(reply), bytes_sent=100, bytes_received=len(reply))
+    metrics.observe_queue_depth(7)
+    metrics.observe_queue_depth(2)
+
+    metadata = metrics.metadata()
+    assert metadata["websocket_errors_by_type"] == {"PricesErrorResponseV2": 1, "empty_suites": 1, "BadRequestResponse": 1}
+    assert metadata["websocket_latency_histogram"] == {"<=5ms": 1, "<=25ms": 2, "<=250ms": 1, "<=60000ms": 1}
+    assert metadata["websocket_latency_p50_ms"] == 25.0
+    assert metadata["websocket_bytes_sent"] == 500
+    assert metadata["websocket_bytes_received"] == sum(len(reply) for reply in replies)
+    assert metadata["websocket_peak_queue_depth"] == 7
+
+    logged = []
+    log = type("Log", (), {"info": lambda self, message: logged.append(message)})()
+    metrics.maybe_log(log)
+    # Nothing new to report
+    metrics.maybe_log(log)
+    assert len(logged) == 1 and "5 requests" in logged[0]
+
+
+def test_socket_replies_are_classified_from_raw_frames():
+    prices = b'{"requestId": "a-1", "data": {"prices": [{"air": {"type": "notAvailable"}}]}, "type": "PricesResponseV2"}'
+    assert request_id(prices) == "a-1"
+    assert response_outcome(prices) == "ok"
+    assert response_outcome(b'{"requestId": "a-2", "type": "PricesErrorResponseV2", "data": {}}') == "PricesErrorResponseV2"
+    # Error types outside a "type" key are still recognised
+    assert response_outcome(b'{"requestId": "a-3", "$type": "BadRequestResponse"}') == "BadRequestResponse"
+    assert response_outcome(b'{"requestId": "a-4", "error": {"name": "PricesErrorResponseV2"}}') == "PricesErrorResponseV2"
+    assert is_negative_response(("prices-v2",), b'{"kind": "PricesErrorResponseV2"}')
+    assert response_outcome(b'{"requestId": "a-5"}') == "unknown"
+    assert is_negative_response(("available-suites",), '{"type": "SuitesResponse", "suites": [ ]}')
+    assert not is_negative_response(("available-suites",), b'{"type": "SuitesResponse", "suites": [{"suiteNumber": "VI1"}]}')
+    # Ids that are not plain strings fall back to a full decode
+    assert request_id(b'{"requestId": "with \\"quotes\\""}') == 'with "quotes"'
+    assert request_id(b"not json") is None
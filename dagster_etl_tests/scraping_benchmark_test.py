@@ -0,0 +1,203 @@
+"""End-to-end scraping benchmarks against the local fakes.
+
+Run them alone with `pytest dagster_etl_tests/scraping_benchmark_test.py`. Every benchmark
+reports requests/sec (bytes/sec for staging), p50/p99 request latency and peak memory in its
+extra_info. Scale the catalog and the fakes' behaviour with the SCRAPE_BENCHMARK_* environment
+variables. The parser benchmarks run on synthetic data, scale them with
+SYNTHETIC_BENCHMARK_SAILINGS.
+"""
+import os
+import time
+from datetime import datetime, timedelta
+
+import duckdb
+import numpy as np
+import pytest
+from dagster import DagsterInstance, MultiPartitionKey, SourceAsset, materialize
+from dagster_duckdb import DuckDBResource
+
+from dagster_etl.assets.scraping import scrape
+from dagster_etl.assets.staging import silversea
+from dagster_etl.resources import AlgoliaAPI, DuckDBArrowIOManager, SilverSeaWebSocketClient
+from dagster_etl.utils import synthetic
+from dagster_etl.utils.profiling import peak_memory_mb
+
+from .fakes import FAKE_BLOB_STORES, FakeAlgoliaServer, FakeBlobStore, FakeSilverseaServer, FakeStorageAccountIoManager, recorded_hits
+
+pytest.importorskip("pytest_benchmark")
+
+COPIES = int(os.getenv("SCRAPE_BENCHMARK_COPIES", "5"))
+LATENCY = float(os.getenv("SCRAPE_BENCHMARK_LATENCY", "0.002"))
+ERROR_RATE = float(os.getenv("SCRAPE_BENCHMARK_ERROR_RATE", "0.01"))
+ROUNDS = int(os.getenv("SCRAPE_BENCHMARK_ROUNDS", "3"))
+SYNTHETIC_SAILINGS = int(os.getenv("SYNTHETIC_BENCHMARK_SAILINGS", "2000"))
+
+# Latency of every websocket or Algolia request in the current benchmark
+LATENCIES = []
+
+
+class TimedAlgoliaAPI(AlgoliaAPI):
+    def request(self, action, url, payload):
+        started = time.perf_counter()
+        try:
+            return super().request(action, url, payload)
+        finally:
+            LATENCIES.append(time.perf_counter() - started)
+
+
+class TimedSilverSeaWebSocketClient(SilverSeaWebSocketClient):
+    def submit(self, context, action, fare_code, sail_code, adults, kids, currency, cabin_category):
+        started = time.perf_counter()
+        future = super().submit(context, action, fare_code, sail_code, adults, kids, currency, cabin_category)
+        future.add_done_callback(lambda _: LATENCIES.append(time.perf_counter() - started))
+        return future
+
+
+@pytest.fixture(scope="module")
+def environment(tmp_path_factory):
+    hits = recorded_hits(COPIES)
+    directory = tmp_path_factory.mktemp("benchmark")
+    # scrape_availability reads scraped.public.cabin_categories, so the file name matters
+    database = str(directory / "scraped.duckdb")
+    with duckdb.connect(database) as conn:
+        conn.execute("create schema public")
+        conn.execute("create table public.cabin_categories (ship_code varchar, cabin_category varchar)")
+        conn.executemany(
+            "insert into public.cabin_categories values (?, ?)",
+            [(ship_code, category) for ship_code in {hit["cruiseCode"][:2] for hit in hits} for category in ["VI", "SL", "ME"]],
+        )
+
+    FAKE_BLOB_STORES["benchmark"] = FakeBlobStore(latency=LATENCY / 2)
+    with FakeSilverseaServer(latency=LATENCY, error_rate=ERROR_RATE) as socket_server, \
+            FakeAlgoliaServer(hits, latency=LATENCY, error_rate=ERROR_RATE) as algolia_server:
+        resources = {
+            "io_manager": DuckDBArrowIOManager(database=database),
+            "duckdb": DuckDBResource(database=database),
+            "storage_account_io_manager": FakeStorageAccountIoManager(account_name="benchmark", account_key="fake", container_name="landing-blob"),
+            "algolia_api": TimedAlgoliaAPI(algolia_url=algolia_server.url, algolia_api_key="fake", algolia_application_id="fake", initial_rate=100.0, max_rate=1000.0),
+            "websocket": TimedSilverSeaWebSocketClient(url=socket_server.url, pool_size=2, initial_rate=1000.0, max_rate=10000.0),
+        }
+        instance = DagsterInstance.ephemeral()
+        assert materialize([scrape.store_sail_codes_file], resources=resources, instance=instance).success
+        ship_code = max(instance.get_dynamic_partitions("ship_codes"), key=lambda code: sum(hit["cruiseCode"].startswith(code) for hit in hits))
+        yield {
+            "resources": resources,
+            "instance": instance,
+            "socket_server": socket_server,
+            "algolia_server": algolia_server,
+            "partition_key": MultiPartitionKey({"currency": "US", "ship_code": ship_code}),
+        }
+    del FAKE_BLOB_STORES["benchmark"]
+
+
+def run_rounds(benchmark, run, count, unit="requests"):
+    """Benchmarks `run` and reports its throughput in `unit`s per second, latency and memory."""
+    before = count()
+    LATENCIES.clear()
+    benchmark.pedantic(run, rounds=ROUNDS, iterations=1)
+    # --benchmark-disable runs it once as a plain test and keeps no stats
+    if benchmark.stats is None:
+        assert count() > before
+        return
+    per_round = (count() - before) / ROUNDS
+    seconds = benchmark.stats.stats.mean
+    info = {
+        unit: per_round,
+        f"{unit}_per_second": round(per_round / seconds, 1) if seconds else 0.0,
+        "peak_memory_mb": peak_memory_mb(),
+    }
+    if LATENCIES:
+        info["p50_latency_ms"] = round(float(np.percentile(LATENCIES, 50)) * 1000, 2)
+        info["p99_latency_ms"] = round(float(np.percentile(LATENCIES, 99)) * 1000, 2)
+    benchmark.extra_info.update(info)
+    assert per_round > 0
+
+
+def test_benchmark_store_sail_codes_file(benchmark, environment):
+    def run():
+        assert materialize([scrape.store_sail_codes_file], resources=environment["resources"], instance=environment["instance"]).success
+
+    run_rounds(benchmark, run, lambda: environment["algolia_server"].requests)
+
+
+@pytest.mark.parametrize("asset", [scrape.process_combination, scrape.scrape_availability], ids=lambda asset: asset.key.path[-1])
+def test_benchmark_socket_scraping(benchmark, environment, asset):
+    name = asset.key.path[-1]
+
+    def run():
+        result = materialize(
+            [SourceAsset("store_sail_codes_file"), asset],
+            partition_key=environment["partition_key"],
+            resources=environment["resources"],
+            instance=environment["instance"],
+            run_config={"ops": {name: {"config": {"resume": False}}}},
+        )
+        assert result.success
+
+    run_rounds(benchmark, run, lambda: environment["socket_server"].requests)
+
+
+@pytest.mark.parametrize("chunked", [False, True], ids=["in_memory", "chunked"])
+def test_benchmark_silversea_cabin_prices(benchmark, environment, chunked):
+    store = FAKE_BLOB_STORES["benchmark"]
+    if not any("/action=prices-v2/" in name for name in store.blobs):
+        assert materialize(
+            [SourceAsset("store_sail_codes_file"), scrape.process_combination],
+            partition_key=environment["partition_key"],
+            resources=environment["resources"],
+            instance=environment["instance"],
+        ).success
+
+    # Blobs land under the day they were scraped, which has no daily partition until it is over
+    today = datetime.now().strftime("%Y/%m/%d")
+    yesterday = datetime.now() - timedelta(days=1)
+    for name in list(store.blobs):
+        if name.startswith(f"silversea/{today}/"):
+            moved = name.replace(today, yesterday.strftime("%Y/%m/%d"), 1)
+            store._put(moved, store.blobs[name].replace(today.encode(), yesterday.strftime("%Y/%m/%d").encode()))
+    partition_key = yesterday.strftime("%Y-%m-%d")
+
+    def run():
+        result = materialize(
+            [silversea.silversea_cabin_prices],
+            partition_key=partition_key,
+            resources=environment["resources"],
+            instance=environment["instance"],
+            run_config={"ops": {"silversea_cabin_prices": {"config": {"chunked": chunked, "batch_size": 10_000}}}},
+        )
+        assert result.success
+
+    run_rounds(benchmark, run, lambda: store.bytes_downloaded, unit="bytes")
+
+
+@pytest.fixture(scope="module")
+def synthetic_sailings():
+    return synthetic.generate_sailings(SYNTHETIC_SAILINGS)
+
+
+def test_benchmark_process_sail_code_json_data(benchmark, synthetic_sailings):
+    pages = list(synthetic.algolia_pages(synthetic_sailings))
+    parsed = []
+
+    def run():
+        parsed.append(len(silversea.process_sail_code_json_data(pages, "2024-06-20")))
+
+    run_rounds(benchmark, run, lambda: sum(parsed), unit="sailings")
+
+
+def test_benchmark_prices_parser(benchmark, synthetic_sailings):
+    # A tenth of the sailings, so the messages fit comfortably in memory at the default scale
+    messages = [
+        message
+        for _, unit_messages in synthetic.price_units(synthetic.generate_sailings(max(1, SYNTHETIC_SAILINGS // 10)))
+        for message in unit_messages
+    ]
+    parsed = []
+
+    def run():
+        parser = silversea.PricesParser("2024-06-20")
+        for message in messages:
+            parser.add(message)
+        parsed.append(parser.buffered_rows)
+
+    run_rounds(benchmark, run, lambda: sum(parsed), unit="rows")
@@ -0,0 +1,40 @@
+with prices as (
+    select
+        extract_date,
+        unnest(from_json(payload -> '$.data.prices', '["JSON"]')) as price
+    from {{ source('public', 'raw_socket_prices') }}
+),
+
+quotes as (
+    select
+        extract_date,
+        price -> '$.right' as quote
+    from prices
+    where price ->> '$._tag' = 'Right'
+)
+
+select
+    quote ->> '$.cruiseCode' as sail_code,
+    left(quote ->> '$.cruiseCode', 2) as ship_code,
+    quote ->> '$.suiteCategory' as cabin_category,
+    (quote ->> '$.occupancy.adults')::bigint as adults,
+    (quote ->> '$.occupancy.kids')::bigint as kids,
+    quote ->> '$.fareCode' as fare_code,
+    quote ->> '$.air.type' as air_type,
+    quote ->> '$.suitePayment.type' as suite_payment_type,
+    (quote ->> '$.suitePayment.percentage')::bigint as suite_payment_percentage,
+    (quote ->> '$.suitePayment.amount.value')::double as suite_payment_amount_value,
+    quote ->> '$.suitePayment.amount.currency' as suite_payment_amount_currency,
+    (quote ->> '$.suitePayment.balanceAmount.value')::double as balance_amount_value,
+    quote ->> '$.suitePayment.balanceAmount.currency' as balance_amount_currency,
+    (quote ->> '$.suitePayment.totalAmount.value')::double as total_amount_value,
+    quote ->> '$.suitePayment.totalAmount.currency' as total_amount_currency,
+    quote ->> '$.suitePayment.finalDueDate' as final_duedate,
+    json_extract_string(quote, '$.price.inclusions[*].inclusionCode') as inclusions,
+    json_extract_string(quote, '$.price.paxPrices[*].number')::bigint[] as guest_seqn,
+    json_extract_string(quote, '$.price.paxPrices[*].total.value')::double[] as pax_prices_totalvalue,
+    json_extract_string(quote, '$.price.paxPrices[*].total.currency') as pax_prices_totalcurrency,
+    (quote ->> '$.price.total.value')::double as price_total_value,
+    quote ->> '$.price.total.currency' as price_total_currency,
+    extract_date
+from quotes
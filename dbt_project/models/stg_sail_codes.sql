@@ -0,0 +1,51 @@
+with results as (
+    select
+        extract_date,
+        unnest(from_json(payload -> '$.results', '["JSON"]')) as result
+    from {{ source('public', 'raw_algolia_results') }}
+),
+
+hits as (
+    select
+        extract_date,
+        unnest(from_json(result -> '$.hits', '["JSON"]')) as hit
+    from results
+)
+
+select
+    hit ->> '$.destinationName.en' as destination_name,
+    (hit ->> '$.visible')::boolean as is_visible,
+    left(hit ->> '$.cruiseCode', 2) as ship_code,
+    hit ->> '$.content.shipId' as ship_id,
+    hit ->> '$.content.shipName' as ship_name,
+    hit ->> '$.specialType' as special_type,
+    hit ->> '$.cruiseCode' as sail_code,
+    hit ->> '$.cruiseId' as cruise_id,
+    (hit ->> '$.available')::boolean as available,
+    (hit ->> '$.days')::bigint as days,
+    hit ->> '$.departureYearMonth' as departure_year_month,
+    hit ->> '$.departurePort.city.en' as departure_port,
+    hit ->> '$.arrivalPort.city.en' as arrival_port,
+    hit ->> '$.cruiseType' as cruise_type,
+    hit ->> '$.comboType' as combo_type,
+    json_extract_string(hit, '$.portCodes[*]') as port_codes,
+    json_extract_string(hit, '$.portNames[*]') as port_names,
+    json_extract_string(hit, '$.countryNames.en[*]') as country_names,
+    (hit ->> '$.departureTimestamp')::bigint as departure_timestamp,
+    (hit ->> '$.topCruise')::boolean as top_cruise,
+    hit ->> '$.dayGroup' as day_group,
+    json_extract_string(hit, '$.features[*]') as features,
+    hit ->> '$.cruiseGroup' as cruise_group,
+    json_extract_string(hit, '$.fareCodes[*]') as fare_codes,
+    json_extract_string(hit, '$.countries[*]') as countries,
+    hit ->> '$.currency' as currency,
+    (hit ->> '$.orderingPrice')::double as ordering_price,
+    hit ->> '$.orderingWebFare' as ordering_webfare,
+    -- Same struct as the Price records of the python staging
+    from_json(
+        hit -> '$.prices',
+        '[{"type": "VARCHAR", "webFareCode": "VARCHAR", "amount": "DOUBLE", "originalAmount": "DOUBLE", "promoConfigurationCodes": ["VARCHAR"]}]'
+    ) as prices,
+    json_extract_string(hit, '$.promoCodes[*]') as promo_codes,
+    extract_date
+from hits
@@ -0,0 +1,18 @@
+with prices as (
+    select
+        extract_date,
+        unnest(from_json(payload -> '$.data.prices', '["JSON"]')) as price
+    from {{ source('public', 'raw_socket_prices') }}
+)
+
+select
+    price ->> '$.left.request.cruiseCode' as sail_code,
+    left(price ->> '$.left.request.cruiseCode', 2) as ship_code,
+    price ->> '$.left.request.suiteCategory' as cabin_category,
+    (price ->> '$.left.request.occupancy.adults')::bigint as adults,
+    (price ->> '$.left.request.occupancy.kids')::bigint as kids,
+    price ->> '$.left.request.fareCode' as fare_code,
+    price ->> '$.left.request.air.type' as air_type,
+    extract_date
+from prices
+where price ->> '$._tag' = 'Left'
@@ -18,18 +18,25 @@ setup(
         "azure-storage-blob",
         "azure-mgmt-storage",
         "dbt-duckdb",
-        "geopandas",
-        "kaleido",
+        # to_arrow_table / to_arrow_reader, .arrow() returns a reader from 1.5 on
+        "duckdb>=1.5",
         "pandas",
-        "plotly",
-        "shapely",
         "smart_open[s3]",
         "s3fs",
         "smart_open",
         "boto3",
         "pyarrow",
         "jsonpath-ng",
-        "websocket-client",
+        "websockets>=14",
+        "urllib3",
+        "brotli",
     ],
-    extras_require={"dev": ["dagster-webserver", "pytest"]},
+    extras_require={
+        "dev": ["dagster-webserver", "pytest", "pytest-benchmark"],
+        "zstd": ["zstandard"],
+        # Faster JSON for socket replies and staging, the standard library is used without it
+        "fastjson": ["orjson"],
+        # Only for notebooks and charts, nothing in dagster_etl imports them
+        "viz": ["geopandas", "kaleido", "plotly", "shapely"],
+    },
 )